@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк Email Validator Bot без реального MailApi.dev
+
+Поднимает локальную замену /v1/verify и пакетного /v1/verify/bulk (задержки,
+429/402/5xx, учет кредитов),
+генерирует Depop JSON / TXT файлы нужного размера и гоняет на них парсинг
+(с задержкой event loop за время разбора) и check_emails_batch. Каждый замер идет в отдельном процессе, чтобы пик
+памяти не смешивался между замерами. Результат - JSON.
+
+Пример:
+    python benchmark.py --sizes 1000,100000 --latency-ms 30 --throttle-rate 0.01 -o bench.json
+    python benchmark.py --sizes 100000 --formats txt --bulk --rate 10
+    python benchmark.py --sizes 1000000 --formats json --archive 16 --parse-processes 4 --no-verify
+    python benchmark.py --sizes 300000 --formats json --parse-inline-mb 1000 --no-verify
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from typing import List
+
+from aiohttp import web
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЗАМЕНА MAILAPI
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class FakeMailApi:
+    """Локальный /v1/verify с поведением MailApi.dev.
+
+    Задержка - логнормальная с медианой latency_ms. Доли ответов 500 и 429
+    задаются error_rate и throttle_rate, после credits запросов - 402.
+    Валидность адреса зависит только от самого адреса (crc32), поэтому
+    прогоны повторяемы. Пакетный запрос отвечает с той же задержкой плюс
+    bulk_cost_ms на адрес и не больше bulk_limit адресов (иначе 413).
+    """
+    def __init__(self, latency_ms: float, latency_sigma: float, error_rate: float,
+                 throttle_rate: float, credits: int, valid_pct: int, seed: int,
+                 bulk_cost_ms: float = 0.2, bulk_limit: int = 1000):
+        self.bulk_cost = bulk_cost_ms / 1000
+        self.bulk_limit = bulk_limit
+        self.latency = latency_ms / 1000
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.credits = credits
+        self.valid_pct = valid_pct
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.runner = None
+
+    async def delay(self, extra: float = 0.0):
+        if self.latency > 0:
+            await asyncio.sleep(
+                self.random.lognormvariate(math.log(self.latency), self.latency_sigma) + extra)
+
+    def failure(self):
+        """Ответ 500/429 по заданным долям или None"""
+        roll = self.random.random()
+        if roll < self.error_rate:
+            return web.Response(status=500)
+        if roll < self.error_rate + self.throttle_rate:
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        return None
+
+    def verdict(self, email: str) -> dict:
+        bucket = zlib.crc32(email.encode()) % 100
+        return {
+            'email': email,
+            'valid': bucket < self.valid_pct,
+            'validators': {'is_disposable': bucket < self.valid_pct // 10},
+        }
+
+    async def verify(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        await self.delay()
+        failure = self.failure()
+        if failure is not None:
+            return failure
+        if self.credits <= 0:
+            return web.Response(status=402)
+        self.credits -= 1
+        return web.json_response({**self.verdict(request.query.get('email', '')),
+                                  'creditsRemaining': self.credits})
+
+    async def verify_bulk(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        emails = (await request.json()).get('emails', [])
+        if len(emails) > self.bulk_limit:
+            return web.Response(status=413)
+        await self.delay(self.bulk_cost * len(emails))
+        failure = self.failure()
+        if failure is not None:
+            return failure
+        if self.credits < len(emails):
+            return web.Response(status=402)
+        self.credits -= len(emails)
+        return web.json_response({'results': [self.verdict(email) for email in emails],
+                                  'creditsRemaining': self.credits})
+
+    async def start(self, port: int) -> str:
+        app = web.Application()
+        app.router.add_get('/v1/verify', self.verify)
+        app.router.add_post('/v1/verify/bulk', self.verify_bulk)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1/verify"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ТЕСТОВЫЕ ДАННЫЕ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def synthetic_nicknames(count: int, seed: int):
+    """Никнеймы как у Depop: ~10% повторов, ~5% невозможных для Gmail"""
+    rnd = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    seen: List[str] = []
+    for _ in range(count):
+        roll = rnd.random()
+        if roll < 0.1 and seen:
+            nick = rnd.choice(seen)
+        elif roll < 0.15:
+            nick = 'shop_' + ''.join(rnd.choices(alphabet, k=6))
+        else:
+            nick = rnd.choice('abcdefghijklmnopqrstuvwxyz') + ''.join(
+                rnd.choices(alphabet, k=rnd.randint(5, 13))
+            )
+            if len(seen) < 10000:
+                seen.append(nick)
+        yield nick
+
+def write_input(path: str, file_type: str, count: int, seed: int):
+    """Пишет файл потоково - 1M записей не держатся в памяти"""
+    with open(path, 'w', encoding='utf-8') as f:
+        if file_type == 'json':
+            f.write('{')
+            for i, nick in enumerate(synthetic_nicknames(count, seed)):
+                record = {'seller': nick, 'price': 10 + i % 90, 'title': f'item {i}'}
+                f.write(f'{"," if i else ""}"{i}": {json.dumps(record)}')
+            f.write('}')
+        else:
+            for nick in synthetic_nicknames(count, seed):
+                f.write(nick + '\n')
+
+def write_archive(path: str, file_type: str, count: int, seed: int, members: int) -> str:
+    """Те же записи, разложенные по members файлам в zip (как выгрузка из нескольких JSON)"""
+    archive_path = path + '.zip'
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for m in range(members):
+            part = f'{path}.part{m}'
+            write_input(part, file_type, count // members + (m < count % members), seed + m)
+            archive.write(part, f'part{m:04d}.{file_type}')
+            os.remove(part)
+    return archive_path
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЗАМЕРЫ (ДОЧЕРНИЙ ПРОЦЕСС)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class NullMessage:
+    text = ''
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+class NullBot:
+    """Бот без Telegram: сообщения о прогрессе никуда не уходят"""
+    async def send_message(self, chat_id, text, **kwargs):
+        return NullMessage()
+
+def open_nicknames(tb, path: str, file_type: str):
+    """Никнеймы файла так же, как их читает задача бота (iter_job_nicknames)"""
+    kind = 'ZIP' if path.endswith('.zip') else file_type.upper()
+    nicknames = tb.iter_job_nicknames(path, kind)
+    return contextlib.closing(nicknames), nicknames
+
+async def bench_parse(tb, path: str, file_type: str, tick_ms: float = 5) -> dict:
+    """Разбор и нормализация в потоке, как в задаче бота, и задержка event loop.
+
+    Пока поток разбирает файл, loop каждые tick_ms просыпается; опоздание
+    пробуждения - сколько ждал бы обработчик апдейта Telegram.
+    """
+    stats = {'found': 0, 'rejected': 0, 'unique': 0}
+    lags: List[float] = []
+    tick = tick_ms / 1000
+
+    def consume():
+        f, nicknames = open_nicknames(tb, path, file_type)
+        with f:
+            for _ in tb.unique_candidates(nicknames, stats):
+                pass
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(tick)
+            lags.append(max(0.0, loop.time() - start - tick))
+
+    start = time.perf_counter()
+    probe = asyncio.create_task(ticker())
+    try:
+        await asyncio.to_thread(consume)
+    finally:
+        probe.cancel()
+    seconds = time.perf_counter() - start
+    tb.parse_pool.shutdown()
+    return {
+        'records': stats['found'],
+        'unique': stats['unique'],
+        'rejected': stats['rejected'],
+        'seconds': round(seconds, 3),
+        'records_per_sec': round(stats['found'] / seconds, 1) if seconds else 0,
+        'loop_lag_ms': {
+            'p50': round(percentile(lags, 50) * 1000, 2),
+            'p99': round(percentile(lags, 99) * 1000, 2),
+            'max': round(max(lags, default=0) * 1000, 2),
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+async def bench_verify(tb, path: str, file_type: str, rate: float, concurrency: int,
+                       workdir: str) -> dict:
+    latencies: List[float] = []
+
+    def timed(request):
+        async def timed_request(session, emails, api_key):
+            start = time.perf_counter()
+            try:
+                return await request(session, emails, api_key)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        return timed_request
+
+    tb.mailapi_request = timed(tb.mailapi_request)
+    tb.mailapi_bulk_request = timed(tb.mailapi_bulk_request)
+    await tb.http_client.start()
+    cache = tb.ResultCache(os.path.join(workdir, f'cache-{os.getpid()}.db'))
+    engine = tb.VerificationEngine(
+        tb.http_client.get_session(),
+        tb.KeyPool([{'key': 'bench', 'rate': rate, 'burst': max(1, int(rate))}]),
+        concurrency=concurrency, cache=cache
+    )
+    start = time.perf_counter()
+    f, nicknames = open_nicknames(tb, path, file_type)
+    try:
+        with f:
+            valid, credits, stats = await tb.check_emails_batch(engine, nicknames, 0, NullBot())
+    finally:
+        await tb.http_client.close()
+    seconds = time.perf_counter() - start
+    return {
+        'records': stats['found'],
+        'unique': stats['unique'],
+        'checked': engine.checked,
+        'valid': len(valid),
+        'unknown': stats['unknown'],
+        'stop_status': stats['stop_status'],
+        'seconds': round(seconds, 3),
+        'emails_per_sec': round(engine.checked / seconds, 1) if seconds else 0,
+        'requests': len(latencies),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 2),
+            'p99': round(percentile(latencies, 99) * 1000, 2),
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def child_main(task: dict):
+    os.environ['MAILAPI_URL'] = task['url']
+    os.environ['MX_DOH_URL'] = ''  # Без сети: MX всех доменов считается рабочим
+    if task.get('bulk'):
+        os.environ['MAILAPI_BULK_URL'] = task['url'] + '/bulk'
+    if task.get('parse_processes'):
+        os.environ['PARSE_PROCESSES'] = str(task['parse_processes'])
+    if task.get('parse_inline_mb') is not None:
+        os.environ['PARSE_INLINE_SIZE'] = str(int(task['parse_inline_mb'] * 2 ** 20))
+    os.chdir(task['workdir'])  # Кэш, конфиги и задачи бота - во временной папке
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import telegram_bot as tb
+
+    if task['stage'] == 'parse':
+        result = asyncio.run(bench_parse(tb, task['path'], task['format']))
+    else:
+        result = asyncio.run(bench_verify(
+            tb, task['path'], task['format'], task['rate'], task['concurrency'], task['workdir']
+        ))
+    print(json.dumps(result))
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЗАПУСК
+# ═══════════════════════════════════════════════════════════════════════════════
+
+async def run_child(task: dict) -> dict:
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--child', json.dumps(task),
+        stdout=asyncio.subprocess.PIPE
+    )
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"замер {task['stage']} {task['format']} упал (код {proc.returncode})")
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+async def run(args) -> dict:
+    api = FakeMailApi(args.latency_ms, args.latency_sigma, args.error_rate,
+                      args.throttle_rate, args.credits, args.valid_pct, args.seed,
+                      args.bulk_cost_ms, args.bulk_limit)
+    url = await api.start(args.port)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+            for size in args.sizes:
+                for file_type in args.formats:
+                    path = os.path.join(workdir, f'input-{size}.{file_type}')
+                    if args.archive:
+                        path = write_archive(path, file_type, size, args.seed, args.archive)
+                    else:
+                        write_input(path, file_type, size, args.seed)
+                    task = {'url': url, 'workdir': workdir, 'path': path, 'format': file_type,
+                            'rate': args.rate, 'concurrency': args.concurrency, 'bulk': args.bulk,
+                            'parse_processes': args.parse_processes,
+                            'parse_inline_mb': args.parse_inline_mb}
+                    entry = {'size': size, 'format': file_type,
+                             'file_mb': round(os.path.getsize(path) / 2 ** 20, 2)}
+                    entry['parse'] = await run_child({**task, 'stage': 'parse'})
+                    if not args.no_verify:
+                        calls = api.calls
+                        entry['verify'] = await run_child({**task, 'stage': 'verify'})
+                        entry['verify']['api_calls'] = api.calls - calls
+                    os.remove(path)
+                    results.append(entry)
+                    print(f"{size} {file_type}: готово", file=sys.stderr)
+    finally:
+        await api.stop()
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'child')},
+        'results': results,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк проверки emails на локальной замене MailApi")
+    parser.add_argument('--sizes', default='1000,10000',
+                        type=lambda s: [int(x) for x in s.split(',')],
+                        help="размеры входных файлов, записей (например 1000,100000,1000000)")
+    parser.add_argument('--formats', default='json,txt', type=lambda s: s.split(','))
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="медианная задержка ответа")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="разброс задержки (логнормальная)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--credits', type=int, default=10 ** 9, help="кредитов до ответов 402")
+    parser.add_argument('--valid-pct', type=int, default=25, help="процент валидных адресов")
+    parser.add_argument('--rate', type=float, default=0.0, help="лимит ключа, запросов/сек (0 - без лимита)")
+    parser.add_argument('--concurrency', type=int, default=50, help="параллельных запросов")
+    parser.add_argument('--bulk', action='store_true', help="пакетная проверка (MAILAPI_BULK_URL)")
+    parser.add_argument('--bulk-cost-ms', type=float, default=0.2, help="задержка пачки на адрес")
+    parser.add_argument('--bulk-limit', type=int, default=1000, help="адресов в пачке до ответа 413")
+    parser.add_argument('--archive', type=int, default=0,
+                        help="разложить записи по N файлам в zip (0 - один файл)")
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        help="процессов разбора архива (0 - PARSE_PROCESSES бота)")
+    parser.add_argument('--parse-inline-mb', type=float, default=None,
+                        help="файл больше разбирается в процессе (по умолчанию PARSE_INLINE_SIZE бота)")
+    parser.add_argument('--no-verify', action='store_true', help="только парсинг")
+    parser.add_argument('--port', type=int, default=0, help="порт замены MailApi (0 - любой свободный)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help="файл для JSON (по умолчанию stdout)")
+    return parser.parse_args()
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        child_main(json.loads(sys.argv[2]))
+        return
+
+    args = parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -5,23 +5,68 @@ Email Validator Telegram Bot v2.0
 Проверка Gmail через MailApi.dev - упрощенная версия
 """
 
+from __future__ import annotations
+
+import time
+IMPORT_STARTED = time.perf_counter()  # Начало запуска для StartupTimer
+
 import asyncio
-import aiohttp
+import bisect
+import csv
+import fcntl
+import gzip
+import hashlib
+import heapq
+import html
+import hmac
 import json
+import mmap
+import multiprocessing
 import os
-from typing import List, Tuple, Set
-from io import BytesIO, StringIO
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    filters,
-    ConversationHandler
-)
+import random
+import re
+import secrets
+import signal
+import string
+import shutil
+import sqlite3
+import ssl
+import tarfile
+import threading
+from array import array
+from collections import OrderedDict
+import codecs
+import uuid
+import zipfile
+import zlib
+from urllib.parse import urlsplit
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, asynccontextmanager, closing, contextmanager, nullcontext
+from functools import lru_cache, partial, wraps
+from itertools import chain, islice
+from typing import (List, Tuple, Set, Dict, Optional, Callable, Awaitable, Iterable, Iterator,
+                    AsyncContextManager, Union, TYPE_CHECKING)
+from io import BytesIO, StringIO, TextIOWrapper
+
+# aiohttp и python-telegram-bot импортируются при первой надобности:
+# load_aiohttp() и load_telegram() (см. ЛЕНИВЫЙ ИМПОРТ). Процессам
+# разбора они не нужны, а импорт - заметная часть времени перезапуска.
+if TYPE_CHECKING:
+    import aiohttp
+    from aiohttp import web
+    from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.error import RetryAfter, TelegramError
+    from telegram.ext import (
+        Application,
+        CommandHandler,
+        MessageHandler,
+        CallbackQueryHandler,
+        ContextTypes,
+        filters,
+        ConversationHandler,
+        TypeHandler
+    )
 
 # ═══════════════════════════════════════════════════════════════════════════════
 #                              КОНФИГУРАЦИЯ
@@ -30,73 +75,1001 @@ from telegram.ext import (
 # Используем токен из переменных окружения (BOT_TOKEN) или резервное значение.
 # ВАЖНО: Если вы используете токен из кода, убедитесь, что это ваш реальный токен.
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8535404887:AAFSYrEd3Fz7ymBtmRBKraYVQHl6oPkUvBw")
-MAILAPI_URL = "https://api.mailapi.dev/v1/verify"
-CONFIG_FILE = "bot_config.json"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")  # свой Bot API сервер
+MAILAPI_URL = os.getenv("MAILAPI_URL", "https://api.mailapi.dev/v1/verify")  # benchmark.py подменяет на локальный
+CONFIG_FILE = "bot_config.json"                                   # старый формат, переносится в CONFIG_DB
+CONFIG_DB = os.getenv("CONFIG_DB", "bot_config.db")
+
+# Лимиты MailApi по умолчанию (можно переопределить для пользователя через /setrate)
+DEFAULT_RATE_LIMIT = float(os.getenv("MAILAPI_RATE", "1.0"))      # запросов/сек
+DEFAULT_RATE_BURST = int(os.getenv("MAILAPI_BURST", "1"))         # допустимый всплеск
+VERIFY_CONCURRENCY = int(os.getenv("MAILAPI_CONCURRENCY", "10"))  # запросов в полёте
+
+# Повторы запросов к MailApi
+MAILAPI_RETRIES = int(os.getenv("MAILAPI_RETRIES", "4"))                  # повторов на адрес
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))            # сек
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))               # сек
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))        # доля повторов от запросов
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "20"))               # повторов сверх доли
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "10"))             # сбоев подряд до паузы
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "5"))              # сек
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "120"))    # сек
+
+# Пакетная проверка: POST {"emails": [...]} на MAILAPI_BULK_URL, ответ
+# {"results": [{"email", "valid", "validators"}], "creditsRemaining"} (пусто - по одному адресу)
+MAILAPI_BULK_URL = os.getenv("MAILAPI_BULK_URL", "")
+BULK_MIN_SIZE = int(os.getenv("BULK_MIN_SIZE", "10"))                    # начальный размер пачки
+BULK_MAX_SIZE = int(os.getenv("BULK_MAX_SIZE", "500"))
+BULK_TARGET_LATENCY = float(os.getenv("BULK_TARGET_LATENCY", "5"))      # сек на пачку
+BULK_PARALLEL = int(os.getenv("BULK_PARALLEL", "4"))                     # пачек в полете
+BULK_LINGER = 0.05                                                       # сек ожидания неполной пачки
+
+# Пул HTTP соединений
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))        # всего соединений
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "20"))   # соединений на хост
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))              # кэш DNS, сек
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))         # keep-alive, сек
+
+# Кэш результатов проверки
+CACHE_FILE = os.getenv("CACHE_FILE", "verify_cache.db")
+CACHE_TTL_VALID = int(os.getenv("CACHE_TTL_VALID", str(30 * 86400)))    # сек
+CACHE_TTL_INVALID = int(os.getenv("CACHE_TTL_INVALID", str(7 * 86400)))  # сек
+CACHE_LRU_SIZE = int(os.getenv("CACHE_LRU_SIZE", "100000"))
+CACHE_FLUSH_SIZE = 200  # записей в памяти до сброса на диск
+
+# Потоковая обработка файлов
+PARSE_BUFFER_SIZE = int(os.getenv("PARSE_BUFFER_SIZE", str(64 * 1024)))  # символов за чтение
+PARSE_RECORD_MAX = int(os.getenv("PARSE_RECORD_MAX", str(2 ** 20)))  # символов на запись JSON
+VERIFY_CHUNK = 500  # emails за одно чтение источника / запрос в кэш
+
+# Архивы (zip, gz, tar.gz) и несколько файлов в одном сообщении - одна задача
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", str(os.cpu_count() or 1)))  # процессов разбора
+ARCHIVE_MAX_MEMBERS = int(os.getenv("ARCHIVE_MAX_MEMBERS", "1000"))             # файлов из архива
+PARSE_INLINE_SIZE = int(os.getenv("PARSE_INLINE_SIZE", str(2 * 2 ** 20)))       # байт - больше разбирает процесс
+PARSE_BATCH = 2000          # кандидатов в пачке от процесса разбора большого файла
+PARSE_MEMO_SIZE = 200000    # никнеймов, повторы которых процесс разбора помнит
+MEDIA_GROUP_WAIT = 1.5  # сек без новых документов группы до постановки задачи
+
+# Правила имени Gmail для локального фильтра
+GMAIL_DOMAINS = ('gmail.com', 'googlemail.com')
+GMAIL_MIN_LEN = int(os.getenv("GMAIL_MIN_LEN", "6"))
+GMAIL_MAX_LEN = int(os.getenv("GMAIL_MAX_LEN", "30"))
+
+# Адреса-кандидаты из никнейма: домены по приоритету (первый валидный побеждает)
+# и шаблоны имени ({nick}, {dots}, {plain}, {letters} - см. PATTERN_FIELDS)
+EXPAND_DOMAINS = tuple(d.strip().lower() for d in os.getenv("EXPAND_DOMAINS", "gmail.com").split(',') if d.strip())
+EXPAND_PATTERNS = tuple(p.strip() for p in os.getenv("EXPAND_PATTERNS", "{nick}").split(',') if p.strip())
+EXPAND_MAX_CANDIDATES = int(os.getenv("EXPAND_MAX_CANDIDATES", "6"))   # адресов на никнейм
+EXPAND_MAX_DOMAINS = 10                                                  # доменов в /domains
+MX_DOH_URL = os.getenv("MX_DOH_URL", "https://dns.google/resolve")      # пусто - без проверки MX
+MX_CACHE_TTL = int(os.getenv("MX_CACHE_TTL", "3600"))                   # сек
+
+# Фоновые задачи: загруженные файлы и состояние хранятся в JOBS_DIR
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+JOBS_DB = os.path.join(JOBS_DIR, "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))                      # задач одновременно
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", "1"))    # задач на пользователя
+JOB_CHECKPOINT_INTERVAL = float(os.getenv("JOB_CHECKPOINT_INTERVAL", "5"))  # сек
+FAST_LANE_WORKERS = int(os.getenv("FAST_LANE_WORKERS", "1"))          # воркеров только для маленьких задач
+FAST_LANE_SIZE = int(os.getenv("FAST_LANE_SIZE", str(64 * 1024)))    # байт - задача считается маленькой
+
+# Справедливое деление MailApi между пользователями: лимиты по умолчанию,
+# свои значения пользователю задает администратор (/limits)
+SCHED_SLOTS = int(os.getenv("SCHED_SLOTS", str(HTTP_POOL_PER_HOST)))  # запросов в полете на процесс
+SCHED_QUANTUM = 10                                                     # запросов за круг на единицу веса
+USER_DAILY_QUOTA = int(os.getenv("USER_DAILY_QUOTA", "0"))             # проверок в сутки, 0 - без лимита
+QUOTA_BLOCK = 50                                                       # проверок, резервируемых за раз
+
+# Несколько процессов: основной принимает апдейты Telegram, задачи выполняют
+# JOB_PROCESSES процессов-воркеров по JOB_WORKERS задач (0 - все в одном процессе)
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "0"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))  # сек, опрос общей очереди
+SQLITE_TIMEOUT = 30.0  # сек ожидания блокировки, когда в базу пишут несколько процессов
+
+# Выгрузка всех результатов: формат и сжатие выбираются через /export
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COMPRESSIONS = ('gz', 'zip')
+EXPORT_PART_SIZE = int(os.getenv("EXPORT_PART_SIZE", str(45 * 2 ** 20)))  # лимит Telegram - 50 МБ
+
+# История проверок для режима сравнения (/diff)
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+
+# Сообщение о прогрессе
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "3"))   # сек между правками в чате
+PROGRESS_RATE_WINDOW = 30.0                                     # сек для расчета скорости
+
+# Webhook вместо long polling: WEBHOOK_URL - публичный адрес бота (пусто - polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                       # https://bot.example.com/telegram
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                 # пусто - случайный при запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))  # обработчиков одновременно
+
+# Метрики: HTTP /metrics на METRICS_HOST:METRICS_PORT (0 - выключено), /stats для админов
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(',', ' ').split()}
 
 # Состояния для ConversationHandler
 WAITING_API_KEY, WAITING_SINGLE_EMAIL = range(2)
 
+HELP_TEXT = (
+    "📖 <b>Как использовать бота</b>\n\n"
+    "<b>1. Настройка API:</b>\n"
+    "• Получите ключ на app.mailapi.dev\n"
+    "• 5000 бесплатных проверок!\n"
+    "• Используйте /setapi ключ\n\n"
+    "<b>2. Проверка файлов:</b>\n"
+    "• Просто отправьте JSON или TXT файл\n"
+    "• JSON: формат Depop (поле 'seller')\n"
+    "• TXT: список никнеймов (по строкам)\n"
+    "• Архивы .zip, .gz, .tar.gz и несколько файлов в одном сообщении - "
+    "одна задача, дубли между файлами убираются\n\n"
+    "<b>3. Результат:</b>\n"
+    "• Получите TXT с валидными Gmail\n"
+    "• Готово к использованию!\n\n"
+    "<b>Команды:</b>\n"
+    "/start - Главное меню\n"
+    "/setapi - Установить API ключ\n"
+    "/setrate - Лимит запросов/сек для ключа\n"
+    "/keys - Пул ключей\n"
+    "/addkey - Добавить ключ в пул\n"
+    "/removekey - Убрать ключ из пула\n"
+    "/jobs - Мои задачи\n"
+    "/export - Формат полной выгрузки (csv/jsonl, gz/zip)\n"
+    "/diff - Пропускать уже проверенные адреса\n"
+    "/domains - Домены для поиска адреса по никнейму\n"
+    "/limits - Мои лимиты: задачи, проверки в сутки\n"
+    "/cancel - Отменить задачу\n"
+    "/help - Эта справка"
+)
+
 # ═══════════════════════════════════════════════════════════════════════════════
-#                              ХРАНИЛИЩЕ ДАННЫХ
+#                              МЕТРИКИ
 # ═══════════════════════════════════════════════════════════════════════════════
 
-class UserConfig:
-    """Конфигурация пользователя"""
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+class Counter:
+    """Счетчик Prometheus с метками: inc() - одно сложение в dict"""
+    kind = 'counter'
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+    
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def total(self) -> float:
+        return sum(self.values.values())
+    
+    def samples(self) -> Iterator[Tuple[str, tuple, float]]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+class Histogram:
+    """Гистограмма Prometheus: счетчики по корзинам, сумма и число наблюдений"""
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values: Dict[tuple, list] = {}  # метки -> [счетчики корзин..., +Inf, сумма]
+    
+    def observe(self, value: float, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+    
+    def stats(self, *labels) -> Tuple[int, float]:
+        """(число наблюдений, среднее)"""
+        row = self.values.get(labels)
+        if not row:
+            return 0, 0.0
+        count = sum(row[:-1])
+        return count, row[-1] / count
+    
+    def samples(self) -> Iterator[Tuple[str, tuple, float]]:
+        for labels, row in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), row):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                yield f"{self.name}_bucket", labels + (('le', le),), cumulative
+            yield f"{self.name}_sum", labels, row[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+class Gauge:
+    """Значение, которое считается при чтении метрик"""
+    kind = 'gauge'
+    
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.labels = ()
+        self.read = read
+    
+    def samples(self) -> Iterator[Tuple[str, tuple, float]]:
+        try:
+            yield self.name, (), self.read()
+        except Exception:
+            pass
+
+class RateMeter:
+    """Событий в секунду за последнюю минуту: 60 секундных ячеек"""
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.slots = [0] * window
+        self.stamps = [0] * window
+    
+    def tick(self, amount: int = 1):
+        now = int(time.monotonic())
+        slot = now % self.window
+        if self.stamps[slot] != now:
+            self.stamps[slot] = now
+            self.slots[slot] = 0
+        self.slots[slot] += amount
+    
+    def rate(self) -> float:
+        now = int(time.monotonic())
+        total = sum(n for n, stamp in zip(self.slots, self.stamps) if now - stamp < self.window)
+        return total / self.window
+
+class Metrics:
+    """Метрики бота в памяти процесса.
+    
+    На горячем пути (каждый email) только сложения в dict, поэтому
+    накладные расходы незаметны на фоне HTTP запроса. Текст для
+    Prometheus собирается только при чтении /metrics.
+    """
     def __init__(self):
-        self.configs = self.load_configs()
+        self.started = time.time()
+        self.mailapi_latency = Histogram(
+            'mailapi_request_seconds', 'Время запроса к MailApi', ('status',))
+        self.mailapi_retries = Counter('mailapi_retries_total', 'Повторы запросов к MailApi')
+        self.verifications = Counter(
+            'verifications_total', 'Проверенные адреса по итоговому статусу', ('status',))
+        self.verify_rate = RateMeter()
+        self.cache = Counter('cache_lookups_total', 'Обращения к кэшу результатов', ('result',))
+        self.saved = Counter(
+            'requests_saved_total', 'Адреса без запроса к MailApi', ('reason',))
+        self.telegram_latency = Histogram(
+            'telegram_request_seconds', 'Время запроса к Telegram Bot API', ('method',))
+        self.download_seconds = Histogram(
+            'file_download_seconds', 'Скачивание файла из Telegram', ('type',), DURATION_BUCKETS)
+        self.parse_seconds = Histogram(
+            'file_parse_seconds', 'Разбор файла (чтение, фильтр и дедупликация)', ('type',),
+            DURATION_BUCKETS)
+        self.job_seconds = Histogram(
+            'job_seconds', 'Длительность задачи проверки', ('status',), DURATION_BUCKETS)
+        self.mailapi_batch = Histogram(
+            'mailapi_batch_size', 'Адресов в пакетном запросе к MailApi', (),
+            (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+        self.sched_wait = Histogram(
+            'scheduler_wait_seconds', 'Ожидание слота запроса к MailApi', ('lane',))
+        self.gauges: List[Gauge] = []
+        self.runner: Optional[web.AppRunner] = None
+    
+    def gauge(self, name: str, help_text: str, read: Callable[[], float]):
+        self.gauges.append(Gauge(name, help_text, read))
+    
+    def all(self) -> list:
+        return [self.mailapi_latency, self.mailapi_retries, self.verifications,
+                self.cache, self.saved, self.telegram_latency, self.download_seconds,
+                self.parse_seconds, self.job_seconds, self.mailapi_batch,
+                self.sched_wait] + self.gauges
+    
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines = []
+        for metric in self.all():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                # После значений меток могут идти готовые пары (le у гистограмм)
+                pairs = list(zip(metric.labels, labels)) + list(labels[len(metric.labels):])
+                label_text = ','.join(f'{k}="{v}"' for k, v in pairs)
+                lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+    
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """Поднимает HTTP /metrics"""
+        load_aiohttp()
+        
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain')
+        
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+    
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics = Metrics()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЛЕНИВЫЙ ИМПОРТ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class StartupTimer:
+    """Время запуска процесса: этапы - в секундах от начала импорта модуля,
+    импорт зависимостей - длительностью.
+    
+    Простой при перезапуске - время до первого апдейта (first_update):
+    накопившиеся за перезапуск апдейты Telegram отдает сразу.
+    """
+    def __init__(self, started: float = IMPORT_STARTED):
+        self.started = started
+        self.stages: Dict[str, float] = {}
+        self.imports: Dict[str, float] = {}
+    
+    def mark(self, stage: str):
+        """Отмечает этап (только первый раз)"""
+        self.stages.setdefault(stage, time.perf_counter() - self.started)
+    
+    def imported(self, name: str, start: float):
+        self.imports[name] = time.perf_counter() - start
+    
+    def report(self) -> str:
+        parts = [f"{stage} {seconds:.3f} с" for stage, seconds in self.stages.items()]
+        parts += [f"импорт {name} {seconds:.3f} с" for name, seconds in self.imports.items()]
+        return ', '.join(parts)
+
+startup = StartupTimer()
+
+def load_aiohttp():
+    """Импорт aiohttp - при первом запросе к MailApi, запуске /metrics или webhook"""
+    global aiohttp, web
+    if 'web' in globals():
+        return
+    start = time.perf_counter()
+    import aiohttp
+    from aiohttp import web
+    startup.imported('aiohttp', start)
+
+def load_telegram():
+    """Импорт python-telegram-bot - в main() и воркере задач, до первого обращения.
+    
+    Имена становятся глобальными, как при обычном импорте в начале модуля.
+    """
+    global Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, RetryAfter, TelegramError
+    global Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes
+    global filters, ConversationHandler, TypeHandler, TimedRequest
+    if 'TimedRequest' in globals():
+        return
+    start = time.perf_counter()
+    from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.error import RetryAfter, TelegramError
+    from telegram.request import HTTPXRequest
+    from telegram.ext import (
+        Application,
+        CommandHandler,
+        MessageHandler,
+        CallbackQueryHandler,
+        ContextTypes,
+        filters,
+        ConversationHandler,
+        TypeHandler
+    )
     
-    def load_configs(self) -> dict:
-        """Загружает конфиги из файла, если он существует."""
-        # На Railway это может работать, только если вы используете постоянное хранилище (Persistent Storage).
-        # Если нет, то каждый запуск бота будет чистым.
-        if os.path.exists(CONFIG_FILE):
+    class TimedRequest(HTTPXRequest):
+        """HTTP клиент Telegram с замером времени каждого метода Bot API"""
+        async def do_request(self, url: str, method: str, *args, **kwargs):
+            start = time.perf_counter()
             try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-    
-    def save_configs(self):
-        """Сохраняет конфиги в файл."""
-        # На Railway это может вызвать ошибку, если нет прав записи. 
-        # API ключ лучше хранить в базе данных или использовать только в памяти (до следующего перезапуска).
+                return await super().do_request(url, method, *args, **kwargs)
+            finally:
+                metrics.telegram_latency.observe(time.perf_counter() - start, url.rsplit('/', 1)[-1])
+    
+    startup.imported('telegram', start)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ХРАНИЛИЩЕ ДАННЫХ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class UserConfig:
+    """Конфигурация пользователя.
+    
+    Хранится в SQLite (WAL) строкой на пользователя и читается лениво - при
+    первом обращении к пользователю. Изменения сразу видны в памяти, а запись
+    строки уходит в поток: одна транзакция на изменение, порядок записей
+    сохраняет версия строки. Старый bot_config.json переносится при первом
+    подключении.
+    
+    Там же, в таблице usage, считаются проверки пользователя за сутки (UTC) -
+    счетчик общий для всех процессов.
+    """
+    def __init__(self, path: str = CONFIG_DB):
+        self.path = path
+        self.configs: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.db = None
+        self.version = 0
+        self.writes: Set[asyncio.Task] = set()
+        self.shared = False  # Процесс-воркер: настройки меняет основной процесс
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=SQLITE_TIMEOUT)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id TEXT PRIMARY KEY, config TEXT NOT NULL, "
+                "version INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "user_id TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, "
+                "PRIMARY KEY (user_id, day))"
+            )
+            self._migrate_json()
+        return self.db
+    
+    def _migrate_json(self):
+        """Переносит конфиги из bot_config.json (один раз)"""
+        if not os.path.exists(CONFIG_FILE):
+            return
         try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.configs, f, indent=2)
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                configs = json.load(f)
+        except Exception as e:
+            print(f"ОШИБКА ЧТЕНИЯ {CONFIG_FILE}: {e}")
+            return  # Файл остается на месте - не теряем его
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO users (user_id, config, version, updated_at) "
+                "VALUES (?, ?, 0, ?)",
+                [(uid, json.dumps(config), now) for uid, config in configs.items()]
+            )
+        os.replace(CONFIG_FILE, CONFIG_FILE + '.migrated')
+    
+    def _load(self, uid: str) -> Optional[dict]:
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT config FROM users WHERE user_id = ?", (uid,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _write(self, uid: str, data: str, version: int):
+        try:
+            with self.lock:
+                db = self._connect()
+                with db:
+                    # Запись из более раннего изменения не затирает позднюю
+                    db.execute(
+                        "INSERT INTO users (user_id, config, version, updated_at) "
+                        "VALUES (?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET "
+                        "config = excluded.config, version = excluded.version, "
+                        "updated_at = excluded.updated_at WHERE excluded.version > users.version",
+                        (uid, data, version, time.time())
+                    )
         except Exception as e:
             print(f"ОШИБКА ЗАПИСИ КОНФИГА: {e}")
-            pass
     
-    # ИСПРАВЛЕНИЕ: УБРАНА ПОПЫТКА ЗАПИСИ В ФАЙЛ ПРИ ПЕРВОМ ЗАПУСКЕ
+    def save(self, user_id: int):
+        """Сохраняет конфиг пользователя: в потоке, если работает event loop"""
+        uid = str(user_id)
+        data = json.dumps(self.configs[uid])
+        self.version = max(self.version + 1, time.time_ns())
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(uid, data, self.version)
+            return
+        task = loop.create_task(asyncio.to_thread(self._write, uid, data, self.version))
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+    
+    async def flush(self):
+        """Дожидается всех начатых записей"""
+        if self.writes:
+            await asyncio.gather(*self.writes)
+    
+    @staticmethod
+    def _defaults() -> dict:
+        return {
+            'mailapi_key': '',
+            'selector': 'seller',
+            'rate_limit': DEFAULT_RATE_LIMIT,
+            'rate_burst': DEFAULT_RATE_BURST
+        }
+    
+    def reload(self, user_id: int) -> dict:
+        """Перечитывает конфиг из базы - его мог изменить другой процесс.
+        
+        Строка из базы заменяет конфиг целиком: удаленные там ключи
+        (например, limit_* после /limits reset) пропадают и здесь.
+        """
+        uid = str(user_id)
+        fresh = self._load(uid)
+        if fresh is None:
+            return self.get_user_config(user_id)
+        self.configs[uid] = {**self._defaults(), **fresh}
+        return self.configs[uid]
+    
+    # Новый пользователь живет в памяти, пока не изменит настройки
     def get_user_config(self, user_id: int) -> dict:
         uid = str(user_id)
         if uid not in self.configs:
-            # Создаем конфигурацию в памяти, но не вызываем save_configs()
-            # при первом доступе, чтобы избежать ошибки записи на старте.
-            self.configs[uid] = {
-                'mailapi_key': '',
-                'selector': 'seller'
-            }
+            self.configs[uid] = {**self._defaults(), **(self._load(uid) or {})}
         return self.configs[uid]
     
     def set_api_key(self, user_id: int, key: str):
-        uid = str(user_id)
         config = self.get_user_config(user_id)
         config['mailapi_key'] = key
-        self.save_configs() # Сохраняем только когда ключ реально меняется
+        self.save(user_id)
     
     def get_api_key(self, user_id: int) -> str:
         return self.get_user_config(user_id).get('mailapi_key', '')
+    
+    def set_rate_limit(self, user_id: int, rate: float, burst: int):
+        config = self.get_user_config(user_id)
+        config['rate_limit'] = rate
+        config['rate_burst'] = burst
+        self.save(user_id)
+    
+    def get_rate_limit(self, user_id: int) -> Tuple[float, int]:
+        """Лимит запросов для ключа пользователя: (запросов/сек, всплеск)"""
+        config = self.get_user_config(user_id)
+        return (
+            float(config.get('rate_limit', DEFAULT_RATE_LIMIT)),
+            int(config.get('rate_burst', DEFAULT_RATE_BURST))
+        )
+    
+    def set_export(self, user_id: int, export_format: str, compression: str):
+        config = self.get_user_config(user_id)
+        config['export_format'] = export_format
+        config['export_compression'] = compression
+        self.save(user_id)
+    
+    def set_diff_mode(self, user_id: int, enabled: bool):
+        self.get_user_config(user_id)['diff_mode'] = enabled
+        self.save(user_id)
+    
+    def set_domains(self, user_id: int, domains: List[str]):
+        self.get_user_config(user_id)['domains'] = domains
+        self.save(user_id)
+    
+    def get_domains(self, user_id: int) -> List[str]:
+        """Домены кандидатов по приоритету"""
+        return self.get_user_config(user_id).get('domains') or list(EXPAND_DOMAINS)
+    
+    def set_limits(self, user_id: int, limits: dict):
+        """Свои лимиты пользователя; None в значении - вернуть значение по умолчанию"""
+        config = self.get_user_config(user_id)
+        for name, value in limits.items():
+            if value is None:
+                config.pop(f'limit_{name}', None)
+            else:
+                config[f'limit_{name}'] = value
+        self.save(user_id)
+    
+    def get_limits(self, user_id: int) -> dict:
+        """Лимиты пользователя: jobs - задач одновременно, quota - проверок
+        в сутки (0 - без лимита), weight - доля запросов к MailApi"""
+        config = self.get_user_config(user_id)
+        return {
+            'jobs': int(config.get('limit_jobs', JOB_USER_CONCURRENCY)),
+            'quota': int(config.get('limit_quota', USER_DAILY_QUOTA)),
+            'weight': float(config.get('limit_weight', 1.0)),
+        }
+    
+    def reserve_quota(self, user_id: int, amount: int) -> int:
+        """Резервирует до amount проверок из дневной квоты, возвращает сколько дали.
+        
+        Блокирующий. BEGIN IMMEDIATE - чтобы процессы не выдали одну квоту дважды.
+        """
+        if self.shared:
+            self.reload(user_id)  # Лимит мог поменять /limits в основном процессе
+        quota = self.get_limits(user_id)['quota']
+        uid, day = str(user_id), time.strftime('%Y-%m-%d', time.gmtime())
+        with self.lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT used FROM usage WHERE user_id = ? AND day = ?", (uid, day)
+                ).fetchone()
+                used = row[0] if row else 0
+                granted = amount if quota <= 0 else max(0, min(amount, quota - used))
+                if granted:
+                    db.execute(
+                        "INSERT INTO usage (user_id, day, used) VALUES (?, ?, ?) "
+                        "ON CONFLICT (user_id, day) DO UPDATE SET used = used + excluded.used",
+                        (uid, day, granted)
+                    )
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return granted
+    
+    def release_quota(self, user_id: int, amount: int):
+        """Возвращает неиспользованный резерв (блокирующий)"""
+        if amount <= 0:
+            return
+        uid, day = str(user_id), time.strftime('%Y-%m-%d', time.gmtime())
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "UPDATE usage SET used = MAX(0, used - ?) WHERE user_id = ? AND day = ?",
+                    (amount, uid, day)
+                )
+    
+    def quota_used(self, user_id: int) -> int:
+        """Проверок за сегодня (блокирующий)"""
+        uid, day = str(user_id), time.strftime('%Y-%m-%d', time.gmtime())
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT used FROM usage WHERE user_id = ? AND day = ?", (uid, day)
+            ).fetchone()
+        return row[0] if row else 0
+    
+    def get_export(self, user_id: int) -> Tuple[str, str]:
+        """Формат полной выгрузки: (csv/jsonl, gz/zip)"""
+        config = self.get_user_config(user_id)
+        return config.get('export_format', 'csv'), config.get('export_compression', 'gz')
+    
+    def get_api_keys(self, user_id: int) -> List[dict]:
+        """Все ключи пользователя: основной первым, затем дополнительные"""
+        config = self.get_user_config(user_id)
+        keys = []
+        if config.get('mailapi_key'):
+            rate, burst = self.get_rate_limit(user_id)
+            keys.append({'key': config['mailapi_key'], 'rate': rate, 'burst': burst})
+        keys.extend(config.get('mailapi_keys', []))
+        return keys
+    
+    def add_api_key(self, user_id: int, key: str, rate: float, burst: int):
+        """Добавляет ключ в пул; первый ключ становится основным"""
+        config = self.get_user_config(user_id)
+        if not config.get('mailapi_key') or config['mailapi_key'] == key:
+            config['mailapi_key'] = key
+            config['rate_limit'] = rate
+            config['rate_burst'] = burst
+        else:
+            extra = [k for k in config.get('mailapi_keys', []) if k['key'] != key]
+            extra.append({'key': key, 'rate': rate, 'burst': burst})
+            config['mailapi_keys'] = extra
+        self.save(user_id)
+    
+    def remove_api_key(self, user_id: int, key: str) -> bool:
+        """Удаляет ключ; вместо основного становится первый дополнительный"""
+        config = self.get_user_config(user_id)
+        extra = config.get('mailapi_keys', [])
+        if config.get('mailapi_key') == key:
+            if extra:
+                first = extra.pop(0)
+                config['mailapi_key'] = first['key']
+                config['rate_limit'] = first['rate']
+                config['rate_burst'] = first['burst']
+            else:
+                config['mailapi_key'] = ''
+        elif any(k['key'] == key for k in extra):
+            extra = [k for k in extra if k['key'] != key]
+        else:
+            return False
+        config['mailapi_keys'] = extra
+        self.save(user_id)
+        return True
 
 user_config = UserConfig()
 
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              HTTP КЛИЕНТ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class HttpClient:
+    """Общий пул keep-alive соединений для всех запросов к MailApi.
+    
+    Создается при первом запросе (get_session), а не при старте - запуск
+    бота не ждет импорта aiohttp. Закрывается при остановке, после этого
+    get_session снова работает только после start().
+    Считает запросы, новые и переиспользованные соединения.
+    """
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.closed = False
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+    
+    async def start(self):
+        self.closed = False
+        self._open()
+    
+    def _open(self):
+        if self.session is not None and not self.session.closed:
+            return
+        
+        load_aiohttp()
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_connection_create_end.append(self._on_connection_create)
+        trace.on_connection_reuseconn.append(self._on_connection_reuse)
+        
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+    
+    async def close(self):
+        self.closed = True
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.closed:
+            raise RuntimeError("HTTP клиент остановлен")
+        self._open()
+        return self.session
+    
+    async def _on_request_start(self, session, ctx, params):
+        self.requests += 1
+    
+    async def _on_connection_create(self, session, ctx, params):
+        self.connections_created += 1
+    
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+    
+    def stats(self) -> dict:
+        """Размер пула и статистика переиспользования соединений"""
+        connector = self.session.connector if self.session else None
+        total = self.connections_created + self.connections_reused
+        return {
+            'limit': HTTP_POOL_LIMIT,
+            'limit_per_host': HTTP_POOL_PER_HOST,
+            'requests': self.requests,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': self.connections_reused / total if total else 0.0,
+            'idle': sum(len(c) for c in connector._conns.values()) if connector else 0,
+        }
+
+http_client = HttpClient()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              КЭШ РЕЗУЛЬТАТОВ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class ResultCache:
+    """Кэш результатов проверки: SQLite на диске + LRU в памяти.
+    
+    Ключ - нормализованный email. Валидные и невалидные результаты живут
+    разное время (CACHE_TTL_VALID / CACHE_TTL_INVALID). Ошибки не кэшируются.
+    Методы get_many и flush блокирующие - вызывать через asyncio.to_thread.
+    lock защищает только LRU и pending (его берет put в event loop), запросы
+    к SQLite идут под отдельным db_lock.
+    """
+    def __init__(self, path: str = CACHE_FILE, lru_size: int = CACHE_LRU_SIZE):
+        self.path = path
+        self.lru_size = lru_size
+        self.lru: OrderedDict = OrderedDict()  # email -> (status, checked_at)
+        self.pending: List[Tuple[str, str, float]] = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.db = None
+    
+    @staticmethod
+    def normalize(email: str) -> str:
+        return email.strip().lower()
+    
+    @staticmethod
+    def is_fresh(status: str, checked_at: float, now: float) -> bool:
+        ttl = CACHE_TTL_VALID if status == 'valid' else CACHE_TTL_INVALID
+        return now - checked_at < ttl
+    
+    def _connect(self):
+        if self.db is None:
+            try:
+                self.db = sqlite3.connect(self.path, check_same_thread=False,
+                                          timeout=SQLITE_TIMEOUT)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    "email TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                    "disposable INTEGER NOT NULL, checked_at REAL NOT NULL)"
+                )
+            except sqlite3.Error as e:
+                # Без диска работаем только с LRU в памяти
+                print(f"ОШИБКА ОТКРЫТИЯ КЭША: {e}")
+                self.db = False
+        return self.db
+    
+    def _remember(self, key: str, status: str, checked_at: float):
+        self.lru[key] = (status, checked_at)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+    
+    def get_many(self, emails: List[str]) -> Dict[str, str]:
+        """Возвращает {email: status} для найденных в кэше свежих записей"""
+        now = time.time()
+        found: Dict[str, str] = {}
+        missing: Dict[str, str] = {}
+        
+        with self.lock:
+            for email in emails:
+                key = self.normalize(email)
+                entry = self.lru.get(key)
+                if entry and self.is_fresh(entry[0], entry[1], now):
+                    self.lru.move_to_end(key)
+                    found[email] = entry[0]
+                else:
+                    missing[key] = email
+        
+        rows = []
+        with self.db_lock:
+            db = self._connect()
+            keys = list(missing) if db else []
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows += db.execute(
+                    f"SELECT email, status, checked_at FROM results "
+                    f"WHERE email IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+        
+        with self.lock:
+            for key, status, checked_at in rows:
+                entry = self.lru.get(key)
+                if entry and entry[1] >= checked_at:
+                    status, checked_at = entry  # put() успел записать более свежий
+                if self.is_fresh(status, checked_at, now):
+                    found[missing[key]] = status
+                    self._remember(key, status, checked_at)
+            
+            self.hits += len(found)
+            self.misses += len(emails) - len(found)
+        return found
+    
+    def put(self, email: str, status: str):
+        """Запоминает результат в памяти, на диск попадет при flush()"""
+        if status not in ('valid', 'invalid', 'disposable'):
+            return
+        key = self.normalize(email)
+        now = time.time()
+        with self.lock:
+            self._remember(key, status, now)
+            self.pending.append((key, status, now))
+    
+    def flush(self):
+        """Сбрасывает накопленные результаты на диск"""
+        # db_lock первым: сбросы идут по очереди, старые записи не затрут новые
+        with self.db_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            db = self._connect()
+            if not pending or not db:
+                return
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO results (email, status, disposable, checked_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(key, status, int(status == 'disposable'), ts) for key, status, ts in pending]
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"ОШИБКА ЗАПИСИ КЭША: {e}")
+
+result_cache = ResultCache()
+
 # ═══════════════════════════════════════════════════════════════════════════════
 #                              MAILAPI ФУНКЦИИ
 # ═══════════════════════════════════════════════════════════════════════════════
 
-async def mailapi_verify_single(session, email: str, api_key: str) -> Tuple[str, str, int]:
-    """Проверка одного email через MailApi.dev"""
+class RetryBudget:
+    """Бюджет повторов: не больше ratio от числа запросов плюс min_retries.
+    
+    Не дает повторам умножить нагрузку на MailApi, когда он лежит.
+    """
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_retries: int = RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+    
+    def spend(self) -> bool:
+        """Забирает один повтор из бюджета; False - бюджет исчерпан"""
+        if self.retries >= self.min_retries + self.ratio * self.requests:
+            return False
+        self.retries += 1
+        return True
+
+class CircuitBreaker:
+    """Пауза всех запросов к MailApi, когда он деградирует.
+    
+    После threshold неудачных попыток подряд открывается на cooldown секунд
+    (при повторных срывах пауза удваивается до max_cooldown), затем пропускает
+    пробные запросы: первый успех закрывает его, первая неудача - снова открывает.
+    """
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.current_cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+    
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+    
+    async def wait(self):
+        """Ждёт, пока пауза не закончится"""
+        delay = self.open_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.open_until - time.monotonic()
+    
+    def record_success(self):
+        self.failures = 0
+        self.current_cooldown = self.cooldown
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold and not self.is_open:
+            print(f"MailApi деградирует - пауза {self.current_cooldown:g} сек")
+            self.open_until = time.monotonic() + self.current_cooldown
+            self.current_cooldown = min(self.current_cooldown * 2, self.max_cooldown)
+            self.failures = self.threshold - 1  # Пробный запрос после паузы
+            self.trips += 1
+
+mailapi_breaker = CircuitBreaker()
+
+def retry_delay(attempt: int, retry_after: float = 0.0) -> float:
+    """Экспоненциальная пауза с джиттером, не меньше Retry-After"""
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return max(retry_after, random.uniform(backoff / 2, backoff))
+
+def parse_retry_after(value: Optional[str]) -> float:
+    try:
+        return min(float(value), RETRY_MAX_DELAY) if value else 0.0
+    except ValueError:
+        return 0.0  # HTTP-дату не разбираем - хватит backoff
+
+def mailapi_verdict(data: dict) -> str:
+    """Статус адреса по ответу MailApi: valid / disposable / invalid"""
+    is_valid = data.get('valid', False)
+    is_disposable = (data.get('validators') or {}).get('is_disposable', False)
+    if is_valid and not is_disposable:
+        return 'valid'
+    return 'disposable' if is_valid else 'invalid'
+
+async def mailapi_request(session, email: str, api_key: str) -> Tuple[str, int, float]:
+    """Одна попытка проверки через MailApi.dev.
+    
+    Возвращает (статус, кредиты, Retry-After). Статус 'retry' - временный сбой
+    (таймаут, обрыв соединения, 429, 5xx), 'error' - повторять бесполезно.
+    """
     try:
         headers = {'Authorization': f'Bearer {api_key}'}
         params = {'email': email}
@@ -110,50 +1083,159 @@ async def mailapi_verify_single(session, email: str, api_key: str) -> Tuple[str,
         ) as resp:
             if resp.status == 200:
                 data = await resp.json()
-                credits = data.get('creditsRemaining', -1)
-                is_valid = data.get('valid', False)
-                validators = data.get('validators', {})
-                is_disposable = validators.get('is_disposable', False)
+                return mailapi_verdict(data), data.get('creditsRemaining', -1), 0.0
 
-                if is_valid and not is_disposable:
-                    return email, 'valid', credits
-                else:
-                    return email, 'invalid', credits
+            elif resp.status == 401:
+                return 'error_key', -1, 0.0
+            elif resp.status == 402:
+                return 'error_credits', -1, 0.0
+            elif resp.status == 429:
+                # Без Retry-After ключ все равно притормаживаем
+                return 'retry', -1, parse_retry_after(resp.headers.get('Retry-After')) or RETRY_BASE_DELAY
+            elif resp.status >= 500:
+                return 'retry', -1, parse_retry_after(resp.headers.get('Retry-After'))
+            else:
+                return 'error', -1, 0.0
+
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError, aiohttp.ContentTypeError, ValueError):
+        return 'retry', -1, 0.0
+    except aiohttp.ClientError:
+        return 'error', -1, 0.0
 
+async def mailapi_verify_single(
+    session,
+    email: str,
+    api_key: str,
+    budget: Optional[RetryBudget] = None,
+    on_throttle: Optional[Callable[[float], None]] = None,
+    slot: Optional[Callable[[int], AsyncContextManager]] = None,
+    acquire: Optional[Callable[[], Awaitable[None]]] = None
+) -> Tuple[str, str, int]:
+    """Проверка одного email через MailApi.dev с повторами.
+    
+    Временные сбои повторяются до MAILAPI_RETRIES раз с паузой retry_delay,
+    пока хватает бюджета; на время деградации MailApi запросы ждут
+    mailapi_breaker. Если повторы исчерпаны - статус 'unknown'.
+    on_throttle(сек) вызывается на 429 и на Retry-After. acquire() - токен
+    ключа перед каждым повтором (первый токен берет вызывающий). slot - слот
+    FairScheduler на время каждой попытки (паузы между ними слот не держат).
+    """
+    if budget:
+        budget.requests += 1
+    attempt = 0
+    while True:
+        if attempt and acquire:
+            await acquire()
+        await mailapi_breaker.wait()
+        async with slot(1) if slot else nullcontext():
+            start = time.perf_counter()
+            status, credits, retry_after = await mailapi_request(session, email, api_key)
+        metrics.mailapi_latency.observe(time.perf_counter() - start, status)
+        if status != 'retry':
+            mailapi_breaker.record_success()
+            return email, status, credits
+        
+        mailapi_breaker.record_failure()
+        if retry_after and on_throttle:
+            on_throttle(retry_after)
+        if attempt >= MAILAPI_RETRIES or (budget and not budget.spend()):
+            return email, 'unknown', -1
+        metrics.mailapi_retries.inc()
+        await asyncio.sleep(retry_delay(attempt, retry_after))
+        attempt += 1
+
+async def mailapi_bulk_request(session, emails: List[str],
+                               api_key: str) -> Tuple[str, Dict[str, str], int, float]:
+    """Одна попытка пакетной проверки через MAILAPI_BULK_URL.
+    
+    Возвращает (статус, {email: вердикт}, кредиты, Retry-After). Статусы как
+    у mailapi_request, плюс 'ok', 'too_large' (413 - пачку надо уменьшить)
+    и 'unsupported' (эндпоинта нет - проверяем по одному адресу).
+    """
+    try:
+        async with session.post(
+            MAILAPI_BULK_URL,
+            headers={'Authorization': f'Bearer {api_key}'},
+            json={'emails': emails},
+            timeout=aiohttp.ClientTimeout(total=120),
+            ssl=False
+        ) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                verdicts = {item['email']: mailapi_verdict(item)
+                            for item in data.get('results') or [] if item.get('email')}
+                return 'ok', verdicts, data.get('creditsRemaining', -1), 0.0
             elif resp.status == 401:
-                return email, 'error_key', -1
+                return 'error_key', {}, -1, 0.0
             elif resp.status == 402:
-                return email, 'error_credits', -1
+                return 'error_credits', {}, -1, 0.0
+            elif resp.status == 413:
+                return 'too_large', {}, -1, 0.0
+            elif resp.status in (404, 405, 501):
+                return 'unsupported', {}, -1, 0.0
+            elif resp.status == 429:
+                return 'retry', {}, -1, parse_retry_after(resp.headers.get('Retry-After')) or RETRY_BASE_DELAY
+            elif resp.status >= 500:
+                return 'retry', {}, -1, parse_retry_after(resp.headers.get('Retry-After'))
             else:
-                return email, 'error', -1
+                return 'error', {}, -1, 0.0
+    
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError, aiohttp.ContentTypeError, ValueError):
+        return 'retry', {}, -1, 0.0
+    except aiohttp.ClientError:
+        return 'error', {}, -1, 0.0
 
-    except:
-        return email, 'error', -1
+class BatchSizer:
+    """Размер пачки для пакетной проверки (AIMD).
+    
+    Пока полные пачки отвечают быстрее target секунд - размер растет
+    (вдвое на старте, затем на 10%); медленный ответ или сбой уменьшает
+    его на четверть.
+    """
+    def __init__(self, initial: int = BULK_MIN_SIZE, maximum: int = BULK_MAX_SIZE,
+                 target: float = BULK_TARGET_LATENCY):
+        self.maximum = max(1, maximum)
+        self.size = min(max(1, initial), self.maximum)
+        self.target = target
+        self.slow_start = True
+    
+    def on_success(self, batch: int, latency: float):
+        if latency > self.target:
+            self.size = max(1, int(self.size * 0.75))
+            self.slow_start = False
+        elif batch >= self.size:  # По неполной пачке о пределе ничего не узнали
+            grow = self.size if self.slow_start else max(1, self.size // 10)
+            self.size = min(self.maximum, self.size + grow)
+    
+    def on_failure(self):
+        self.size = max(1, int(self.size * 0.75))
+        self.slow_start = False
 
 async def mailapi_test_connection(api_key: str) -> Tuple[bool, str, int]:
     """Тест API ключа"""
     try:
-        connector = aiohttp.TCPConnector(ssl=False, force_close=True)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            headers = {'Authorization': f'Bearer {api_key}'}
-            params = {'email': 'test@gmail.com'}
-
-            async with session.get(
-                MAILAPI_URL,
-                headers=headers,
-                params=params,
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    credits = data.get('creditsRemaining', 0)
-                    return True, "✅ API работает!", credits
-                elif resp.status == 401:
-                    return False, "❌ Неверный ключ", 0
-                elif resp.status == 402:
-                    return False, "❌ Нет кредитов", 0
-                else:
-                    return False, f"❌ HTTP {resp.status}", 0
+        session = http_client.get_session()
+        headers = {'Authorization': f'Bearer {api_key}'}
+        params = {'email': 'test@gmail.com'}
+
+        async with session.get(
+            MAILAPI_URL,
+            headers=headers,
+            params=params,
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                credits = data.get('creditsRemaining', 0)
+                return True, "✅ API работает!", credits
+            elif resp.status == 401:
+                return False, "❌ Неверный ключ", 0
+            elif resp.status == 402:
+                return False, "❌ Нет кредитов", 0
+            else:
+                return False, f"❌ HTTP {resp.status}", 0
 
     except Exception as e:
         return False, f"❌ Ошибка: {str(e)[:30]}", 0
@@ -162,103 +1244,2399 @@ async def mailapi_test_connection(api_key: str) -> Tuple[bool, str, int]:
 #                              ПАРСИНГ ФАЙЛОВ
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def parse_json_content(content: str, selector: str = 'seller') -> List[str]:
-    """Парсинг JSON контента - извлекаем seller"""
-    try:
-        data = json.loads(content)
-        nicknames = []
-        
-        if isinstance(data, dict):
-            # Перебираем все записи (0, 1, 2, ...)
-            for key, value in data.items():
-                if isinstance(value, dict) and selector in value:
-                    seller = value[selector]
-                    if seller and isinstance(seller, str):
-                        nicknames.append(seller)
-        elif isinstance(data, list):
-            for item in data:
-                if isinstance(item, dict) and selector in item:
-                    seller = item[selector]
-                    if seller and isinstance(seller, str):
-                        nicknames.append(seller)
-        
-        return nicknames
-    except:
-        return []
+class InvalidJsonError(ValueError):
+    """Битый JSON: дальше ошибки файл не разобрать"""
+
+def iter_json_nicknames(stream, selector: str = 'seller',
+                        chunk_size: int = PARSE_BUFFER_SIZE,
+                        record_max: int = PARSE_RECORD_MAX) -> Iterator[str]:
+    """Потоковый парсинг JSON - извлекаем seller по одной записи.
+    
+    Поддерживает оба формата: dict записей {"0": {...}, ...} и list [{...}, ...].
+    stream - текстовый поток; в памяти держится буфер chunk_size плюс одна запись.
+    На битом JSON, отдав всё, что успел разобрать, бросает InvalidJsonError:
+    запись, которая не разобралась и за record_max символов, считается битой -
+    иначе ошибка в начале файла дочитывала бы его в память целиком.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    offset = 0  # Символов файла до начала buf
+    
+    def fill() -> bool:
+        """Дочитывает следующий кусок, отбрасывая разобранное. False на EOF"""
+        nonlocal buf, pos, offset
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return False
+        offset += pos
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+    
+    def peek() -> str:
+        """Пропускает пробелы и возвращает следующий символ ('' на EOF)"""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return ''
+    
+    def decode():
+        """Разбирает одно значение, дочитывая поток, пока оно не поместится в буфер"""
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if len(buf) - pos > record_max or not fill():
+                    raise
+                continue
+            # Число на границе буфера могло оборваться - дочитываем
+            if end < len(buf) or not fill():
+                pos = end
+                return value
+    
+    try:
+        opening = peek()
+        if opening not in ('{', '['):
+            return
+        pos += 1
+        is_dict = opening == '{'
+        closing = '}' if is_dict else ']'
+        
+        while True:
+            c = peek()
+            if c in (closing, ''):
+                return
+            if c == ',':
+                pos += 1
+                continue
+            if is_dict:
+                decode()  # Ключ записи (0, 1, 2, ...)
+                if peek() != ':':
+                    return
+                pos += 1
+                peek()
+            item = decode()
+            if isinstance(item, dict) and selector in item:
+                seller = item[selector]
+                if seller and isinstance(seller, str):
+                    yield seller
+    except json.JSONDecodeError as e:
+        raise InvalidJsonError(f"некорректный JSON (символ {offset + e.pos}): {e.msg}") from None
+
+def iter_txt_nicknames(stream) -> Iterator[str]:
+    """Потоковый парсинг TXT - по одной строке"""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+def parse_json_content(content: str, selector: str = 'seller') -> List[str]:
+    """Парсинг JSON контента - извлекаем seller"""
+    return list(iter_json_nicknames(StringIO(content), selector))
+
+def parse_txt_content(content: str) -> List[str]:
+    """Парсинг TXT контента"""
+    return list(iter_txt_nicknames(StringIO(content)))
+
+FILE_KINDS = (('.tar.gz', 'TAR'), ('.tgz', 'TAR'), ('.zip', 'ZIP'), ('.gz', 'GZ'),
+              ('.json', 'JSON'), ('.txt', 'TXT'))
+ARCHIVE_ERRORS = (OSError, EOFError, zlib.error, zipfile.BadZipFile, tarfile.TarError,
+                  InvalidJsonError)
+
+def file_kind(name: str) -> Optional[str]:
+    """Тип источника по имени: JSON, TXT или архив ZIP / GZ / TAR (tar.gz)"""
+    name = name.lower()
+    return next((kind for suffix, kind in FILE_KINDS if name.endswith(suffix)), None)
+
+def file_suffix(name: str) -> str:
+    """Расширение для копии на диске: у .gz сохраняется тип файла внутри"""
+    name = name.lower()
+    suffix = next(suffix for suffix, _ in FILE_KINDS if name.endswith(suffix))
+    if suffix == '.gz' and file_kind(name[:-3]) in ('JSON', 'TXT'):
+        suffix = name[:-3][name[:-3].rindex('.'):] + suffix
+    return suffix
+
+def is_hidden(name: str) -> bool:
+    """Служебные файлы архиваторов (__MACOSX, .DS_Store, ._*)"""
+    return name.startswith('__MACOSX/') or os.path.basename(name).startswith('.')
+
+def iter_members(path: str, kind: str) -> Iterator[Tuple[str, str, str]]:
+    """Файлы с никнеймами внутри источника задачи, всегда в одном порядке.
+    
+    Элемент - (путь, имя в zip, JSON/TXT/AUTO/TAR). Файл открывает тот, кто
+    разбирает. Тип AUTO (файл .gz без расширения внутри) определяется по
+    первому символу. tar(.gz) читается только подряд, поэтому идет одним
+    элементом - его файлы по очереди разбирает тот же процесс. Каталог -
+    документы одной media group - обходится по именам, архивы в нем раскрываются.
+    """
+    if kind in ('JSON', 'TXT', 'TAR'):
+        yield path, '', kind
+    elif kind == 'GZ':
+        inner = file_kind(path[:-3])
+        yield path, '', inner if inner in ('JSON', 'TXT') else 'AUTO'
+    elif kind == 'ZIP':
+        with zipfile.ZipFile(path) as archive:
+            names = sorted(info.filename for info in archive.infolist() if not info.is_dir())
+        for name in names:
+            if file_kind(name) in ('JSON', 'TXT') and not is_hidden(name):
+                yield path, name, file_kind(name)
+    elif kind == 'GROUP':
+        for name in sorted(os.listdir(path)):
+            yield from iter_members(os.path.join(path, name), file_kind(name))
+
+@contextmanager
+def open_member(member: Tuple[str, str, str]) -> Iterator[Tuple[object, str]]:
+    """Открывает файл из iter_members: (бинарный поток с распаковкой, JSON/TXT)"""
+    path, name, kind = member
+    with ExitStack() as stack:
+        if name:
+            raw = stack.enter_context(stack.enter_context(zipfile.ZipFile(path)).open(name))
+        elif path.lower().endswith('.gz'):
+            raw = stack.enter_context(gzip.open(path, 'rb'))
+        else:
+            raw = stack.enter_context(open(path, 'rb'))
+        if kind == 'AUTO':
+            head = raw.peek(PARSE_BUFFER_SIZE).lstrip(b'\xef\xbb\xbf \t\r\n')
+            kind = 'JSON' if head[:1] in (b'{', b'[') else 'TXT'
+        yield raw, kind
+
+def iter_raw_nicknames(raw, kind: str, selector: str) -> Iterator[str]:
+    """Никнеймы из бинарного потока JSON/TXT"""
+    reader = codecs.getreader('utf-8-sig')(raw, errors='ignore')
+    if kind == 'JSON':
+        yield from iter_json_nicknames(reader, selector)
+    else:
+        yield from iter_txt_nicknames(reader)
+
+def iter_tar_nicknames(path: str, selector: str) -> Iterator[str]:
+    """Файлы JSON/TXT из tar(.gz) подряд, не распаковывая их в память"""
+    with tarfile.open(path, 'r|*') as archive:
+        files = 0
+        for info in archive:
+            if files >= ARCHIVE_MAX_MEMBERS:
+                break
+            if info.isfile() and file_kind(info.name) in ('JSON', 'TXT') and not is_hidden(info.name):
+                files += 1
+                yield from iter_raw_nicknames(archive.extractfile(info), file_kind(info.name), selector)
+
+def iter_member_nicknames(member: Tuple[str, str, str], selector: str = 'seller',
+                          errors: Optional[List[str]] = None) -> Iterator[str]:
+    """Потоковый разбор одного файла из iter_members.
+    
+    Битый архив, как и битый JSON, не роняет задачу: отдаем то, что
+    успели разобрать, а ошибку добавляем в errors - ее увидит пользователь.
+    """
+    try:
+        if member[2] == 'TAR':
+            yield from iter_tar_nicknames(member[0], selector)
+            return
+        with open_member(member) as (raw, kind):
+            yield from iter_raw_nicknames(raw, kind, selector)
+    except ARCHIVE_ERRORS as e:
+        print(f"ОШИБКА РАЗБОРА {member[1] or member[0]}: {e}")
+        if errors is not None:
+            errors.append(f"{member[1]}: {e}" if member[1] else str(e))
+
+def iter_member_groups(member: Tuple[str, str, str], selector: str, domains: Tuple[str, ...],
+                       errors: Optional[List[str]] = None) -> Iterator[Tuple[str, ...]]:
+    """Разбор и нормализация файла - выполняется в процессе ParsePool.
+    
+    Для каждого никнейма по порядку - кортеж кандидатов (пустой - отсеян
+    фильтром). Повторы никнейма получают тот же объект кортежа: pickle
+    передает его один раз, а кандидаты не вычисляются заново. Память
+    повторов ограничена PARSE_MEMO_SIZE никнеймами.
+    """
+    expand = candidate_expander(domains, EXPAND_PATTERNS, EXPAND_MAX_CANDIDATES)
+    groups: Dict[str, Tuple[str, ...]] = {}
+    for nick in iter_member_nicknames(member, selector, errors):
+        group = groups.get(nick)
+        if group is None:
+            if len(groups) >= PARSE_MEMO_SIZE:
+                groups.clear()
+            group = groups[nick] = expand(nick)
+        yield group
+
+def parse_member(member: Tuple[str, str, str], selector: str,
+                 domains: Tuple[str, ...]) -> Tuple[List[Tuple[str, ...]], List[str]]:
+    """Файл архива целиком и ошибки его разбора (ParsePool.map)"""
+    errors: List[str] = []
+    return list(iter_member_groups(member, selector, domains, errors)), errors
+
+def stream_member(conn, member: Tuple[str, str, str], selector: str,
+                  domains: Tuple[str, ...]):
+    """Большой файл пачками по PARSE_BATCH в conn (ParsePool.stream).
+    
+    Пачка - список; в конце строка с ошибкой разбора ('' - файл целый).
+    """
+    try:
+        errors: List[str] = []
+        batch = []
+        for group in iter_member_groups(member, selector, domains, errors):
+            batch.append(group)
+            if len(batch) >= PARSE_BATCH:
+                conn.send(batch)
+                batch = []
+        conn.send(batch)
+        conn.send('; '.join(errors))
+    except (BrokenPipeError, EOFError):
+        pass  # Задачу остановили - пачки больше не нужны
+    finally:
+        conn.close()
+
+class ParsePool:
+    """Процессы для разбора файлов архива и больших файлов.
+    
+    Разбор JSON и нормализация никнеймов упираются в CPU и держат GIL:
+    в потоке основного процесса они отнимают время у event loop. Поэтому
+    файлы архива разбираются параллельно в PARSE_PROCESSES процессах (spawn,
+    пул создается при первом архиве), а большой одиночный файл - потоково
+    в своем процессе (stream).
+    """
+    def __init__(self, processes: int = PARSE_PROCESSES):
+        self.processes = max(1, processes)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+    
+    def map(self, members: Iterable[tuple], selector: str,
+            domains: Tuple[str, ...]) -> Iterator[Tuple[List[Tuple[str, ...]], List[str]]]:
+        """Кандидаты и ошибки каждого файла по порядку (parse_member); впереди
+        разбирается не больше 2 * processes файлов, чтобы не держать в памяти весь архив"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context('spawn'))
+        window: deque = deque()
+        try:
+            for member in members:
+                window.append(self.executor.submit(parse_member, member, selector, domains))
+                if len(window) >= 2 * self.processes:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+    
+    def stream(self, member: tuple, selector: str, domains: Tuple[str, ...],
+               errors: Optional[List[str]] = None) -> Iterator[List[Tuple[str, ...]]]:
+        """Кандидаты одного файла пачками по мере разбора (stream_member).
+        
+        Процесс пишет в pipe и ждет, пока пачку не заберут, - в памяти не
+        больше пары пачек, а проверка начинается с первой, не дожидаясь
+        конца файла. Если генератор закрыли раньше, процесс завершается.
+        Ошибка разбора добавляется в errors.
+        """
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=stream_member, args=(sender, member, selector, domains),
+                                  name='parse-stream', daemon=True)
+        process.start()
+        sender.close()
+        try:
+            while True:
+                try:
+                    batch = receiver.recv()
+                except EOFError:
+                    print(f"ОШИБКА РАЗБОРА {member[1] or member[0]}: процесс разбора завершился")
+                    batch = "процесс разбора завершился"
+                if isinstance(batch, str):
+                    if batch and errors is not None:
+                        errors.append(batch)
+                    return
+                yield batch
+        finally:
+            receiver.close()
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+parse_pool = ParsePool()
+
+def iter_job_nicknames(path: str, kind: str, selector: str = 'seller',
+                       domains: Iterable[str] = EXPAND_DOMAINS,
+                       errors: Optional[List[str]] = None) -> Iterator[Union[str, Tuple[str, ...]]]:
+    """Никнеймы источника задачи: файла, архива или группы файлов.
+    
+    Файл до PARSE_INLINE_SIZE байт разбирается потоково прямо здесь и
+    отдает никнеймы. Больший файл (пачками, по мере разбора) и файлы архива
+    разбирает parse_pool - они отдают уже готовые кортежи кандидатов по
+    доменам domains, в порядке файлов, так что продолжение задачи с курсора
+    видит тот же поток.
+    Дубли, в том числе между файлами, убирает unique_candidates. Ошибки
+    разбора (битый JSON или архив) собираются в errors.
+    """
+    members = islice(iter_members(path, kind), ARCHIVE_MAX_MEMBERS)
+    first, second = next(members, None), next(members, None)
+    if first is None:
+        return
+    # Размер сжатого файла - оценка снизу, для решения этого достаточно
+    size = os.path.getsize(first[0])
+    if second is None:
+        if size <= PARSE_INLINE_SIZE:
+            yield from iter_member_nicknames(first, selector, errors)
+        else:
+            for batch in parse_pool.stream(first, selector, tuple(domains), errors):
+                yield from batch
+        return
+    for groups, member_errors in parse_pool.map(chain((first, second), members),
+                                                selector, tuple(domains)):
+        if errors is not None:
+            errors.extend(member_errors)
+        yield from groups
+
+def source_size(path: str, kind: str) -> int:
+    """Сколько байт разбирать (без сжатия); -1 - заранее неизвестно"""
+    if kind in ('JSON', 'TXT'):
+        return os.path.getsize(path)
+    if kind == 'ZIP':
+        with zipfile.ZipFile(path) as archive:
+            return sum(info.file_size for info in archive.infolist())
+    if kind == 'GROUP':
+        sizes = [source_size(os.path.join(path, name), file_kind(name) or '')
+                 for name in os.listdir(path)]
+        return -1 if -1 in sizes else sum(sizes)
+    return -1
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЛОКАЛЬНЫЙ ФИЛЬТР И КАНДИДАТЫ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Латиница и цифры, точки только между символами (не в начале/конце, не подряд)
+GMAIL_LOCAL_RE = re.compile(r'^[a-z0-9]+(?:\.[a-z0-9]+)*$')
+
+def canonical_gmail(local: str) -> Optional[str]:
+    """Каноничный Gmail адрес для никнейма или None, если такого ящика быть не может.
+    
+    Gmail не различает регистр и точки, а +метка ведет в тот же ящик,
+    поэтому "John.Smith+shop" и "johnsmith" - это один johnsmith@gmail.com.
+    Принимает и полный адрес gmail.com/googlemail.com (например, из
+    unknown_emails.txt), адреса других доменов отсеиваются.
+    """
+    local, at, domain = local.strip().lower().rpartition('@')
+    if not at:
+        local = domain
+    elif domain not in GMAIL_DOMAINS:
+        return None
+    return gmail_address(local)
+
+def gmail_address(local: str) -> Optional[str]:
+    """canonical_gmail для имени, уже приведенного к нижнему регистру и без @"""
+    local = local.split('+', 1)[0]
+    if not GMAIL_LOCAL_RE.match(local):
+        return None  # Подчеркивания, дефисы, пробелы, кириллица и т.п.
+    canonical = local.replace('.', '')
+    if not GMAIL_MIN_LEN <= len(canonical) <= GMAIL_MAX_LEN:
+        return None
+    if len(canonical) >= 8 and canonical.isdigit():
+        return None  # Длинные имена обязаны содержать букву
+    return f"{canonical}@gmail.com"
+
+# Остальные почтовые сервисы: латиница, цифры и . _ - внутри имени, без точек подряд
+GENERIC_LOCAL_RE = re.compile(r'^[a-z0-9](?:[a-z0-9._-]{0,62}[a-z0-9])?$')
+DOMAIN_RE = re.compile(r'^[a-z0-9-]+(?:\.[a-z0-9-]+)+$')
+NICK_SEPARATORS_RE = re.compile(r'[\s_-]+')
+PATTERN_FIELDS = {
+    'nick': lambda nick: nick,                                    # как есть
+    'dots': lambda nick: NICK_SEPARATORS_RE.sub('.', nick).strip('.'),  # john_smith -> john.smith
+    'plain': lambda nick: NICK_SEPARATORS_RE.sub('', nick),       # john_smith -> johnsmith
+    'letters': lambda nick: nick.rstrip('0123456789'),           # john92 -> john
+}
+
+def candidate_email(local: str, domain: str) -> Optional[str]:
+    """Адрес local@domain по правилам имен домена или None"""
+    if domain in GMAIL_DOMAINS:
+        return canonical_gmail(local)
+    local = local.split('+', 1)[0]
+    if not GENERIC_LOCAL_RE.match(local) or '..' in local:
+        return None
+    return f"{local}@{domain}"
+
+def normalize_address(address: str) -> Optional[str]:
+    """Полный адрес в каноничном виде; имя без домена считается Gmail"""
+    local, at, domain = address.strip().lower().rpartition('@')
+    if not at:
+        return canonical_gmail(domain)
+    return candidate_email(local, domain)
+
+def expand_candidates(nick: str, domains: Iterable[str] = EXPAND_DOMAINS,
+                      patterns: Iterable[str] = EXPAND_PATTERNS,
+                      limit: int = EXPAND_MAX_CANDIDATES) -> Tuple[str, ...]:
+    """Адреса для проверки никнейма в порядке приоритета (не больше limit).
+    
+    Сначала все шаблоны первого домена, затем следующего. Полный адрес
+    остается единственным кандидатом, если его домен есть в списке.
+    """
+    return candidate_expander(tuple(domains), tuple(patterns), limit)(nick)
+
+@lru_cache(maxsize=64)
+def candidate_expander(domains: Tuple[str, ...], patterns: Tuple[str, ...],
+                       limit: int) -> Callable[[str], Tuple[str, ...]]:
+    """expand_candidates с шаблонами, разобранными один раз.
+    
+    Считаются только поля, которые есть в шаблонах; шаблон {nick}
+    подставляется без format_map, а Gmail-имя, уже приведенное
+    к нижнему регистру, не нормализуется второй раз.
+    """
+    formatter = string.Formatter()
+    plan: List[Optional[str]] = []  # None - шаблон {nick}
+    used: Set[str] = set()
+    for pattern in patterns:
+        try:
+            names = {re.split(r'[.\[]', name, 1)[0]
+                     for _, name, _, _ in formatter.parse(pattern) if name is not None}
+        except ValueError:
+            continue
+        if not names <= PATTERN_FIELDS.keys():
+            continue  # Шаблон с неизвестным полем
+        used |= names
+        plan.append(None if pattern == '{nick}' else pattern)
+    fields_used = [(name, PATTERN_FIELDS[name]) for name in PATTERN_FIELDS if name in used]
+    gmail_allowed = 'gmail.com' in domains
+    
+    def expand(nick: str) -> Tuple[str, ...]:
+        nick = nick.strip().lower()
+        local, at, domain = nick.rpartition('@')
+        if at:
+            allowed = domain in domains or (domain in GMAIL_DOMAINS and gmail_allowed)
+            email = candidate_email(local, domain) if allowed else None
+            return (email,) if email else ()
+        fields = {name: field(nick) for name, field in fields_used}
+        candidates: List[str] = []
+        for domain in domains:
+            for pattern in plan:
+                if pattern is None:
+                    email = (gmail_address(nick) if domain in GMAIL_DOMAINS
+                             else candidate_email(nick, domain))
+                else:
+                    try:
+                        email = candidate_email(pattern.format_map(fields), domain)
+                    except (KeyError, ValueError, IndexError, AttributeError, TypeError):
+                        continue
+                if email and email not in candidates:
+                    candidates.append(email)
+                    if len(candidates) >= limit:
+                        return tuple(candidates)
+        return tuple(candidates)
+    
+    return expand
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ПРОВЕРКА MX
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class MxResolver:
+    """Есть ли у домена MX записи - запросом DNS-over-HTTPS (MX_DOH_URL).
+    
+    Ответ кэшируется на домен на MX_CACHE_TTL, домены Gmail не проверяются.
+    Без MX_DOH_URL или при ошибке DNS домен считается рабочим - кандидатов
+    из-за сбоя не теряем. Без сети lookup подменяется (см. benchmark.py).
+    """
+    ERROR_TTL = 60  # сек до повтора после ошибки
+    
+    def __init__(self, url: str = MX_DOH_URL, ttl: int = MX_CACHE_TTL):
+        self.url = url
+        self.ttl = ttl
+        self.cache: Dict[str, Tuple[bool, float]] = {domain: (True, float('inf')) for domain in GMAIL_DOMAINS}
+        self.ssl_context: Optional[ssl.SSLContext] = None
+    
+    async def lookup(self, domain: str) -> Optional[bool]:
+        """True/False - есть ли MX, None - ответа нет"""
+        if not self.url:
+            return True
+        if self.ssl_context is None:
+            # Пул соединений создан с ssl=False, а подделанный ответ DNS отсеет
+            # рабочие домены - сертификат DoH проверяем (ssl=True взял бы настройку пула)
+            self.ssl_context = ssl.create_default_context()
+        try:
+            async with http_client.get_session().get(
+                self.url, params={'name': domain, 'type': 'MX'},
+                headers={'Accept': 'application/dns-json'},
+                timeout=aiohttp.ClientTimeout(total=5),
+                ssl=self.ssl_context
+            ) as response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"ОШИБКА MX {domain}: {e}")
+            return None
+        # Status 3 - домена нет; MX "0 ." (RFC 7505) - почту домен не принимает
+        return any(answer.get('type') == 15 and answer.get('data', '').split()[-1:] != ['.']
+                   for answer in data.get('Answer') or [])
+    
+    async def check_many(self, domains: Iterable[str]) -> Dict[str, bool]:
+        now = time.monotonic()
+        result = {}
+        for domain in set(domains):
+            entry = self.cache.get(domain)
+            if entry is None or entry[1] <= now:
+                has_mx = await self.lookup(domain)
+                if has_mx is None:
+                    entry = (True, now + self.ERROR_TTL)
+                else:
+                    entry = (has_mx, now + self.ttl)
+                self.cache[domain] = entry
+            result[domain] = entry[0]
+        return result
+
+mx_resolver = MxResolver()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ДВИЖОК ПРОВЕРКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TokenBucket:
+    """Токен-бакет: не больше rate запросов/сек, всплеск до burst"""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    def wait_time(self) -> float:
+        """Сколько секунд ждать до следующего токена (0 - есть сейчас)"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now  # MailApi попросил подождать (429)
+        if self.rate <= 0:
+            return 0.0  # Лимит не задан
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self):
+        """Забирает токен (после wait_time() == 0)"""
+        if self.rate > 0:
+            self.tokens -= 1
+    
+    async def acquire(self):
+        """Ждёт, пока появится токен, и забирает его"""
+        async with self.lock:
+            while True:
+                wait = self.wait_time()
+                if wait <= 0:
+                    self.take()
+                    return
+                await asyncio.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (Retry-After)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def mask_key(key: str) -> str:
+    """Ключ для показа пользователю: abcd…wxyz"""
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 10 else "…"
+
+class ApiKey:
+    """Ключ MailApi в пуле: свой лимит, последний известный остаток кредитов"""
+    def __init__(self, key: str, rate: float, burst: int = 1):
+        self.key = key
+        self.bucket = TokenBucket(rate, burst)
+        self.credits = -1
+        self.retired = ''  # '' / 'error_key' / 'error_credits'
+        self.requests = 0
+
+class KeyPool:
+    """Пул ключей пользователя.
+    
+    Каждый ключ ограничен своим токен-бакетом, поэтому суммарная скорость
+    равна сумме лимитов ключей. Из ключей с готовым токеном берется тот,
+    у которого больше кредитов. Ключ с 401/402 выбывает из пула.
+    """
+    def __init__(self, keys: List[dict]):
+        self.keys = [ApiKey(k['key'], k['rate'], k['burst']) for k in keys]
+        self.lock = asyncio.Lock()
+    
+    @property
+    def total_rate(self) -> float:
+        return sum(k.bucket.rate for k in self.keys if not k.retired)
+    
+    async def acquire(self) -> Optional[ApiKey]:
+        """Ждёт токен на любом активном ключе; None - активных ключей нет"""
+        async with self.lock:
+            while True:
+                active = [k for k in self.keys if not k.retired]
+                if not active:
+                    return None
+                waits = [(k.bucket.wait_time(), k) for k in active]
+                ready = [k for wait, k in waits if wait <= 0]
+                if ready:
+                    key = max(ready, key=lambda k: k.credits if k.credits >= 0 else float('inf'))
+                    key.bucket.take()
+                    key.requests += 1
+                    return key
+                await asyncio.sleep(min(wait for wait, _ in waits))
+    
+    def update_credits(self, key: ApiKey, credits: int):
+        # Ответы приходят не по порядку - берём минимальный остаток
+        if credits >= 0:
+            key.credits = credits if key.credits < 0 else min(key.credits, credits)
+    
+    def retire(self, key: ApiKey, status: str):
+        if not key.retired:
+            key.retired = status
+            if status == 'error_credits':
+                key.credits = 0
+    
+    def exhausted_status(self) -> str:
+        """Почему кончились ключи: error_credits, если хоть один исчерпан"""
+        statuses = {k.retired for k in self.keys}
+        return 'error_credits' if 'error_credits' in statuses else 'error_key'
+    
+    def credits(self) -> int:
+        """Суммарный известный остаток кредитов (-1 - неизвестно)"""
+        known = [k.credits for k in self.keys if k.credits >= 0 and k.retired != 'error_key']
+        return sum(known) if known else -1
+    
+    def retired_keys(self) -> List[Tuple[str, str]]:
+        return [(mask_key(k.key), k.retired) for k in self.keys if k.retired]
+
+class FairScheduler:
+    """Общие для всех пользователей слоты запросов к MailApi.
+    
+    В полете не больше slots запросов процесса (по умолчанию - сколько
+    соединений пул держит к одному хосту). Пока слоты свободны, запрос
+    проходит сразу; когда их не хватает, ожидающие пользователи
+    обслуживаются по кругу с дефицитом (deficit round robin): за круг
+    пользователь получает quantum * вес, запрос стоит столько адресов,
+    сколько в нем проверяется. Так большой файл не вытесняет чужую
+    маленькую задачу. Срочные запросы (одиночная проверка в чате)
+    идут вне очереди.
+    """
+    def __init__(self, slots: int = SCHED_SLOTS, quantum: int = SCHED_QUANTUM):
+        self.slots = max(1, slots)
+        self.quantum = quantum
+        self.busy = 0
+        self.urgent: deque = deque()             # future
+        self.waiting: Dict[int, deque] = {}      # user_id -> (future, стоимость)
+        self.users: deque = deque()              # пользователи с ожидающими, по кругу
+        self.deficit: Dict[int, float] = {}
+        self.weights: Dict[int, float] = {}
+    
+    def share(self, user_id: int, weight: float = 1.0,
+              urgent: bool = False) -> Callable[[int], 'AsyncContextManager']:
+        """slot(стоимость) для запросов пользователя - передается в движок"""
+        return lambda cost=1: self.slot(user_id, weight, cost, urgent)
+    
+    @asynccontextmanager
+    async def slot(self, user_id: int, weight: float = 1.0, cost: int = 1, urgent: bool = False):
+        start = time.perf_counter()
+        await self._acquire(user_id, weight, cost, urgent)
+        metrics.sched_wait.observe(time.perf_counter() - start, 'urgent' if urgent else 'fair')
+        try:
+            yield
+        finally:
+            self.busy -= 1
+            self._dispatch()
+    
+    async def _acquire(self, user_id: int, weight: float, cost: int, urgent: bool):
+        if self.busy < self.slots and not self.urgent and not self.users:
+            self.busy += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        if urgent:
+            self.urgent.append(future)
+        else:
+            if user_id not in self.waiting:
+                self.waiting[user_id] = deque()
+                self.users.append(user_id)
+                self.deficit[user_id] = 0.0
+            self.waiting[user_id].append((future, cost))
+            self.weights[user_id] = max(weight, 0.01)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.busy -= 1  # Слот уже выдан, но его не дождались
+                self._dispatch()
+            raise
+    
+    def _dispatch(self):
+        """Раздает свободные слоты: сначала срочным, затем по кругу"""
+        while self.busy < self.slots:
+            if self.urgent:
+                future = self.urgent.popleft()
+            elif self.users:
+                user_id = self.users[0]
+                queue = self.waiting[user_id]
+                future, cost = queue[0]
+                if not future.cancelled() and self.deficit[user_id] < cost:
+                    self.deficit[user_id] += self.quantum * self.weights[user_id]
+                    self.users.rotate(-1)
+                    continue
+                queue.popleft()
+                if not future.cancelled():
+                    self.deficit[user_id] -= cost
+                if not queue:
+                    # Без очереди дефицит не копится
+                    del self.waiting[user_id], self.deficit[user_id], self.weights[user_id]
+                    self.users.popleft()
+            else:
+                return
+            if not future.cancelled():
+                self.busy += 1
+                future.set_result(None)
+
+scheduler = FairScheduler()
+
+class QuotaLease:
+    """Дневная квота пользователя для одного движка.
+    
+    Проверки резервируются в UserConfig блоками по QUOTA_BLOCK, чтобы не
+    писать в базу на каждый адрес; неизрасходованный остаток возвращается
+    в close(). take() == False - квота на сегодня кончилась.
+    """
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.left = 0
+        self.exhausted = False
+        self.lock = asyncio.Lock()
+    
+    async def take(self) -> bool:
+        while self.left <= 0:
+            if self.exhausted:
+                return False
+            async with self.lock:
+                if self.left <= 0 and not self.exhausted:
+                    granted = await asyncio.to_thread(
+                        user_config.reserve_quota, self.user_id, QUOTA_BLOCK)
+                    self.left += granted
+                    self.exhausted = granted < QUOTA_BLOCK
+        self.left -= 1
+        return True
+    
+    def give_back(self):
+        """Зарезервированная проверка не понадобилась"""
+        self.left += 1
+    
+    async def close(self):
+        left, self.left = self.left, 0
+        self.exhausted = True
+        await asyncio.to_thread(user_config.release_quota, self.user_id, left)
+
+class SingleVerifier:
+    """Проверка по одному адресу (GET на MAILAPI_URL) - основной способ.
+    
+    Каждый запрос берет токен у ключа из пула; при 401/402 ключ выбывает,
+    а адрес проверяется следующим ключом. Возвращает статус адреса или
+    None, если ключи кончились или движок остановлен.
+    """
+    def __init__(self, engine: 'VerificationEngine'):
+        self.engine = engine
+    
+    async def verify(self, email: str) -> Optional[str]:
+        engine = self.engine
+        while True:
+            key = await engine.pool.acquire()
+            if key is None:
+                engine.stop(engine.pool.exhausted_status())
+            if engine.stop_status:
+                return None
+            
+            _, status, credits = await mailapi_verify_single(
+                engine.session, email, key.key,
+                budget=engine.budget, on_throttle=key.bucket.pause, slot=engine.slot,
+                acquire=key.bucket.acquire
+            )
+            engine.pool.update_credits(key, credits)
+            if status not in ('error_key', 'error_credits'):
+                return status
+            engine.pool.retire(key, status)
+    
+    async def close(self):
+        pass
+
+class BulkVerifier(SingleVerifier):
+    """Пакетная проверка через MAILAPI_BULK_URL.
+    
+    Адреса от воркеров движка копятся в очереди и уходят пачкой, когда она
+    полная (размер подбирает BatchSizer) или через BULK_LINGER после первого
+    адреса. В полете до BULK_PARALLEL пачек, каждая берет один токен ключа.
+    При сбое пачка после паузы retry_delay возвращается в очередь: у адреса
+    до MAILAPI_RETRIES повторов, из бюджета повторов пачка тратит один. Адреса, которых нет
+    в ответе, и все адреса после ответа "эндпоинта нет" проверяются по одному.
+    """
+    def __init__(self, engine: 'VerificationEngine'):
+        super().__init__(engine)
+        self.sizer = BatchSizer()
+        self.pending: deque = deque()  # (email, future, попыток)
+        self.ready = asyncio.Event()
+        self.senders: List[asyncio.Task] = []
+        self.fallbacks: Set[asyncio.Task] = set()
+        self.supported = True
+    
+    async def verify(self, email: str) -> Optional[str]:
+        if not self.supported:
+            return await super().verify(email)
+        if not self.senders:
+            self.senders = [asyncio.create_task(self._sender()) for _ in range(BULK_PARALLEL)]
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((email, future, 0))
+        self.ready.set()
+        return await future
+    
+    async def _sender(self):
+        while True:
+            await self.ready.wait()
+            if len(self.pending) < self.sizer.size:
+                await asyncio.sleep(BULK_LINGER)
+            batch = [self.pending.popleft() for _ in range(min(self.sizer.size, len(self.pending)))]
+            if not self.pending:
+                self.ready.clear()
+            if batch:
+                await self._send(batch)
+    
+    @staticmethod
+    def _resolve(items: Iterable[tuple], status: Optional[str]):
+        for _, future, _ in items:
+            if not future.done():
+                future.set_result(status)
+    
+    def _requeue(self, items: List[tuple], delay: float = 0.0):
+        if delay <= 0:
+            self.pending.extendleft(reversed(items))
+            self.ready.set()
+            return
+        # Пауза перед повтором не задерживает остальные пачки
+        async def later():
+            await asyncio.sleep(delay)
+            self._requeue(items)
+        task = asyncio.create_task(later())
+        self.fallbacks.add(task)
+        task.add_done_callback(self.fallbacks.discard)
+    
+    def _fallback(self, items: List[tuple]):
+        async def single(email: str, future: asyncio.Future):
+            status = await SingleVerifier.verify(self, email)
+            if not future.done():
+                future.set_result(status)
+        for email, future, _ in items:
+            task = asyncio.create_task(single(email, future))
+            self.fallbacks.add(task)
+            task.add_done_callback(self.fallbacks.discard)
+    
+    async def _send(self, batch: List[tuple]):
+        engine = self.engine
+        key = await engine.pool.acquire()
+        if key is None:
+            engine.stop(engine.pool.exhausted_status())
+        if engine.stop_status:
+            self._resolve(batch, None)
+            self._resolve(self.pending, None)
+            self.pending.clear()
+            return
+        
+        engine.budget.requests += 1
+        await mailapi_breaker.wait()
+        async with engine.slot(len(batch)) if engine.slot else nullcontext():
+            start = time.perf_counter()
+            status, verdicts, credits, retry_after = await mailapi_bulk_request(
+                engine.session, [email for email, _, _ in batch], key.key
+            )
+        elapsed = time.perf_counter() - start
+        metrics.mailapi_latency.observe(elapsed, f"bulk_{status}")
+        metrics.mailapi_batch.observe(len(batch))
+        engine.pool.update_credits(key, credits)
+        
+        if status == 'ok':
+            mailapi_breaker.record_success()
+            self.sizer.on_success(len(batch), elapsed)
+            for email, future, _ in batch:
+                if email in verdicts and not future.done():
+                    future.set_result(verdicts[email])
+            self._fallback([item for item in batch if item[0] not in verdicts])
+        elif status in ('error_key', 'error_credits'):
+            engine.pool.retire(key, status)
+            self._requeue(batch)
+        elif status == 'unsupported':
+            print("MailApi: пакетная проверка недоступна - проверяю по одному адресу")
+            self.supported = False
+            rest = list(self.pending)
+            self.pending.clear()
+            self._fallback(batch + rest)
+        elif status == 'too_large':
+            self.sizer.on_failure()
+            self._requeue(batch)
+        elif status == 'retry':
+            mailapi_breaker.record_failure()
+            if retry_after:
+                key.bucket.pause(retry_after)
+            self.sizer.on_failure()
+            if engine.budget.spend():
+                metrics.mailapi_retries.inc()
+                self._resolve([item for item in batch if item[2] >= MAILAPI_RETRIES], 'unknown')
+                self._requeue([(email, future, tries + 1) for email, future, tries in batch
+                               if tries < MAILAPI_RETRIES],
+                              retry_delay(max(item[2] for item in batch), retry_after))
+            else:
+                self._resolve(batch, 'unknown')
+        else:
+            self._resolve(batch, status)
+    
+    async def close(self):
+        tasks = self.senders + list(self.fallbacks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.senders = []
+        self._resolve(self.pending, None)
+        self.pending.clear()
+
+class VerificationEngine:
+    """Параллельная проверка emails через пул ключей с лимитами скорости.
+    
+    Адреса из кэша сразу идут в результат, остальные через ограниченную
+    очередь попадают к concurrency воркерам. Результат сохраняет порядок
+    валидных emails как в источнике; когда ключи кончились - останавливается
+    (error_key, или error_credits с частичным результатом).
+    """
+    def __init__(self, session, pool: KeyPool,
+                 concurrency: int = VERIFY_CONCURRENCY,
+                 cache: Optional[ResultCache] = None,
+                 keep_results: bool = False,
+                 known: Optional[Callable[[List[str]], Set[str]]] = None,
+                 mx: Optional[MxResolver] = None,
+                 slot: Optional[Callable[[int], AsyncContextManager]] = None,
+                 quota: Optional[QuotaLease] = None):
+        self.session = session
+        self.pool = pool
+        self.slot = slot     # slot(стоимость) - слот FairScheduler.share на запрос к MailApi
+        self.quota = quota   # Дневная квота: кончилась - остановка 'quota' с частичным результатом
+        self.concurrency = max(1, concurrency)
+        self.verifier = BulkVerifier(self) if MAILAPI_BULK_URL else SingleVerifier(self)
+        if MAILAPI_BULK_URL:
+            # Воркеров столько, чтобы пачки успевали наполняться
+            self.concurrency = max(self.concurrency, BULK_MAX_SIZE * BULK_PARALLEL)
+        self.cache = cache
+        self.queued = 0      # поставлено в очередь к MailApi (промахи кэша)
+        self.checked = 0     # получено ответов MailApi
+        self.cache_hits = 0
+        self.skipped = 0     # пропущено по истории
+        self.no_mx = 0       # все домены кандидатов без MX
+        # known(порция emails) -> адреса, которые проверять не нужно (режим сравнения)
+        self.known = known
+        self.mx = mx
+        self.valid: Dict[int, str] = {}
+        self.unknown: Dict[int, str] = {}  # повторы кончились - не кэшируются
+        # С keep_results: idx -> (email, статус, 'cache'/'api'), забирает вызывающий
+        self.keep_results = keep_results
+        self.results: Dict[int, Tuple[str, str, str]] = {}
+        self.budget = RetryBudget()  # Общий на повторы mailapi_verify_single
+        self.queue: Optional[asyncio.Queue] = None
+        self.read_seconds = 0.0  # время чтения источника (разбор файла)
+        self.cursor = 0      # сколько первых адресов источника обработано полностью
+        self.stop_status = ''
+        self._done: Set[int] = set()
+    
+    def stop(self, status: str = 'cancelled'):
+        """Останавливает проверку: новые запросы не отправляются"""
+        if not self.stop_status:
+            self.stop_status = status
+    
+    @staticmethod
+    def _resolve(group: Tuple[str, ...], verdicts: Dict[str, str]) -> Tuple[str, str]:
+        """Итог по кандидатам: первый валидный, иначе первый без ответа
+        (его стоит перепроверить), иначе вердикт основного кандидата"""
+        for status in ('valid', 'unknown'):
+            for email in group:
+                if verdicts.get(email) == status:
+                    return email, status
+        return group[0], verdicts[group[0]]
+    
+    def _mark_done(self, idx: int):
+        self._done.add(idx)
+        while self.cursor in self._done:
+            self._done.remove(self.cursor)
+            self.cursor += 1
+    
+    async def run(
+        self,
+        emails: Iterable[str],
+        on_progress: Optional[Callable[[int, int, int], Awaitable[None]]] = None,
+        skip: int = 0
+    ) -> Tuple[List[str], int, str]:
+        """Возвращает (валидные emails, остаток кредитов, статус остановки или '').
+        
+        Источник читается порциями в отдельном потоке (может быть генератором,
+        который еще разбирает файл). Элемент - адрес или кортеж кандидатов
+        одного никнейма по приоритету: они проверяются до первого валидного,
+        кандидаты с доменом без MX отсеиваются без запроса. Первые skip
+        адресов пропускаются - так прерванная проверка продолжается с cursor.
+        """
+        valid = self.valid
+        done = 0
+        source = iter(emails)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.queue = queue
+        feeder_error: Optional[Exception] = None
+        self.cursor = skip
+        
+        def next_chunk() -> List[Tuple[str, ...]]:
+            start = time.perf_counter()
+            chunk = [(item,) if isinstance(item, str) else item
+                     for item in islice(source, VERIFY_CHUNK)]
+            self.read_seconds += time.perf_counter() - start
+            return chunk
+        
+        def lookup(emails: List[str]) -> Tuple[Set[str], Dict[str, str]]:
+            """Уже проверенные раньше (история) и найденные в кэше"""
+            known = self.known(emails) if self.known else set()
+            rest = [email for email in emails if email not in known] if known else emails
+            cached = self.cache.get_many(rest) if self.cache and rest else {}
+            return known, cached
+        
+        async def feeder():
+            nonlocal feeder_error
+            idx = 0
+            try:
+                while not self.stop_status:
+                    chunk = await asyncio.to_thread(next_chunk)
+                    if not chunk:
+                        break
+                    if idx + len(chunk) <= skip:
+                        idx += len(chunk)
+                        continue
+                    if idx < skip:
+                        chunk = chunk[skip - idx:]
+                        idx = skip
+                    has_mx = {}
+                    if self.mx is not None:
+                        has_mx = await self.mx.check_many(
+                            email.rpartition('@')[2] for group in chunk for email in group)
+                    groups = [tuple(email for email in group
+                                    if has_mx.get(email.rpartition('@')[2], True))
+                              for group in chunk]
+                    emails = [email for group in groups for email in group]
+                    known, cached = await asyncio.to_thread(lookup, emails)
+                    if self.cache:
+                        metrics.cache.inc('hit', amount=len(cached))
+                        metrics.cache.inc('miss', amount=len(emails) - len(known) - len(cached))
+                    for original, group in zip(chunk, groups):
+                        if not group:
+                            self.no_mx += 1
+                            if self.keep_results:
+                                self.results[idx] = (original[0], 'no_mx', 'local')
+                            self._mark_done(idx)
+                        elif known and any(email in known for email in group):
+                            self.skipped += 1
+                            self._mark_done(idx)
+                        else:
+                            verdicts = {email: cached[email] for email in group if email in cached}
+                            # Кэша хватает, если у всех кандидатов до первого валидного есть ответ
+                            for email in group:
+                                if email not in verdicts or verdicts[email] == 'valid':
+                                    break
+                            if email in verdicts:
+                                self.cache_hits += 1
+                                email, status = self._resolve(group, verdicts)
+                                if status == 'valid':
+                                    valid[idx] = email
+                                if self.keep_results:
+                                    self.results[idx] = (email, status, 'cache')
+                                self._mark_done(idx)
+                            else:
+                                self.queued += 1
+                                await queue.put((idx, group, verdicts))
+                        idx += 1
+            except Exception as e:
+                # Источник сломался - будим воркеров, не дожидаясь места в очереди
+                feeder_error = e
+                while not queue.empty():
+                    queue.get_nowait()
+                for _ in range(self.concurrency):
+                    queue.put_nowait(None)
+                return
+            for _ in range(self.concurrency):
+                await queue.put(None)
+        
+        async def verify(email: str) -> Optional[str]:
+            """Запрос к MailApi; None - проверка остановлена"""
+            if self.quota is not None and not await self.quota.take():
+                self.stop('quota')
+                return None
+            status = await self.verifier.verify(email)
+            if status is None:
+                if self.quota is not None:
+                    self.quota.give_back()
+                return None
+            
+            self.checked += 1
+            metrics.verifications.inc(status)
+            metrics.verify_rate.tick()
+            if self.cache:
+                self.cache.put(email, status)
+                if len(self.cache.pending) >= CACHE_FLUSH_SIZE:
+                    await asyncio.to_thread(self.cache.flush)
+            return status
+        
+        async def worker():
+            nonlocal done
+            while True:
+                item = await queue.get()
+                if item is None or self.stop_status:
+                    return
+                idx, group, verdicts = item
+                
+                # Кандидаты по приоритету до первого валидного
+                for email in group:
+                    if email in verdicts:
+                        if verdicts[email] == 'valid':
+                            break
+                        continue
+                    status = await verify(email)
+                    if status is None:
+                        return
+                    verdicts[email] = status
+                    if status == 'valid':
+                        break
+                
+                result_email, status = self._resolve(group, verdicts)
+                if status == 'valid':
+                    valid[idx] = result_email
+                elif status == 'unknown':
+                    self.unknown[idx] = result_email
+                if self.keep_results:
+                    self.results[idx] = (result_email, status, 'api')
+                self._mark_done(idx)
+                
+                done += 1
+                if on_progress:
+                    await on_progress(done, len(valid), self.pool.credits())
+        
+        feeder_task = asyncio.create_task(feeder())
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        await self.verifier.close()
+        if self.quota is not None:
+            await self.quota.close()
+        # После остановки feeder может ждать места в очереди
+        feeder_task.cancel()
+        try:
+            await feeder_task
+        except asyncio.CancelledError:
+            pass
+        if self.cache:
+            await asyncio.to_thread(self.cache.flush)
+        if feeder_error is not None:
+            raise feeder_error
+        
+        valid_emails = [valid[idx] for idx in sorted(valid)]
+        return valid_emails, self.pool.credits(), self.stop_status
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ОБРАБОТКА EMAILS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def unique_candidates(nicknames: Iterable[Union[str, Tuple[str, ...]]], stats: dict,
+                      domains: Iterable[str] = EXPAND_DOMAINS) -> Iterator[Tuple[str, ...]]:
+    """Фильтр, расширение и дедупликация никнеймов на лету.
+    
+    Для каждого никнейма - кортеж адресов-кандидатов (expand_candidates),
+    генерируется лениво по мере чтения, так что очередь не раздувается.
+    Элемент nicknames может быть и готовым кортежем (iter_job_nicknames).
+    Невозможные имена отсеиваются без запроса к API, варианты одного
+    ящика склеиваются по каноничным адресам. Считает найденные, отсеянные
+    и уникальные.
+    """
+    expand = candidate_expander(tuple(domains), EXPAND_PATTERNS, EXPAND_MAX_CANDIDATES)
+    seen: Set[Tuple[str, ...]] = set()
+    for nick in nicknames:
+        stats['found'] += 1
+        # Из процесса разбора приходят уже готовые кандидаты
+        group = nick if isinstance(nick, tuple) else expand(nick)
+        if not group:
+            stats['rejected'] += 1
+        elif group not in seen:
+            seen.add(group)
+            stats['unique'] += 1
+            yield group
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} сек"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} сек"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+class ProgressReporter:
+    """Обновляет сообщение о прогрессе отдельной задачей.
+    
+    Проверка только сообщает новые числа (update), а сообщение правится
+    не чаще раза в interval секунд на чат - даже если в чате идут несколько
+    проверок. Одинаковый текст не отправляется, на RetryAfter чат ждет
+    столько, сколько попросил Telegram. Скорость считается по реальным
+    ответам за последние PROGRESS_RATE_WINDOW секунд.
+    """
+    next_edit: Dict[int, float] = {}  # chat_id -> когда можно править снова
+    
+    def __init__(self, message, chat_id: int, render: Callable[['ProgressReporter'], str],
+                 interval: float = PROGRESS_INTERVAL):
+        self.message = message
+        self.chat_id = chat_id
+        self.render = render
+        self.interval = interval
+        self.done = 0
+        self.total = 0
+        self.samples: deque = deque([(time.monotonic(), 0)])
+        self.text = message.text if hasattr(message, 'text') else ''
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+    
+    def update(self, done: int, total: int):
+        """Новые числа прогресса - дешево, без запросов к Telegram"""
+        self.done, self.total = done, total
+        now = time.monotonic()
+        if now - self.samples[-1][0] >= 1:
+            self.samples.append((now, done))
+            while len(self.samples) > 2 and now - self.samples[0][0] > PROGRESS_RATE_WINDOW:
+                self.samples.popleft()
+        self.changed.set()
+    
+    @property
+    def rate(self) -> float:
+        """Проверок в секунду за последнее окно"""
+        start_time, start_done = self.samples[0]
+        elapsed = time.monotonic() - start_time
+        return (self.done - start_done) / elapsed if elapsed >= 1 else 0.0
+    
+    def eta_text(self) -> str:
+        rate = self.rate
+        if rate <= 0 or self.total <= self.done:
+            return "?"
+        return format_eta((self.total - self.done) / rate)
+    
+    async def _edit(self):
+        text = self.render(self)
+        if text == self.text:
+            return
+        try:
+            await self.message.edit_text(text)
+            self.text = text
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            self.next_edit[self.chat_id] = time.monotonic() + delay
+        except TelegramError:
+            pass  # Сообщение удалено и т.п. - прогресс не критичен
+    
+    async def _run(self):
+        while True:
+            await self.changed.wait()
+            delay = self.next_edit.get(self.chat_id, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.changed.clear()
+            self.next_edit[self.chat_id] = max(
+                self.next_edit.get(self.chat_id, 0), time.monotonic() + self.interval
+            )
+            await self._edit()
+    
+    async def stop(self):
+        """Останавливает задачу и показывает последние числа, если их еще
+        не показали (итоговое сообщение пишет вызывающий)"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            if self.changed.is_set():
+                self.changed.clear()
+                await self._edit()
+
+async def check_emails_batch(
+    engine: VerificationEngine,
+    nicknames: Iterable[str],
+    chat_id: int,
+    bot,
+    skip: int = 0,
+    on_checkpoint: Optional[Callable[[VerificationEngine, int, dict], Awaitable[None]]] = None,
+    domains: Iterable[str] = EXPAND_DOMAINS
+) -> Tuple[List[str], int, dict]:
+    """Массовая проверка emails - параллельно, с лимитом запросов/сек движка.
+    
+    nicknames может быть генератором: проверка начинается до окончания
+    разбора файла. Каждый никнейм проверяется по доменам domains до первого
+    валидного адреса. Адреса из кэша в MailApi не отправляются. Первые skip
+    адресов пропускаются, on_checkpoint вызывается каждые
+    JOB_CHECKPOINT_INTERVAL секунд и в конце. Возвращает
+    (валидные emails, остаток кредитов, статистика).
+    """
+    stats = {'found': 0, 'rejected': 0, 'unique': 0, 'cache_hits': 0,
+             'cache_misses': 0, 'unknown': 0, 'skipped': 0, 'no_mx': 0, 'stop_status': '',
+             'retired_keys': []}
+    last_credits = -1
+    
+    # Начальное сообщение
+    status_msg = await bot.send_message(
+        chat_id,
+        f"⏳ {'Продолжаю' if skip else 'Начинаю'} проверку...\n\n"
+        f"🔑 Ключей: {len(engine.pool.keys)}\n"
+        f"⚙️ Лимит: {engine.pool.total_rate} запросов/сек"
+    )
+    
+    def render(reporter: ProgressReporter) -> str:
+        pause_text = "\n\n⏸ MailApi перегружен - пауза" if mailapi_breaker.is_open else ""
+        skipped_text = f"⏭ Уже проверены раньше: {engine.skipped}\n" if engine.skipped else ""
+        return (
+            f"⏳ Проверка: {reporter.done}/{reporter.total}\n\n"
+            f"📊 Найдено: {stats['found']} seller\n"
+            f"🗄 Из кэша: {engine.cache_hits}\n"
+            f"{skipped_text}"
+            f"✅ Валидных: {len(engine.valid)}\n"
+            f"❓ Без ответа: {len(engine.unknown)}\n"
+            f"💳 Кредитов: {last_credits if last_credits >= 0 else '?'}\n"
+            f"🚀 Скорость: {reporter.rate:.1f} email/сек, осталось ≈ {reporter.eta_text()}"
+            f"{pause_text}"
+        )
+    
+    reporter = ProgressReporter(status_msg, chat_id, render)
+    reporter.start()
+    
+    async def on_progress(done: int, valid_count: int, credits: int):
+        nonlocal last_credits
+        last_credits = credits
+        # Очередь знает только прочитанное, поэтому итог берем по найденным уникальным
+        reporter.update(done, max(engine.queued,
+                                  stats['unique'] - skip - engine.cache_hits - engine.skipped
+                                  - engine.no_mx))
+    
+    async def checkpoints():
+        while True:
+            await asyncio.sleep(JOB_CHECKPOINT_INTERVAL)
+            await on_checkpoint(engine, last_credits, stats)
+    
+    checkpoint_task = asyncio.create_task(checkpoints()) if on_checkpoint else None
+    try:
+        valid_emails, last_credits, stop_status = await engine.run(
+            unique_candidates(nicknames, stats, domains), on_progress, skip
+        )
+    finally:
+        if checkpoint_task:
+            checkpoint_task.cancel()
+        await reporter.stop()
+    stats['cache_hits'] = engine.cache_hits
+    stats['cache_misses'] = engine.queued
+    stats['unknown'] = len(engine.unknown)
+    stats['skipped'] = engine.skipped
+    stats['no_mx'] = engine.no_mx
+    stats['stop_status'] = stop_status
+    stats['retired_keys'] = engine.pool.retired_keys()
+    if not skip:  # При продолжении файл читается заново - не считаем дважды
+        metrics.saved.inc('filter', amount=stats['rejected'])
+        metrics.saved.inc('duplicate', amount=stats['found'] - stats['unique'] - stats['rejected'])
+    metrics.saved.inc('cache', amount=engine.cache_hits)
+    metrics.saved.inc('history', amount=engine.skipped)
+    metrics.saved.inc('mx', amount=engine.no_mx)
+    if on_checkpoint:
+        await on_checkpoint(engine, last_credits, stats)
+    
+    # Проверяем ошибки API и остановку
+    if stop_status == 'error_key':
+        await status_msg.edit_text("❌ Неверный API ключ!")
+        return [], -1, stats
+    elif stop_status == 'error_credits':
+        await status_msg.edit_text("❌ Кончились кредиты на всех ключах!")
+    elif stop_status == 'quota':
+        await status_msg.edit_text("⛔ Дневной лимит проверок исчерпан - отправляю что успел")
+    elif stop_status == 'cancelled':
+        await status_msg.edit_text("🚫 Проверка отменена")
+    elif stop_status == 'shutdown':
+        try:
+            await status_msg.edit_text("⏸ Бот перезапускается - продолжу проверку после запуска")
+        except Exception as e:
+            # Курсор уже сохранен - задача продолжится и без этого сообщения
+            print(f"ОШИБКА УВЕДОМЛЕНИЯ О ПЕРЕЗАПУСКЕ: {e}")
+    
+    return valid_emails, last_credits, stats
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЭКСПОРТ РЕЗУЛЬТАТОВ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+EXPORT_FIELDS = ('email', 'status', 'source')
+
+class ResultExporter:
+    """Пишет вердикты в сжатый CSV/JSONL построчно, сразу на диск.
+    
+    Когда сжатая часть дорастает до part_size, начинается следующая -
+    каждая часть самостоятельный файл (со своим заголовком CSV) и влезает
+    в лимит Telegram. Блокирующий - вызывать через asyncio.to_thread.
+    """
+    def __init__(self, base_path: str, export_format: str = 'csv', compression: str = 'gz',
+                 part_size: int = EXPORT_PART_SIZE):
+        self.base_path = base_path
+        self.format = export_format
+        self.compression = compression
+        self.part_size = part_size
+        self.paths: List[str] = []
+        self.raw = None
+        self.archive = None
+        self.text = None
+        self.writer = None
+    
+    def _open_part(self):
+        path = f"{self.base_path}_part{len(self.paths) + 1}.{self.format}.{self.compression}"
+        self.paths.append(path)
+        self.raw = open(path, 'wb')
+        if self.compression == 'zip':
+            self.archive = zipfile.ZipFile(self.raw, 'w', zipfile.ZIP_DEFLATED)
+            binary = self.archive.open(f"{os.path.basename(self.base_path)}.{self.format}",
+                                       'w', force_zip64=True)
+        else:
+            binary = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.text = TextIOWrapper(binary, encoding='utf-8', newline='')
+        if self.format == 'csv':
+            self.writer = csv.writer(self.text)
+            self.writer.writerow(EXPORT_FIELDS)
+    
+    def _close_part(self):
+        self.text.close()
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+        self.raw.close()
+        self.raw = None
+    
+    def write(self, email: str, status: str, source: str):
+        # Размер считаем по уже сжатым байтам - буферы дают запас в пару МБ
+        if self.raw is None or self.raw.tell() >= self.part_size:
+            if self.raw is not None:
+                self._close_part()
+            self._open_part()
+        if self.format == 'csv':
+            self.writer.writerow((email, status, source))
+        else:
+            self.text.write(json.dumps({'email': email, 'status': status, 'source': source}) + '\n')
+    
+    def close(self) -> List[str]:
+        """Закрывает файлы и возвращает пути частей"""
+        if self.raw is not None:
+            self._close_part()
+        if len(self.paths) == 1:
+            # Одна часть - без суффикса _part1
+            path = f"{self.base_path}.{self.format}.{self.compression}"
+            os.replace(self.paths[0], path)
+            self.paths = [path]
+        return self.paths
+
+def export_results(store, job_id: int, base_path: str,
+                   export_format: str = 'csv', compression: str = 'gz') -> List[str]:
+    """Выгружает все вердикты задачи, возвращает пути файлов (пусто, если нечего)"""
+    exporter = ResultExporter(base_path, export_format, compression)
+    try:
+        for email, status, source in store.iter_results(job_id):
+            exporter.write(email, status, source)
+    except Exception:
+        exporter.close()
+        for path in exporter.paths:
+            JobManager._remove_file(path)
+        raise
+    return exporter.close()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ИСТОРИЯ ПРОВЕРОК
+# ═══════════════════════════════════════════════════════════════════════════════
+
+HISTORY_STATUSES = ('valid', 'invalid', 'disposable')  # окончательные вердикты
+
+def history_path(user_id: int) -> str:
+    return os.path.join(HISTORY_DIR, f"{user_id}.hashes")
+
+class SeenHistory:
+    """Адреса, которые пользователь уже проверял.
+    
+    Хранится как отсортированный массив 64-битных хэшей (blake2b) в файле:
+    8 байт на адрес, 10M адресов - 80 МБ на диске, а в память через mmap
+    подтягиваются только нужные страницы. Проверка - бинарный поиск,
+    случайное совпадение хэшей при таком размере практически исключено.
+    Методы блокирующие - вызывать через asyncio.to_thread.
+    """
+    def __init__(self, path: str):
+        self.path = path
+    
+    @staticmethod
+    def hash(email: str) -> int:
+        return int.from_bytes(hashlib.blake2b(email.encode(), digest_size=8).digest(), 'little')
+    
+    def __len__(self) -> int:
+        try:
+            return os.path.getsize(self.path) // 8
+        except OSError:
+            return 0
+    
+    def contains_many(self, emails: List[str]) -> Set[str]:
+        """Какие из emails уже есть в истории"""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return set()
+        with f:
+            if os.fstat(f.fileno()).st_size < 8:
+                return set()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hashes = memoryview(mapped).cast('Q')
+                try:
+                    size = len(hashes)
+                    found = set()
+                    for email in emails:
+                        value = self.hash(email)
+                        pos = bisect.bisect_left(hashes, value)
+                        if pos < size and hashes[pos] == value:
+                            found.add(email)
+                    return found
+                finally:
+                    hashes.release()
+    
+    @staticmethod
+    def iter_file(path: str) -> Iterator[int]:
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                block = array('Q')
+                block.frombytes(f.read(8 * 65536))
+                if not block:
+                    return
+                yield from block
+    
+    def merge(self, emails: Iterable[str], run_size: int = 1_000_000) -> int:
+        """Добавляет адреса в историю, возвращает новый размер.
+        
+        Новые хэши сортируются порциями по run_size во временные файлы
+        (память ограничена размером порции), затем все порции и старая
+        история сливаются потоком в файл, который атомарно заменяет историю.
+        Слияние идет под файловой блокировкой - историю одного пользователя
+        могут дополнять несколько процессов.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        runs: List[str] = []
+        source = iter(emails)
+        try:
+            while True:
+                run = sorted(self.hash(email) for email in islice(source, run_size))
+                if not run:
+                    break
+                runs.append(f"{self.path}.{os.getpid()}.run{len(runs)}")
+                with open(runs[-1], 'wb') as out:
+                    array('Q', run).tofile(out)
+            if not runs:
+                return len(self)
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                return self._write_merged([self.path] + runs)
+        finally:
+            for run_path in runs:
+                try:
+                    os.remove(run_path)
+                except OSError:
+                    pass
+    
+    def _write_merged(self, paths: List[str]) -> int:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        count = 0
+        last = None
+        block = array('Q')
+        with open(tmp_path, 'wb') as out:
+            for value in heapq.merge(*(self.iter_file(path) for path in paths)):
+                if value == last:
+                    continue
+                last = value
+                block.append(value)
+                if len(block) >= 65536:
+                    block.tofile(out)
+                    count += len(block)
+                    block = array('Q')
+            block.tofile(out)
+            count += len(block)
+        os.replace(tmp_path, self.path)
+        return count
+    
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def iter_verdict_file(path: str) -> Iterator[str]:
+    """Адреса с окончательным вердиктом из прежней выгрузки.
+    
+    Понимает выгрузки бота (CSV / JSONL, в том числе .gz / .zip) и простой
+    список адресов (valid_emails.txt). Адреса приводятся к каноничному виду.
+    """
+    name = path.lower()
+    with ExitStack() as stack:
+        if name.endswith('.gz'):
+            stream = stack.enter_context(gzip.open(path, 'rt', encoding='utf-8', errors='ignore'))
+        elif name.endswith('.zip'):
+            archive = stack.enter_context(zipfile.ZipFile(path))
+            stream = stack.enter_context(TextIOWrapper(
+                archive.open(archive.namelist()[0]), encoding='utf-8', errors='ignore'))
+        else:
+            stream = stack.enter_context(open(path, 'r', encoding='utf-8', errors='ignore'))
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            status = 'valid'
+            if line.startswith('{'):
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                email, status = row.get('email', ''), row.get('status', 'valid')
+            elif ',' in line:
+                email, status = (line.split(',') + ['valid'])[:2]
+            else:
+                email = line
+            if status not in HISTORY_STATUSES:
+                continue  # Заголовок CSV, unknown, error
+            email = normalize_address(email)
+            if email:
+                yield email
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ФОНОВЫЕ ЗАДАЧИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+JOB_STATUS_TEXT = {
+    'pending': '⏳ в очереди',
+    'running': '🔄 выполняется',
+    'done': '✅ готово',
+    'stopped': '⚠️ остановлена',
+    'cancelled': '🚫 отменена',
+    'failed': '❌ ошибка',
+}
+
+class JobStore:
+    """Хранилище задач проверки в SQLite: состояние, курсор и найденные валидные.
+    
+    Все методы блокирующие - вызывать через asyncio.to_thread.
+    """
+    def __init__(self, path: str = JOBS_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=SQLITE_TIMEOUT)
+            self.db.row_factory = sqlite3.Row
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                "chat_id INTEGER NOT NULL, file_path TEXT NOT NULL, file_type TEXT NOT NULL, "
+                "selector TEXT NOT NULL, status TEXT NOT NULL, cursor INTEGER NOT NULL DEFAULT 0, "
+                "credits INTEGER NOT NULL DEFAULT -1, found INTEGER NOT NULL DEFAULT 0, "
+                "cache_hits INTEGER NOT NULL DEFAULT 0, cache_misses INTEGER NOT NULL DEFAULT 0, "
+                "skipped INTEGER NOT NULL DEFAULT 0, error TEXT NOT NULL DEFAULT '', created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, id);"
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, user_id);"
+                "CREATE TABLE IF NOT EXISTS job_results ("
+                "job_id INTEGER NOT NULL, idx INTEGER NOT NULL, email TEXT NOT NULL, "
+                "status TEXT NOT NULL, source TEXT NOT NULL, PRIMARY KEY (job_id, idx));"
+            )
+            self._migrate()
+        return self.db
+    
+    # Колонки, добавленные после первой версии таблицы jobs
+    COLUMNS = {
+        'skipped': "INTEGER NOT NULL DEFAULT 0",
+        'worker': "INTEGER NOT NULL DEFAULT -1",         # процесс, выполняющий задачу
+        'started_at': "REAL NOT NULL DEFAULT 0",
+        'cancel_requested': "INTEGER NOT NULL DEFAULT 0",
+        'domains': "TEXT NOT NULL DEFAULT ''",           # домены кандидатов через запятую
+        'size': "INTEGER NOT NULL DEFAULT -1",           # байт в файле, -1 - неизвестно
+    }
+    
+    def _migrate(self):
+        """Добавляет новые колонки и переносит результаты из job_valid / job_unknown"""
+        tables = {row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        with self.db:
+            for column, ddl in self.COLUMNS.items():
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+            for table, status in (('job_valid', 'valid'), ('job_unknown', 'unknown')):
+                if table in tables:
+                    self.db.execute(
+                        f"INSERT OR IGNORE INTO job_results (job_id, idx, email, status, source) "
+                        f"SELECT job_id, idx, email, '{status}', 'api' FROM {table}"
+                    )
+                    self.db.execute(f"DROP TABLE {table}")
+    
+    def create(self, user_id: int, chat_id: int, file_path: str,
+               file_type: str, selector: str, domains: Iterable[str] = EXPAND_DOMAINS,
+               size: int = -1) -> int:
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            cur = db.execute(
+                "INSERT INTO jobs (user_id, chat_id, file_path, file_type, selector, domains, "
+                "size, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?)",
+                (user_id, chat_id, file_path, file_type, selector, ','.join(domains), size, now, now)
+            )
+            db.commit()
+            return cur.lastrowid
+    
+    def get(self, job_id: int) -> Optional[dict]:
+        with self.lock:
+            row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def list_user(self, user_id: int, limit: int = 10) -> List[dict]:
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT * FROM jobs WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def unfinished(self) -> List[dict]:
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT * FROM jobs WHERE status IN ('pending', 'running') ORDER BY id"
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def set_status(self, job_id: int, status: str, error: str = ''):
+        with self.lock:
+            db = self._connect()
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id)
+            )
+            db.commit()
+    
+    def claim(self, worker: int, user_limit: Callable[[int], int],
+              max_size: Optional[int] = None) -> Optional[dict]:
+        """Забирает следующую задачу из общей очереди для процесса worker.
+        
+        Пользователи чередуются: первым идет тот, чья задача запускалась
+        давнее всех, и у пользователя не больше user_limit(user_id) выполняемых
+        задач. С max_size - только задачи с файлом не больше max_size байт.
+        BEGIN IMMEDIATE не дает двум процессам забрать одну задачу.
+        """
+        with self.lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT j.id, j.user_id, (SELECT COUNT(*) FROM jobs r WHERE "
+                    "r.user_id = j.user_id AND r.status = 'running') AS running "
+                    "FROM jobs j WHERE j.status = 'pending' AND j.size BETWEEN ? AND ? ORDER BY ("
+                    "SELECT MAX(started_at) FROM jobs s WHERE s.user_id = j.user_id), j.id",
+                    (0 if max_size is not None else -1,
+                     max_size if max_size is not None else 2 ** 62)
+                ).fetchall()
+                row = next((r for r in rows if r['running'] < user_limit(r['user_id'])), None)
+                if row:
+                    now = time.time()
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, "
+                        "cancel_requested = 0, updated_at = ? WHERE id = ?",
+                        (worker, now, now, row['id'])
+                    )
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return self.get(row['id']) if row else None
+    
+    def requeue(self, worker: Optional[int] = None) -> int:
+        """Возвращает в очередь выполняемые задачи процесса (без worker - все)"""
+        with self.lock:
+            db = self._connect()
+            if worker is None:
+                cur = db.execute(
+                    "UPDATE jobs SET status = 'pending', worker = -1 WHERE status = 'running'")
+            else:
+                cur = db.execute(
+                    "UPDATE jobs SET status = 'pending', worker = -1 "
+                    "WHERE status = 'running' AND worker = ?", (worker,))
+            db.commit()
+            return cur.rowcount
+    
+    def cancel_pending(self, job_id: int) -> bool:
+        """Отменяет задачу, если ее еще не забрал воркер"""
+        with self.lock:
+            db = self._connect()
+            cur = db.execute(
+                "UPDATE jobs SET status = 'cancelled', updated_at = ? "
+                "WHERE id = ? AND status = 'pending'", (time.time(), job_id))
+            db.commit()
+            return cur.rowcount > 0
+    
+    def request_cancel(self, job_id: int) -> bool:
+        """Просит процесс-воркер остановить выполняемую задачу"""
+        with self.lock:
+            db = self._connect()
+            cur = db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'",
+                (job_id,))
+            db.commit()
+            return cur.rowcount > 0
+    
+    def cancel_requested(self, job_id: int) -> bool:
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+    
+    def count_active(self, before: Optional[int] = None) -> Tuple[int, int]:
+        """Задач в очереди и выполняемых (с before - только созданных раньше)"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE status IN ('pending', 'running') "
+                "AND id < ? GROUP BY status", (before if before is not None else 2 ** 62,)
+            ).fetchall()
+        counts = dict(rows)
+        return counts.get('pending', 0), counts.get('running', 0)
+    
+    def start(self, job_id: int, cursor: int):
+        """Помечает задачу выполняемой и убирает результаты после курсора"""
+        with self.lock:
+            db = self._connect()
+            db.execute("DELETE FROM job_results WHERE job_id = ? AND idx >= ?", (job_id, cursor))
+            db.execute(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+            db.commit()
+    
+    def checkpoint(self, job_id: int, cursor: int, credits: int, stats: dict,
+                   rows: List[Tuple[int, str, str, str]]):
+        """Сохраняет прогресс и результаты: rows - (idx, email, статус, источник)"""
+        with self.lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR IGNORE INTO job_results (job_id, idx, email, status, source) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(job_id,) + row for row in rows]
+            )
+            db.execute(
+                "UPDATE jobs SET cursor = ?, credits = ?, found = ?, cache_hits = ?, "
+                "cache_misses = ?, skipped = ?, updated_at = ? WHERE id = ?",
+                (cursor, credits, stats['found'], stats['cache_hits'],
+                 stats['cache_misses'], stats['skipped'], time.time(), job_id)
+            )
+            db.commit()
+    
+    def emails(self, job_id: int, status: str) -> List[str]:
+        """Адреса задачи с заданным статусом в порядке файла"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT email FROM job_results WHERE job_id = ? AND status = ? ORDER BY idx",
+                (job_id, status)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def iter_results(self, job_id: int, page: int = 5000) -> Iterator[Tuple[str, str, str]]:
+        """Все результаты задачи (email, статус, источник) страницами.
+        
+        Блокировка берется на страницу, а не на всю выгрузку.
+        """
+        last = -1
+        while True:
+            with self.lock:
+                rows = self._connect().execute(
+                    "SELECT idx, email, status, source FROM job_results "
+                    "WHERE job_id = ? AND idx > ? ORDER BY idx LIMIT ?",
+                    (job_id, last, page)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1], row[2], row[3]
+            last = rows[-1][0]
+
+class JobManager:
+    """Очередь фоновых проверок с пулом воркеров.
+    
+    Задачи берутся по кругу между пользователями (у одного пользователя
+    выполняется не больше задач, чем его лимит jobs), прогресс периодически
+    сохраняется в JobStore. При остановке бота выполняемые задачи
+    сохраняют курсор и продолжаются после следующего запуска.
+    
+    Кроме workers общих воркеров есть fast_workers быстрой полосы: они
+    берут только маленькие задачи (файл до FAST_LANE_SIZE байт), поэтому
+    короткий список не ждет, пока освободится воркер с большим файлом.
+    Запросы всех задач к MailApi делит между пользователями scheduler,
+    проверки списываются с дневной квоты пользователя.
+    
+    В режиме shared очередь не в памяти, а в jobs.db: задачи забирают
+    процессы-воркеры (см. JobProcesses), отмена выполняемой задачи
+    передается флагом в базе и проверяется на каждой контрольной точке.
+    """
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS,
+                 fast_workers: int = FAST_LANE_WORKERS):
+        self.store = store
+        self.workers = max(1, workers)
+        self.fast_workers = max(0, fast_workers)
+        self.bot = None
+        self.pending: Dict[int, deque] = {}   # user_id -> id задач
+        self.sizes: Dict[int, int] = {}       # id задачи в очереди -> размер файла
+        self.users: deque = deque()           # очередь пользователей по кругу
+        self.active: Dict[int, int] = {}      # user_id -> выполняемых задач
+        self.engines: Dict[int, VerificationEngine] = {}
+        self.cond: Optional[asyncio.Condition] = None
+        self.tasks: List[asyncio.Task] = []
+        self.stopping = False
+        self.shared = False
+        self.worker_id = -1
+    
+    async def start(self, bot):
+        self.bot = bot
+        self.cond = asyncio.Condition()
+        self.stopping = False
+        # Незавершенные задачи продолжаются с сохраненного курсора
+        # (в режиме shared их возвращает в очередь основной процесс)
+        if not self.shared:
+            for job in await asyncio.to_thread(self.store.unfinished):
+                self._enqueue(job['user_id'], job['id'], job['size'])
+        self.tasks = [asyncio.create_task(self._worker(fast))
+                      for fast in [False] * self.workers + [True] * self.fast_workers]
+    
+    async def stop(self):
+        self.stopping = True
+        for engine in self.engines.values():
+            engine.stop('shutdown')
+        if self.cond:
+            async with self.cond:
+                self.cond.notify_all()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    
+    def _enqueue(self, user_id: int, job_id: int, size: int = -1):
+        if user_id not in self.pending:
+            self.pending[user_id] = deque()
+            self.users.append(user_id)
+        self.pending[user_id].append(job_id)
+        self.sizes[job_id] = size
+    
+    @staticmethod
+    def is_small(size: int) -> bool:
+        return 0 <= size <= FAST_LANE_SIZE
+    
+    @staticmethod
+    def _user_limit(user_id: int) -> int:
+        if user_config.shared:
+            user_config.reload(user_id)  # Вызывается из claim в потоке
+        return user_config.get_limits(user_id)['jobs']
+    
+    async def submit(self, user_id: int, job_id: int, size: int = -1) -> int:
+        """Ставит задачу в очередь, возвращает число задач впереди"""
+        if self.shared:
+            return sum(await asyncio.to_thread(self.store.count_active, job_id))
+        ahead = sum(len(q) for q in self.pending.values()) + len(self.engines)
+        async with self.cond:
+            self._enqueue(user_id, job_id, size)
+            self.cond.notify_all()
+        return ahead
+    
+    async def cancel(self, job_id: int) -> bool:
+        """Отменяет задачу в очереди или выполняемую"""
+        if job_id in self.engines:
+            self.engines[job_id].stop('cancelled')
+            return True
+        for user_id, queue in self.pending.items():
+            if job_id in queue:
+                queue.remove(job_id)
+                self.sizes.pop(job_id, None)
+                if not queue:
+                    del self.pending[user_id]
+                    self.users.remove(user_id)
+                job = await asyncio.to_thread(self.store.get, job_id)
+                await asyncio.to_thread(self.store.set_status, job_id, 'cancelled')
+                self._remove_file(job['file_path'])
+                return True
+        if self.shared:
+            if await asyncio.to_thread(self.store.cancel_pending, job_id):
+                job = await asyncio.to_thread(self.store.get, job_id)
+                self._remove_file(job['file_path'])
+                return True
+            return await asyncio.to_thread(self.store.request_cancel, job_id)
+        return False
+    
+    async def counts(self) -> Tuple[int, int]:
+        """Задач в очереди и выполняемых"""
+        if self.shared:
+            return await asyncio.to_thread(self.store.count_active)
+        return sum(len(q) for q in self.pending.values()), len(self.engines)
+    
+    async def _claim_job(self, fast: bool) -> Optional[Tuple[int, int]]:
+        """Следующая задача из общей очереди в jobs.db (режим shared)"""
+        while not self.stopping:
+            job = await asyncio.to_thread(self.store.claim, self.worker_id, self._user_limit,
+                                          FAST_LANE_SIZE if fast else None)
+            if job and self.stopping:
+                await asyncio.to_thread(self.store.set_status, job['id'], 'pending')
+                break
+            if job:
+                self.active[job['user_id']] = self.active.get(job['user_id'], 0) + 1
+                return job['user_id'], job['id']
+            async with self.cond:
+                try:
+                    await asyncio.wait_for(self.cond.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        return None
+    
+    async def _next_job(self, fast: bool = False) -> Optional[Tuple[int, int]]:
+        """Следующая задача по кругу пользователей; fast - только маленькие"""
+        if self.shared:
+            return await self._claim_job(fast)
+        async with self.cond:
+            while not self.stopping:
+                for _ in range(len(self.users)):
+                    user_id = self.users[0]
+                    self.users.rotate(-1)
+                    if self.active.get(user_id, 0) >= self._user_limit(user_id):
+                        continue
+                    queue = self.pending[user_id]
+                    if fast:
+                        job_id = next((j for j in queue if self.is_small(self.sizes[j])), None)
+                        if job_id is None:
+                            continue
+                        queue.remove(job_id)
+                    else:
+                        job_id = queue.popleft()
+                    del self.sizes[job_id]
+                    if not queue:
+                        del self.pending[user_id]
+                        self.users.remove(user_id)
+                    self.active[user_id] = self.active.get(user_id, 0) + 1
+                    return user_id, job_id
+                await self.cond.wait()
+        return None
+    
+    async def _worker(self, fast: bool = False):
+        while True:
+            item = await self._next_job(fast)
+            if item is None:
+                return
+            user_id, job_id = item
+            try:
+                await self._run_job(job_id)
+            except Exception as e:
+                print(f"ОШИБКА ЗАДАЧИ #{job_id}: {e}")
+                engine = self.engines.get(job_id)
+                if engine is not None and engine.stop_status == 'shutdown':
+                    continue  # Статус остается 'running' - продолжим после перезапуска
+                await asyncio.to_thread(self.store.set_status, job_id, 'failed', str(e)[:200])
+            finally:
+                self.engines.pop(job_id, None)
+                async with self.cond:
+                    self.active[user_id] -= 1
+                    self.cond.notify_all()
+    
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)  # Документы одной media group
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+    
+    async def _run_job(self, job_id: int):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        user_id, chat_id = job['user_id'], job['chat_id']
+        if self.shared:
+            # Ключи и настройки меняет основной процесс
+            await asyncio.to_thread(user_config.reload, user_id)
+        keys = user_config.get_api_keys(user_id)
+        if not keys:
+            await asyncio.to_thread(self.store.set_status, job_id, 'failed', 'no api key')
+            await self.bot.send_message(chat_id, f"❌ Задача #{job_id}: API ключ не настроен!")
+            return
+        
+        # Режим сравнения: адреса из истории пользователя не проверяем
+        history = None
+        if user_config.get_user_config(user_id).get('diff_mode'):
+            history = SeenHistory(history_path(user_id))
+        
+        # Воркеров пропорционально числу ключей - иначе упремся в задержку, а не в лимит
+        limits = user_config.get_limits(user_id)
+        engine = VerificationEngine(
+            http_client.get_session(), KeyPool(keys),
+            concurrency=VERIFY_CONCURRENCY * len(keys), cache=result_cache,
+            keep_results=True, known=history.contains_many if history is not None else None,
+            mx=mx_resolver, slot=scheduler.share(user_id, limits['weight']),
+            quota=QuotaLease(user_id)
+        )
+        self.engines[job_id] = engine
+        await asyncio.to_thread(self.store.start, job_id, job['cursor'])
+        
+        persisted = job['cursor']
+        
+        async def on_checkpoint(engine: VerificationEngine, credits: int, stats: dict):
+            nonlocal persisted
+            if self.shared and await asyncio.to_thread(self.store.cancel_requested, job_id):
+                engine.stop('cancelled')
+            cursor = engine.cursor
+            # Сохраненные результаты больше не держим в памяти
+            rows = [(idx,) + engine.results.pop(idx) for idx in range(persisted, cursor)
+                    if idx in engine.results]
+            await asyncio.to_thread(
+                self.store.checkpoint, job_id, cursor, credits,
+                {'found': stats['found'],
+                 'cache_hits': job['cache_hits'] + engine.cache_hits,
+                 'cache_misses': job['cache_misses'] + engine.queued,
+                 'skipped': job['skipped'] + engine.skipped},
+                rows
+            )
+            persisted = cursor
+        
+        started = time.perf_counter()
+        # Домены запоминаются при постановке - продолжение идет по тем же кандидатам
+        domains = job['domains'].split(',') if job['domains'] else EXPAND_DOMAINS
+        parse_errors: List[str] = []
+        with closing(iter_job_nicknames(job['file_path'], job['file_type'],
+                                        job['selector'], domains, parse_errors)) as nicknames:
+            _, credits, stats = await check_emails_batch(
+                engine, nicknames, chat_id, self.bot, job['cursor'], on_checkpoint, domains
+            )
+        stats['parse_errors'] = parse_errors
+        
+        stop_status = stats['stop_status']
+        metrics.parse_seconds.observe(engine.read_seconds, job['file_type'])
+        metrics.job_seconds.observe(time.perf_counter() - started, stop_status or 'done')
+        if stop_status == 'shutdown':
+            return  # Статус остается 'running' - продолжим после перезапуска
+        if stop_status == 'cancelled':
+            await asyncio.to_thread(self.store.set_status, job_id, 'cancelled')
+            self._remove_file(job['file_path'])
+            return
+        if stop_status == 'error_key':
+            await asyncio.to_thread(self.store.set_status, job_id, 'failed', 'error_key')
+            self._remove_file(job['file_path'])
+            return
+        
+        # Частичный результат на error_credits тоже сохраняем целиком
+        await asyncio.to_thread(
+            self.store.checkpoint, job_id, engine.cursor, credits,
+            {'found': stats['found'],
+             'cache_hits': job['cache_hits'] + engine.cache_hits,
+             'cache_misses': job['cache_misses'] + engine.queued,
+             'skipped': job['skipped'] + engine.skipped},
+            [(idx,) + row for idx, row in sorted(engine.results.items())]
+        )
+        valid_emails = await asyncio.to_thread(self.store.emails, job_id, 'valid')
+        unknown_emails = await asyncio.to_thread(self.store.emails, job_id, 'unknown')
+        export_format, compression = user_config.get_export(user_id)
+        export_paths = await asyncio.to_thread(
+            export_results, self.store, job_id,
+            os.path.join(JOBS_DIR, f"results_{job_id}"), export_format, compression
+        )
+        await asyncio.to_thread(
+            self.store.set_status, job_id, 'stopped' if stop_status else 'done',
+            stop_status or '; '.join(parse_errors)
+        )
+        self._remove_file(job['file_path'])
+        
+        stats['cache_hits'] += job['cache_hits']
+        stats['cache_misses'] += job['cache_misses']
+        stats['skipped'] += job['skipped']
+        if history is not None:
+            added = await asyncio.to_thread(history.merge, (
+                email for email, status, _ in self.store.iter_results(job_id)
+                if status in HISTORY_STATUSES
+            ))
+            stats['history_size'] = added
+        try:
+            await send_results(self.bot, chat_id, job_id, valid_emails, credits, stats,
+                               unknown_emails, export_paths)
+        finally:
+            for path in export_paths:
+                self._remove_file(path)
+
+async def send_results(bot, chat_id: int, job_id: int, valid_emails: List[str],
+                       credits: int, stats: dict, unknown_emails: Optional[List[str]] = None,
+                       export_paths: Iterable[str] = ()):
+    """Отправляет итог проверки, файл с валидными emails, файл с непроверенными
+    и полную выгрузку вердиктов.
+    
+    unknown_emails - адреса, на которых кончились повторы: файл можно
+    отправить боту еще раз как TXT.
+    """
+    unknown_emails = unknown_emails or []
+    saved = stats['found'] - stats['unique']
+    cache_text = (
+        f"🧹 Отсеяно фильтром: {stats['rejected']}, "
+        f"дублей: {saved - stats['rejected']} (сэкономлено запросов: {saved})\n"
+        f"🗄 Кэш: {stats['cache_hits']} попаданий, {stats['cache_misses']} промахов\n"
+    )
+    for masked, reason in stats.get('retired_keys', []):
+        cache_text += (
+            f"🔑 Ключ {masked} отключен: "
+            f"{'нет кредитов' if reason == 'error_credits' else 'неверный ключ'}\n"
+        )
+    if stats.get('skipped'):
+        cache_text += f"⏭ Пропущено (уже проверены раньше): {stats['skipped']}\n"
+    if stats.get('no_mx'):
+        cache_text += f"📭 Домены без MX: {stats['no_mx']}\n"
+    if 'history_size' in stats:
+        cache_text += f"📚 В истории: {stats['history_size']} адресов\n"
+    if unknown_emails:
+        cache_text += f"❓ Не проверено (повторы исчерпаны): {len(unknown_emails)}\n"
+    for error in stats.get('parse_errors', []):
+        cache_text += f"⚠️ Файл поврежден, проверено только до ошибки - {html.escape(error)}\n"
+    
+    if not valid_emails:
+        await bot.send_message(
+            chat_id,
+            f"😔 <b>Задача #{job_id}: валидные email не найдены</b>\n\n"
+            f"Проверено: {stats['found']} seller\n"
+            f"{cache_text}"
+            f"💳 Осталось кредитов: {credits if credits >= 0 else '?'}",
+            parse_mode='HTML'
+        )
+        await send_unknown(bot, chat_id, unknown_emails)
+        await send_export(bot, chat_id, export_paths)
+        return
+    
+    # Формируем результат
+    result_text = (
+        f"✅ <b>Задача #{job_id}: проверка завершена!</b>\n\n"
+        f"📊 Всего seller: {stats['found']}\n"
+        f"✅ Валидных: {len(valid_emails)}\n"
+        f"❌ Невалидных: {stats['found'] - len(valid_emails) - len(unknown_emails) - stats.get('skipped', 0) - stats.get('no_mx', 0)}\n"
+        f"{cache_text}"
+    )
+    if credits >= 0:
+        result_text += f"\n💳 Осталось кредитов: {credits}"
+    
+    await bot.send_message(chat_id, result_text, parse_mode='HTML')
+    
+    # Отправляем файл с результатами
+    valid_content = '\n'.join(valid_emails)
+    await bot.send_document(
+        chat_id,
+        document=BytesIO(valid_content.encode()),
+        filename='valid_emails.txt',
+        caption=f'✅ {len(valid_emails)} валидных адресов'
+    )
+    await send_unknown(bot, chat_id, unknown_emails)
+    await send_export(bot, chat_id, export_paths)
+
+async def send_export(bot, chat_id: int, export_paths: Iterable[str]):
+    """Файлы полной выгрузки (по частям, если не влезли в лимит Telegram)"""
+    export_paths = list(export_paths)
+    for part, path in enumerate(export_paths, 1):
+        caption = '📦 Все результаты'
+        if len(export_paths) > 1:
+            caption += f' (часть {part}/{len(export_paths)})'
+        with open(path, 'rb') as f:
+            await bot.send_document(chat_id, document=f, filename=os.path.basename(path),
+                                    caption=caption)
 
-def parse_txt_content(content: str) -> List[str]:
-    """Парсинг TXT контента"""
-    return [line.strip() for line in content.split('\n') if line.strip()]
+async def send_unknown(bot, chat_id: int, unknown_emails: List[str]):
+    """Файл с адресами, которые MailApi так и не проверил"""
+    if not unknown_emails:
+        return
+    await bot.send_document(
+        chat_id,
+        document=BytesIO('\n'.join(unknown_emails).encode()),
+        filename='unknown_emails.txt',
+        caption=f'❓ {len(unknown_emails)} адресов без ответа MailApi - отправьте файл позже еще раз'
+    )
 
-# ═══════════════════════════════════════════════════════════════════════════════
-#                              ОБРАБОТКА EMAILS
-# ═══════════════════════════════════════════════════════════════════════════════
+job_manager = JobManager(JobStore())
 
-async def check_emails_batch(
-    nicknames: List[str],
-    api_key: str,
-    chat_id: int,
-    context: ContextTypes.DEFAULT_TYPE
-) -> Tuple[List[str], int]:
-    """Массовая проверка emails - упрощенная версия"""
+class JobProcesses:
+    """Процессы-воркеры задач (режим JOB_PROCESSES > 0).
     
-    # Дедупликация
-    seen: Set[str] = set()
-    unique = []
-    for nick in nicknames:
-        nl = nick.lower()
-        if nl not in seen:
-            seen.add(nl)
-            unique.append(nick)
+    Каждый процесс со своим event loop и пулом соединений забирает задачи
+    из общей jobs.db; кэш результатов и конфиги - общие базы SQLite в WAL.
+    Завершившийся процесс перезапускается, а его задачи возвращаются
+    в очередь и продолжаются с сохраненного курсора.
+    """
+    def __init__(self, store: JobStore, count: int):
+        self.store = store
+        self.count = count
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.monitor: Optional[asyncio.Task] = None
+        self.stopping = False
     
-    emails = [f"{n}@gmail.com" for n in unique]
-    valid_emails = []
-    last_credits = -1
+    async def start(self):
+        self.stopping = False
+        # Живых воркеров еще нет - все выполнявшиеся задачи снова в очередь
+        await asyncio.to_thread(self.store.requeue)
+        for worker_id in range(self.count):
+            self._spawn(worker_id)
+        self.monitor = asyncio.create_task(self._monitor())
     
-    # Начальное сообщение
-    status_msg = await context.bot.send_message(
-        chat_id,
-        f"⏳ Начинаю проверку...\n\n"
-        f"📊 Найдено: {len(nicknames)} seller\n"
-        f"🔄 Уникальных: {len(unique)}\n"
-        f"⏱ Примерное время: ~{len(emails)} сек"
-    )
+    def _spawn(self, worker_id: int):
+        process = self.context.Process(
+            target=run_job_worker, args=(worker_id,), name=f"job-worker-{worker_id}")
+        process.start()
+        self.processes[worker_id] = process
     
-    connector = aiohttp.TCPConnector(ssl=False, force_close=True)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        for idx, email in enumerate(emails, 1):
-            result_email, status, credits = await mailapi_verify_single(session, email, api_key)
-            
-            if credits >= 0:
-                last_credits = credits
-            
-            # Проверяем ошибки API
-            if status == 'error_key':
-                await status_msg.edit_text("❌ Неверный API ключ!")
-                return [], -1
-            elif status == 'error_credits':
-                await status_msg.edit_text("❌ Кончились кредиты!")
-                return valid_emails, last_credits
-            
-            # Сохраняем только валидные
-            if status == 'valid':
-                valid_emails.append(result_email)
-            
-            # Обновление статуса каждые 10 проверок
-            if idx % 10 == 0 or idx == len(emails):
-                try:
-                    await status_msg.edit_text(
-                        f"⏳ Проверка: {idx}/{len(emails)}\n\n"
-                        f"✅ Валидных: {len(valid_emails)}\n"
-                        f"💳 Кредитов: {last_credits if last_credits >= 0 else '?'}"
-                    )
-                except:
-                    pass
-            
-            # Rate limit: 1 запрос/сек
-            await asyncio.sleep(1.0)
+    async def _monitor(self):
+        while not self.stopping:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            for worker_id, process in list(self.processes.items()):
+                if process.is_alive() or self.stopping:
+                    continue
+                print(f"ВОРКЕР {worker_id} ЗАВЕРШИЛСЯ (код {process.exitcode}), перезапуск")
+                await asyncio.to_thread(self.store.requeue, worker_id)
+                self._spawn(worker_id)
     
-    return valid_emails, last_credits
+    async def stop(self):
+        """Просит воркеры сохранить курсоры и завершиться (SIGTERM)"""
+        self.stopping = True
+        if self.monitor:
+            self.monitor.cancel()
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            await asyncio.to_thread(process.join, 60)
+            if process.is_alive():
+                process.kill()
+        self.processes = {}
+
+job_processes = JobProcesses(job_manager.store, JOB_PROCESSES)
+
+metrics.gauge('jobs_pending', 'Задач в очереди',
+              lambda: sum(len(q) for q in job_manager.pending.values()))
+metrics.gauge('jobs_running', 'Выполняемых задач', lambda: len(job_manager.engines))
+metrics.gauge('verify_queue_depth', 'Адресов в очередях к MailApi',
+              lambda: sum(e.queue.qsize() for e in job_manager.engines.values() if e.queue))
+metrics.gauge('verifications_per_second', 'Проверок в секунду за последнюю минуту',
+              metrics.verify_rate.rate)
+metrics.gauge('mailapi_breaker_open', 'Пауза запросов к MailApi (1 - идет)',
+              lambda: float(mailapi_breaker.is_open))
+metrics.gauge('mailapi_breaker_trips', 'Сколько раз включалась пауза', lambda: mailapi_breaker.trips)
+metrics.gauge('http_connection_reuse_ratio', 'Доля переиспользованных соединений',
+              lambda: http_client.stats()['reuse_ratio'])
+metrics.gauge('startup_ready_seconds', 'Запуск процесса до приема апдейтов',
+              lambda: startup.stages['ready'])
+metrics.gauge('startup_first_update_seconds', 'Запуск процесса до первого апдейта',
+              lambda: startup.stages['first_update'])
 
 # ═══════════════════════════════════════════════════════════════════════════════
 #                              КОМАНДЫ БОТА
@@ -334,28 +3712,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_SINGLE_EMAIL
     
     elif query.data == "help":
-        help_text = (
-            "📖 <b>Как использовать бота</b>\n\n"
-            "<b>1. Настройка API:</b>\n"
-            "• Получите ключ на app.mailapi.dev\n"
-            "• 5000 бесплатных проверок!\n"
-            "• Используйте /setapi ключ\n\n"
-            "<b>2. Проверка файлов:</b>\n"
-            "• Просто отправьте JSON или TXT файл\n"
-            "• JSON: формат Depop (поле 'seller')\n"
-            "• TXT: список никнеймов (по строкам)\n\n"
-            "<b>3. Результат:</b>\n"
-            "• Получите TXT с валидными Gmail\n"
-            "• Готово к использованию!\n\n"
-            "<b>Команды:</b>\n"
-            "/start - Главное меню\n"
-            "/setapi - Установить API ключ\n"
-            "/help - Эта справка"
-        )
         
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
         await query.edit_message_text(
-            help_text,
+            HELP_TEXT,
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='HTML'
         )
@@ -429,6 +3789,105 @@ async def setapi_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='HTML'
         )
 
+async def setrate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /setrate - лимит запросов/сек для ключа пользователя"""
+    user_id = update.effective_user.id
+    
+    if not context.args:
+        rate, burst = user_config.get_rate_limit(user_id)
+        await update.message.reply_text(
+            f"⚙️ Текущий лимит: {rate} запросов/сек, всплеск {burst}\n\n"
+            "Использование:\n<code>/setrate запросов_в_сек [всплеск]</code>",
+            parse_mode='HTML'
+        )
+        return
+    
+    try:
+        rate = float(context.args[0])
+        burst = int(context.args[1]) if len(context.args) > 1 else max(1, int(rate))
+        if rate <= 0 or burst < 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Неверное значение лимита")
+        return
+    
+    user_config.set_rate_limit(user_id, rate, burst)
+    await update.message.reply_text(
+        f"✅ Лимит сохранен: {rate} запросов/сек, всплеск {burst}"
+    )
+
+async def keys_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /keys - пул ключей пользователя"""
+    keys = user_config.get_api_keys(update.effective_user.id)
+    if not keys:
+        await update.message.reply_text("❌ Ключей нет. Добавьте: /addkey ключ")
+        return
+    
+    lines = ["🔑 <b>Пул ключей</b>\n"]
+    for num, k in enumerate(keys, 1):
+        line = f"{num}. <code>{mask_key(k['key'])}</code> - {k['rate']} запросов/сек"
+        if num == 1:
+            line += " (основной)"
+        lines.append(line)
+    lines.append(f"\n⚙️ Всего: {sum(k['rate'] for k in keys)} запросов/сек")
+    await update.message.reply_text('\n'.join(lines), parse_mode='HTML')
+
+async def addkey_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /addkey ключ [запросов_в_сек] [всплеск]"""
+    if not context.args:
+        await update.message.reply_text(
+            "Использование:\n<code>/addkey ключ [запросов_в_сек] [всплеск]</code>",
+            parse_mode='HTML'
+        )
+        return
+    
+    api_key = context.args[0].strip()
+    try:
+        rate = float(context.args[1]) if len(context.args) > 1 else DEFAULT_RATE_LIMIT
+        burst = int(context.args[2]) if len(context.args) > 2 else max(1, int(rate))
+        if rate <= 0 or burst < 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Неверное значение лимита")
+        return
+    
+    msg = await update.message.reply_text("⏳ Проверяю ключ...")
+    ok, message, credits = await mailapi_test_connection(api_key)
+    if not ok:
+        await msg.edit_text(f"❌ <b>Ошибка</b>\n\n{message}", parse_mode='HTML')
+        return
+    
+    user_id = update.effective_user.id
+    user_config.add_api_key(user_id, api_key, rate, burst)
+    await msg.edit_text(
+        f"✅ <b>Ключ добавлен в пул</b>\n\n"
+        f"💳 Доступно: {credits} кредитов\n"
+        f"🔑 Ключей в пуле: {len(user_config.get_api_keys(user_id))}",
+        parse_mode='HTML'
+    )
+
+async def removekey_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /removekey номер_или_ключ"""
+    user_id = update.effective_user.id
+    keys = user_config.get_api_keys(user_id)
+    if not context.args:
+        await update.message.reply_text(
+            "Использование:\n<code>/removekey номер</code> (номер из /keys)",
+            parse_mode='HTML'
+        )
+        return
+    
+    arg = context.args[0].strip()
+    if arg.isdigit() and 1 <= int(arg) <= len(keys):
+        key = keys[int(arg) - 1]['key']
+    else:
+        key = arg
+    
+    if user_config.remove_api_key(user_id, key):
+        await update.message.reply_text(f"🗑 Ключ {mask_key(key)} удален")
+    else:
+        await update.message.reply_text("❌ Ключ не найден")
+
 async def handle_api_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка API ключа"""
     api_key = update.message.text.strip()
@@ -471,81 +3930,738 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     document = update.message.document
     file_name = document.file_name.lower()
     
-    # Скачиваем файл
-    try:
-        file = await context.bot.get_file(document.file_id)
-        file_bytes = await file.download_as_bytearray()
-        content = file_bytes.decode('utf-8', errors='ignore')
-    except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка загрузки файла: {str(e)}")
+    if (update.message.caption or '').strip().lower().startswith('/diff'):
+        await import_history(update, context, document)
         return
     
-    # Парсим файл
-    nicknames = []
-    if file_name.endswith('.json'):
-        nicknames = parse_json_content(content, config.get('selector', 'seller'))
-        file_type = "JSON"
-    elif file_name.endswith('.txt'):
-        nicknames = parse_txt_content(content)
-        file_type = "TXT"
-    else:
+    file_type = file_kind(file_name)
+    if file_type is None:
         await update.message.reply_text(
             "❌ Неподдерживаемый формат!\n\n"
-            "Используйте:\n• .json (Depop формат)\n• .txt (список никнеймов)"
+            "Используйте:\n• .json (Depop формат)\n• .txt (список никнеймов)\n"
+            "• архив .zip, .gz или .tar.gz с такими файлами"
         )
         return
     
-    if not nicknames:
+    quota = user_config.get_limits(user_id)['quota']
+    if quota > 0 and await asyncio.to_thread(user_config.quota_used, user_id) >= quota:
         await update.message.reply_text(
+            f"⛔ Дневной лимит проверок исчерпан ({quota})\n\n"
+            f"Лимит обновится в 00:00 UTC • /limits"
+        )
+        return
+    
+    # Несколько документов в одном сообщении - одна задача на всю группу
+    group_id = update.message.media_group_id
+    if group_id:
+        group = media_groups.join(group_id)
+        file_path = os.path.join(
+            group['path'], f"{update.message.message_id:012d}{file_suffix(file_name)}")
+    else:
+        # Скачиваем файл в каталог задач - он нужен до конца проверки
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        file_path = os.path.join(JOBS_DIR, f"{uuid.uuid4().hex}{file_suffix(file_name)}")
+    try:
+        start = time.perf_counter()
+        file = await context.bot.get_file(document.file_id)
+        await file.download_to_drive(file_path)
+        metrics.download_seconds.observe(time.perf_counter() - start, file_type)
+    except Exception as e:
+        JobManager._remove_file(file_path)
+        await update.message.reply_text(f"❌ Ошибка загрузки файла: {str(e)}")
+        if not group_id:
+            return
+    
+    chat_id = update.effective_chat.id
+    if group_id:
+        async def on_complete(group: dict):
+            await queue_job(context.bot, user_id, chat_id, group['path'], 'GROUP',
+                            partial(context.bot.send_message, chat_id))
+        media_groups.done(group_id, on_complete)
+        return
+    await queue_job(context.bot, user_id, chat_id, file_path, file_type,
+                    update.message.reply_text)
+
+async def queue_job(bot, user_id: int, chat_id: int, file_path: str, file_type: str,
+                    reply: Callable[..., Awaitable]):
+    """Проверяет, что в источнике есть никнеймы, и ставит задачу в очередь"""
+    selector = user_config.get_user_config(user_id).get('selector', 'seller')
+    if not await asyncio.to_thread(has_nicknames, file_path, file_type, selector):
+        JobManager._remove_file(file_path)
+        await reply(
             f"❌ Не удалось извлечь данные из {file_type} файла!\n\n"
             f"Проверьте формат файла"
         )
         return
     
-    # Проверяем emails
-    valid_emails, credits = await check_emails_batch(
-        nicknames, api_key, update.effective_chat.id, context
+    # Ставим проверку в очередь
+    size = await asyncio.to_thread(source_size, file_path, file_type)
+    job_id = await asyncio.to_thread(
+        job_manager.store.create, user_id, chat_id,
+        file_path, file_type, selector, user_config.get_domains(user_id), size
+    )
+    ahead = await job_manager.submit(user_id, job_id, size)
+    await reply(
+        f"📥 <b>Задача #{job_id} в очереди</b>\n\n"
+        f"Впереди задач: {ahead}\n"
+        f"Статус: /jobs • Отмена: <code>/cancel {job_id}</code>",
+        parse_mode='HTML'
     )
+
+class MediaGroups:
+    """Документы, отправленные одним сообщением (media group).
     
-    if not valid_emails:
+    Telegram присылает их отдельными апдейтами с общим media_group_id.
+    Файлы скачиваются в общий каталог, а задача на всю группу ставится,
+    когда MEDIA_GROUP_WAIT секунд не приходит новых документов и все
+    начатые скачивания закончились.
+    """
+    def __init__(self):
+        self.groups: Dict[str, dict] = {}
+    
+    def join(self, group_id: str) -> dict:
+        """Каталог группы; документ считается скачиваемым до done()"""
+        group = self.groups.get(group_id)
+        if group is None:
+            path = os.path.join(JOBS_DIR, f"{uuid.uuid4().hex}.group")
+            os.makedirs(path, exist_ok=True)
+            group = self.groups[group_id] = {'path': path, 'downloading': 0, 'timer': None}
+        group['downloading'] += 1
+        return group
+    
+    def done(self, group_id: str, on_complete: Callable[[dict], Awaitable[None]]):
+        """Документ скачан - ожидание следующих начинается заново"""
+        group = self.groups[group_id]
+        group['downloading'] -= 1
+        if group['timer']:
+            group['timer'].cancel()
+        group['timer'] = asyncio.create_task(self._wait(group_id, on_complete))
+    
+    async def _wait(self, group_id: str, on_complete: Callable[[dict], Awaitable[None]]):
+        await asyncio.sleep(MEDIA_GROUP_WAIT)
+        group = self.groups.get(group_id)
+        if group is None or group['downloading']:
+            return  # Задачу поставит done() последнего документа
+        del self.groups[group_id]
+        await on_complete(group)
+
+media_groups = MediaGroups()
+
+async def import_history(update: Update, context: ContextTypes.DEFAULT_TYPE, document):
+    """Прежняя выгрузка с подписью /diff - добавляем ее адреса в историю"""
+    user_id = update.effective_user.id
+    if not document.file_name.lower().endswith(('.txt', '.csv', '.jsonl', '.gz', '.zip')):
         await update.message.reply_text(
-            "😔 <b>Валидные email не найдены</b>\n\n"
-            f"Проверено: {len(nicknames)} seller\n"
-            f"💳 Осталось кредитов: {credits if credits >= 0 else '?'}",
-            parse_mode='HTML'
+            "❌ Для истории нужна выгрузка бота (.csv / .jsonl, можно .gz / .zip) "
+            "или список адресов .txt"
         )
         return
     
-    # Формируем результат
-    result_text = (
-        f"✅ <b>Проверка завершена!</b>\n\n"
-        f"📊 Всего seller: {len(nicknames)}\n"
-        f"✅ Валидных: {len(valid_emails)}\n"
-        f"❌ Невалидных: {len(nicknames) - len(valid_emails)}\n"
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    file_path = os.path.join(JOBS_DIR, f"{uuid.uuid4().hex}_{os.path.basename(document.file_name)}")
+    history = SeenHistory(history_path(user_id))
+    try:
+        file = await context.bot.get_file(document.file_id)
+        await file.download_to_drive(file_path)
+        before = await asyncio.to_thread(len, history)
+        size = await asyncio.to_thread(history.merge, iter_verdict_file(file_path))
+    except Exception as e:
+        await update.message.reply_text(f"❌ Не удалось прочитать историю: {str(e)}")
+        return
+    finally:
+        JobManager._remove_file(file_path)
+    
+    if not user_config.get_user_config(user_id).get('diff_mode'):
+        user_config.set_diff_mode(user_id, True)
+    await update.message.reply_text(
+        f"📚 В историю добавлено: {size - before}\n"
+        f"Всего в истории: {size}\n\n"
+        f"Режим сравнения включен - эти адреса больше не проверяются. "
+        f"Выключить: <code>/diff off</code>",
+        parse_mode='HTML'
     )
-    if credits >= 0:
-        result_text += f"\n💳 Осталось кредитов: {credits}"
+
+async def diff_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /diff - режим сравнения с прежними проверками"""
+    user_id = update.effective_user.id
+    history = SeenHistory(history_path(user_id))
+    action = context.args[0].lower() if context.args else ''
     
-    await update.message.reply_text(result_text, parse_mode='HTML')
+    if action in ('on', 'off'):
+        user_config.set_diff_mode(user_id, action == 'on')
+    elif action == 'clear':
+        await asyncio.to_thread(history.clear)
+    elif action:
+        await update.message.reply_text("❌ Использование: /diff [on|off|clear]")
+        return
     
-    # Отправляем файл с результатами
-    valid_content = '\n'.join(valid_emails)
-    await update.message.reply_document(
-        document=BytesIO(valid_content.encode()),
-        filename='valid_emails.txt',
-        caption=f'✅ {len(valid_emails)} валидных Gmail адресов'
+    enabled = bool(user_config.get_user_config(user_id).get('diff_mode'))
+    size = await asyncio.to_thread(len, history)
+    await update.message.reply_text(
+        f"🔀 <b>Режим сравнения: {'включен' if enabled else 'выключен'}</b>\n"
+        f"📚 В истории: {size} адресов\n\n"
+        f"Когда режим включен, адреса с готовым вердиктом из прошлых проверок "
+        f"пропускаются, а результаты новых проверок добавляются в историю.\n\n"
+        f"<code>/diff on</code> / <code>/diff off</code> - включить / выключить\n"
+        f"<code>/diff clear</code> - очистить историю\n"
+        f"Файл прежней выгрузки с подписью <code>/diff</code> - добавить в историю",
+        parse_mode='HTML'
+    )
+
+async def domains_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /domains - домены, по которым ищется адрес никнейма"""
+    user_id = update.effective_user.id
+    args = [arg.lower().strip(',') for arg in context.args]
+    
+    if args == ['reset']:
+        user_config.set_domains(user_id, [])
+    elif args:
+        domains = list(dict.fromkeys(arg.lstrip('@') for arg in args if arg))
+        bad = [domain for domain in domains if not DOMAIN_RE.match(domain)]
+        if bad or len(domains) > EXPAND_MAX_DOMAINS:
+            await update.message.reply_text(
+                f"❌ Неверные домены: {', '.join(bad)}" if bad else
+                f"❌ Не больше {EXPAND_MAX_DOMAINS} доменов"
+            )
+            return
+        has_mx = await mx_resolver.check_many(domains)
+        no_mx = [domain for domain in domains if not has_mx[domain]]
+        if no_mx:
+            await update.message.reply_text(f"❌ У доменов нет MX записей: {', '.join(no_mx)}")
+            return
+        user_config.set_domains(user_id, domains)
+    
+    domains = user_config.get_domains(user_id)
+    await update.message.reply_text(
+        f"🌐 <b>Домены (по приоритету):</b> {', '.join(domains)}\n"
+        f"🧩 Шаблоны имени: {', '.join(EXPAND_PATTERNS)}\n\n"
+        f"Для каждого никнейма адреса проверяются по порядку до первого валидного - "
+        f"чем больше доменов, тем больше запросов на ненайденные никнеймы "
+        f"(не больше {EXPAND_MAX_CANDIDATES} адресов на никнейм).\n\n"
+        f"Сменить: <code>/domains gmail.com outlook.com</code>\n"
+        f"По умолчанию: <code>/domains reset</code>",
+        parse_mode='HTML'
+    )
+
+LIMIT_NAMES = {'jobs': int, 'quota': int, 'weight': float}
+
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /limits - лимиты пользователя; администратор меняет их:
+    /limits <user_id> jobs=2 quota=10000 weight=2 (или reset)"""
+    user_id = update.effective_user.id
+    target = user_id
+    if context.args:
+        if user_id not in ADMIN_IDS:
+            await update.message.reply_text("⛔ Менять лимиты могут только администраторы")
+            return
+        try:
+            target = int(context.args[0])
+            if context.args[1:] == ['reset']:
+                changes = dict.fromkeys(LIMIT_NAMES)
+            else:
+                changes = {}
+                for arg in context.args[1:]:
+                    name, _, value = arg.partition('=')
+                    changes[name] = LIMIT_NAMES[name](value)
+                    if changes[name] < 0 or (name != 'quota' and changes[name] == 0):
+                        raise ValueError
+        except (ValueError, KeyError):
+            await update.message.reply_text(
+                "❌ Формат: <code>/limits 123456 jobs=2 quota=10000 weight=2</code> "
+                "или <code>/limits 123456 reset</code>",
+                parse_mode='HTML'
+            )
+            return
+        if changes:
+            user_config.set_limits(target, changes)
+    
+    limits = user_config.get_limits(target)
+    used = await asyncio.to_thread(user_config.quota_used, target)
+    quota_text = f"{used} из {limits['quota']}" if limits['quota'] > 0 else f"{used} (без лимита)"
+    await update.message.reply_text(
+        f"📏 <b>Лимиты{'' if target == user_id else f' пользователя {target}'}</b>\n\n"
+        f"Задач одновременно: {limits['jobs']}\n"
+        f"Проверок сегодня: {quota_text}\n"
+        f"Доля запросов к MailApi: ×{limits['weight']:g}\n\n"
+        f"Лимит проверок обновляется в 00:00 UTC; адреса из кэша его не тратят.",
+        parse_mode='HTML'
     )
 
+def has_nicknames(file_path: str, file_type: str, selector: str) -> bool:
+    """Есть ли в файле (в любом файле архива или группы) хотя бы один никнейм"""
+    try:
+        for member in islice(iter_members(file_path, file_type), ARCHIVE_MAX_MEMBERS):
+            with closing(iter_member_nicknames(member, selector)) as nicknames:
+                if next(nicknames, None) is not None:
+                    return True
+    except ARCHIVE_ERRORS:
+        pass
+    return False
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /jobs - последние задачи пользователя"""
+    jobs = await asyncio.to_thread(job_manager.store.list_user, update.effective_user.id)
+    if not jobs:
+        await update.message.reply_text("📭 Задач пока нет - отправьте файл для проверки")
+        return
+    
+    lines = ["📋 <b>Ваши задачи</b>\n"]
+    for job in jobs:
+        line = f"#{job['id']} {job['file_type']} - {JOB_STATUS_TEXT.get(job['status'], job['status'])}"
+        if job['status'] in ('running', 'stopped', 'done') and job['found']:
+            line += f" ({job['cursor']} проверено)"
+        lines.append(line)
+    await update.message.reply_text('\n'.join(lines), parse_mode='HTML')
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /cancel [id] - отмена задачи (без id - всех активных)"""
+    user_id = update.effective_user.id
+    jobs = await asyncio.to_thread(job_manager.store.list_user, user_id, 1000)
+    active = [job['id'] for job in jobs if job['status'] in ('pending', 'running')]
+    
+    if context.args:
+        try:
+            job_id = int(context.args[0].lstrip('#'))
+        except ValueError:
+            await update.message.reply_text("❌ Неверный номер задачи")
+            return
+        if job_id not in active:
+            await update.message.reply_text(f"❌ Активная задача #{job_id} не найдена")
+            return
+        targets = [job_id]
+    else:
+        targets = active
+    
+    cancelled = [job_id for job_id in targets if await job_manager.cancel(job_id)]
+    if cancelled:
+        await update.message.reply_text(
+            "🚫 Отменено: " + ', '.join(f"#{job_id}" for job_id in cancelled)
+        )
+    else:
+        await update.message.reply_text("📭 Нет активных задач")
+
 async def handle_single_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверка одного email"""
     user_id = update.effective_user.id
-    config = user_config.get_user_config(user_id)
-    api_key = config.get('mailapi_key', '')
     
     user_input = update.message.text.strip()
-    email = f"{user_input}@gmail.com" if '@' not in user_input else user_input
+    local, _, domain = user_input.rpartition('@')
+    if not _:
+        candidates = expand_candidates(user_input, user_config.get_domains(user_id))
+    elif domain.lower() in GMAIL_DOMAINS:
+        email = canonical_gmail(local)
+        candidates = (email,) if email else ()
+    else:
+        candidates = (user_input,)
+    
+    if not candidates:
+        await update.message.reply_text(
+            f"❌ <b>Такого Gmail не бывает</b>\n\n"
+            f"<code>{user_input}</code> не подходит под правила имен Gmail "
+            f"({GMAIL_MIN_LEN}-{GMAIL_MAX_LEN} символов: латиница, цифры, точки)",
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
+    
+    has_mx = await mx_resolver.check_many(email.rpartition('@')[2] for email in candidates)
+    candidates = tuple(email for email in candidates if has_mx[email.rpartition('@')[2]])
+    if not candidates:
+        await update.message.reply_text("📭 У домена нет MX записей - почту он не принимает")
+        return ConversationHandler.END
+    
+    msg = await update.message.reply_text(f"⏳ Проверяю {', '.join(candidates)}...")
+    
+    # Кандидаты по приоритету до первого валидного; запросы идут вне очереди задач.
+    # Ключи - тем же пулом, что и у задач: при 401/402 адрес проверяет следующий ключ
+    cached = await asyncio.to_thread(result_cache.get_many, list(candidates))
+    pool = KeyPool(user_config.get_api_keys(user_id))
+    verdicts: Dict[str, str] = {}
+    status = ''
+    slot = scheduler.share(user_id, urgent=True)
+    for email in candidates:
+        if email in cached:
+            status = cached[email]
+        elif not await asyncio.to_thread(user_config.reserve_quota, user_id, 1):
+            status = 'quota'
+            break
+        else:
+            while True:
+                key = await pool.acquire()
+                if key is None:
+                    status = pool.exhausted_status()
+                    break
+                _, status, credits = await mailapi_verify_single(
+                    http_client.get_session(), email, key.key,
+                    on_throttle=key.bucket.pause, slot=slot, acquire=key.bucket.acquire
+                )
+                pool.update_credits(key, credits)
+                if status not in ('error_key', 'error_credits'):
+                    break
+                pool.retire(key, status)
+            if key is None:
+                await asyncio.to_thread(user_config.release_quota, user_id, 1)
+                break
+            result_cache.put(email, status)
+        verdicts[email] = status
+        if status == 'valid':
+            break
+    await asyncio.to_thread(result_cache.flush)
+    if status not in ('error_key', 'error_credits', 'quota'):
+        result_email, status = VerificationEngine._resolve(candidates, verdicts)
+    
+    if status == 'valid':
+        text = f"✅ <b>Валидный!</b>\n\n📧 <code>{result_email}</code>"
+    elif status == 'disposable':
+        text = f"❌ <b>Одноразовый адрес</b>\n\n📧 <code>{result_email}</code>"
+    elif status == 'invalid':
+        text = f"❌ <b>Невалидный</b>\n\n📧 <code>{result_email}</code>"
+    elif status == 'error_key':
+        text = "❌ Неверный API ключ!"
+    elif status == 'error_credits':
+        text = "❌ Кончились кредиты!"
+    elif status == 'quota':
+        text = "⛔ Дневной лимит проверок исчерпан - /limits"
+    elif status == 'unknown':
+        text = f"⚠️ MailApi не отвечает - попробуйте позже\n\n📧 <code>{result_email}</code>"
+    else:
+        text = f"⚠️ Не удалось проверить <code>{result_email}</code>"
+    
+    if len(verdicts) > 1 and status != 'valid':
+        text += "\n\n" + '\n'.join(f"• <code>{email}</code> - {verdict}"
+                                     for email, verdict in verdicts.items())
+    for masked, reason in pool.retired_keys():
+        text += (
+            f"\n🔑 Ключ {masked} отключен: "
+            f"{'нет кредитов' if reason == 'error_credits' else 'неверный ключ'}"
+        )
+    credits = pool.credits()
+    if credits >= 0:
+        text += f"\n\n💳 Осталось кредитов: {credits}"
     
-    msg = await update.message.reply_text(f"⏳ Проверяю {email}...")
+    await msg.edit_text(text, parse_mode='HTML')
+    return ConversationHandler.END
+
+async def pool_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /pool - состояние пула HTTP соединений"""
+    stats = http_client.stats()
+    await update.message.reply_text(
+        f"🔌 <b>Пул соединений</b>\n\n"
+        f"Лимит: {stats['limit']} (на хост: {stats['limit_per_host']})\n"
+        f"Свободных: {stats['idle']}\n"
+        f"Запросов: {stats['requests']}\n"
+        f"Новых соединений: {stats['connections_created']}\n"
+        f"Переиспользовано: {stats['connections_reused']} "
+        f"({stats['reuse_ratio']:.0%})",
+        parse_mode='HTML'
+    )
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export - формат полной выгрузки результатов"""
+    user_id = update.effective_user.id
+    args = [arg.lower() for arg in context.args]
+    if not args:
+        export_format, compression = user_config.get_export(user_id)
+        await update.message.reply_text(
+            f"📦 <b>Полная выгрузка:</b> {export_format}.{compression}\n\n"
+            f"Для каждого адреса: статус (valid/invalid/disposable/unknown/error) "
+            f"и источник (api - проверен сейчас, cache - из кэша).\n\n"
+            f"Сменить: <code>/export csv gz</code>, <code>/export jsonl zip</code>",
+            parse_mode='HTML'
+        )
+        return
+    
+    export_format = next((a for a in args if a in EXPORT_FORMATS), None)
+    compression = next((a for a in args if a in EXPORT_COMPRESSIONS), None)
+    if export_format is None and compression is None:
+        await update.message.reply_text(
+            f"❌ Форматы: {', '.join(EXPORT_FORMATS)}; сжатие: {', '.join(EXPORT_COMPRESSIONS)}"
+        )
+        return
+    current_format, current_compression = user_config.get_export(user_id)
+    export_format = export_format or current_format
+    compression = compression or current_compression
+    user_config.set_export(user_id, export_format, compression)
+    await update.message.reply_text(f"✅ Полная выгрузка: {export_format}.{compression}")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - сводка метрик (только для ADMIN_IDS)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Команда только для администраторов")
+        return
+    
+    def latency_line(histogram: Histogram, label: str, title: str) -> str:
+        count, avg = histogram.stats(label)
+        return f"{title}: {count} шт, в среднем {avg * 1000:.0f} мс\n" if count else ""
+    
+    uptime = format_eta(time.time() - metrics.started)
+    pending, running = await job_manager.counts()
+    statuses = ', '.join(f"{labels[0]} {value:g}" for labels, value in
+                         sorted(metrics.verifications.values.items())) or 'нет'
+    text = (
+        f"📈 <b>Статистика</b> (работает {uptime})\n\n"
+        f"🚀 Проверок/сек (минута): {metrics.verify_rate.rate():.1f}\n"
+        f"✉️ Проверено: {statuses}\n"
+        f"🔁 Повторов MailApi: {metrics.mailapi_retries.total():g}, "
+        f"пауз: {mailapi_breaker.trips}\n"
+        f"🗄 Кэш: {metrics.cache.values.get(('hit',), 0):g} попаданий, "
+        f"{metrics.cache.values.get(('miss',), 0):g} промахов\n"
+        f"🧹 Сэкономлено запросов: {metrics.saved.total():g}\n"
+        f"📥 Задач: {pending} в очереди, {running} выполняется\n\n"
+    )
+    for labels in sorted(metrics.mailapi_latency.values):
+        text += latency_line(metrics.mailapi_latency, labels[0], f"MailApi {labels[0]}")
+    for method in ('sendMessage', 'editMessageText', 'sendDocument', 'getFile'):
+        text += latency_line(metrics.telegram_latency, method, f"Telegram {method}")
+    for file_type in ('JSON', 'TXT', 'ZIP', 'GZ', 'TAR', 'GROUP'):
+        text += latency_line(metrics.download_seconds, file_type, f"Скачивание {file_type}")
+        text += latency_line(metrics.parse_seconds, file_type, f"Разбор {file_type}")
+    
+    await update.message.reply_text(text, parse_mode='HTML')
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /help"""
+    await update.message.reply_text(HELP_TEXT, parse_mode='HTML')
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                              ЗАПУСК
+# ═══════════════════════════════════════════════════════════════════════════════
+
+async def start_metrics(port: int = METRICS_PORT):
+    """/metrics после запуска: aiohttp импортируется в потоке, пока бот
+    уже принимает апдейты, и к первой проверке файла готов"""
+    await asyncio.to_thread(load_aiohttp)
+    if port:
+        try:
+            await metrics.start(port=port)
+        except OSError as e:
+            print(f"ОШИБКА ЗАПУСКА /metrics (порт {port}): {e}")
+
+async def on_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: отмечает первый апдейт после запуска, обработку не прерывает"""
+    if 'first_update' not in startup.stages:
+        startup.mark('first_update')
+        print(f"⏱ Первый апдейт: {startup.stages['first_update']:.3f} с после запуска")
+
+async def on_startup(application: Application):
+    # Пул HTTP и /metrics не задерживают прием апдейтов - см. HttpClient, start_metrics
+    application.bot_data['metrics_task'] = asyncio.create_task(start_metrics())
+    if JOB_PROCESSES:
+        # Задачи выполняют отдельные процессы, здесь - только очередь в базе
+        job_manager.shared = True
+        await job_processes.start()
+    else:
+        await job_manager.start(application.bot)
+    startup.mark('ready')
+    print(f"⏱ Запуск: {startup.report()}")
+
+async def on_stop(application: Application):
+    """post_stop: задачи останавливаются, пока бот еще может писать в чаты.
+    
+    Движки сохраняют курсор и сообщают о перезапуске; после этого
+    Application.shutdown закрывает HTTP клиент бота.
+    """
+    if JOB_PROCESSES:
+        await job_processes.stop()
+    else:
+        await job_manager.stop()
+
+async def on_shutdown(application: Application):
+    metrics_task = application.bot_data.pop('metrics_task', None)
+    if metrics_task:
+        metrics_task.cancel()
+        await asyncio.gather(metrics_task, return_exceptions=True)
+    parse_pool.shutdown()
+    await metrics.stop()
+    await http_client.close()
+    await asyncio.to_thread(result_cache.flush)
+    await user_config.flush()
+
+class WebhookServer:
+    """Прием апдейтов по webhook на aiohttp в том же event loop, что и проверки.
+    
+    Запрос без верного секрета (заголовок X-Telegram-Bot-Api-Secret-Token)
+    отклоняется с 403. Апдейт кладется в очередь Application и сразу
+    получает 200 - обработчики идут параллельно (см. concurrent).
+    GET /healthz - проверка для балансировщика, при остановке отвечает 503.
+    """
+    def __init__(self, application: Application, url: str, secret: str):
+        self.application = application
+        self.url = url
+        self.path = urlsplit(url).path or '/'
+        self.secret = secret
+        self.runner: Optional[web.AppRunner] = None
+        self.draining = False
+    
+    async def start(self):
+        load_aiohttp()
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get('/healthz', self.health)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await self.application.bot.set_webhook(
+            self.url, secret_token=self.secret, allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.draining:
+            return web.Response(status=503)  # Telegram повторит позже
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        return web.Response()
+    
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(status=503 if self.draining else 200, text='ok')
+    
+    async def stop(self):
+        """Перестает принимать апдейты; принятые уже в очереди Application"""
+        self.draining = True
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+async def run_webhook(application: Application):
+    """Работа в режиме webhook до SIGTERM / SIGINT.
+    
+    При остановке новые апдейты не принимаются, принятые дорабатываются
+    (Application.stop ждет очередь и обработчики), затем on_stop
+    останавливает задачи - они сохраняют курсор и продолжатся после запуска.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    server = WebhookServer(application, WEBHOOK_URL, WEBHOOK_SECRET or secrets.token_urlsafe(32))
+    try:
+        async with application:
+            await application.post_init(application)
+            await application.start()
+            try:
+                await server.start()
+                print("🤖 Бот запущен (webhook)!")
+                await stop.wait()
+            finally:
+                await server.stop()
+                await application.stop()
+                # Как в run_polling: задачи - до shutdown, пока бот может писать в чаты
+                await application.post_stop(application)
+    finally:
+        await application.post_shutdown(application)
+
+def run_job_worker(worker_id: int):
+    """Точка входа процесса-воркера задач"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C обрабатывает основной процесс
+    load_telegram()
+    asyncio.run(job_worker_main(worker_id))
+
+async def job_worker_main(worker_id: int):
+    """Выполняет задачи из общей очереди до SIGTERM от основного процесса.
+    
+    /metrics воркера слушает METRICS_PORT + номер воркера + 1.
+    """
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    job_manager.shared = True
+    job_manager.worker_id = worker_id
+    user_config.shared = True
+    
+    bot = Bot(BOT_TOKEN, base_url=TELEGRAM_API_URL, request=TimedRequest(connection_pool_size=64))
+    async with bot:
+        metrics_task = asyncio.create_task(start_metrics(METRICS_PORT and METRICS_PORT + worker_id + 1))
+        await job_manager.start(bot)
+        startup.mark('ready')
+        print(f"⏱ Воркер {worker_id}: {startup.report()}")
+        await stop.wait()
+        metrics_task.cancel()
+        await asyncio.gather(metrics_task, return_exceptions=True)
+        await job_manager.stop()
+        parse_pool.shutdown()
+        await metrics.stop()
+        await http_client.close()
+        await asyncio.to_thread(result_cache.flush)
+
+def concurrent(callback: Callable, slots: asyncio.Semaphore) -> Callable:
+    """Обработчик для block=False: не больше UPDATE_CONCURRENCY одновременно.
+    
+    Апдейты разбираются по одному (concurrent_updates выключен): с ним
+    ConversationHandler мог бы обработать два сообщения пользователя в одном
+    состоянии. Долгие обработчики при этом идут задачами и не держат очередь,
+    а состояние разговора обновляется, когда задача закончится.
+    """
+    @wraps(callback)
+    async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with slots:
+            return await callback(update, context)
+    return run
+
+def main():
+    load_telegram()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .request(TimedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
     
-    connector = aiohttp.TCPConnector(ssl=False, force_close=True)
-    async with aiohttp.ClientSession(connector=connecto
+    def on_command(name: str, callback: Callable) -> CommandHandler:
+        return CommandHandler(name, concurrent(callback, slots), block=False)
+    
+    def on_text(callback: Callable) -> MessageHandler:
+        return MessageHandler(filters.TEXT & ~filters.COMMAND, concurrent(callback, slots),
+                              block=False)
+    
+    conv_handler = ConversationHandler(
+        # Кнопка только правит сообщение - ждем ее, чтобы состояние сменилось сразу
+        entry_points=[CallbackQueryHandler(button_handler)],
+        states={
+            WAITING_API_KEY: [on_text(handle_api_key)],
+            WAITING_SINGLE_EMAIL: [on_text(handle_single_email)],
+        },
+        fallbacks=[on_command('start', start)],
+    )
+    
+    application.add_handler(TypeHandler(Update, on_first_update), group=-1)
+    application.add_handler(on_command('start', start))
+    application.add_handler(on_command('setapi', setapi_command))
+    application.add_handler(on_command('setrate', setrate_command))
+    application.add_handler(on_command('keys', keys_command))
+    application.add_handler(on_command('addkey', addkey_command))
+    application.add_handler(on_command('removekey', removekey_command))
+    application.add_handler(on_command('jobs', jobs_command))
+    application.add_handler(on_command('cancel', cancel_command))
+    application.add_handler(on_command('pool', pool_command))
+    application.add_handler(on_command('export', export_command))
+    application.add_handler(on_command('diff', diff_command))
+    application.add_handler(on_command('domains', domains_command))
+    application.add_handler(on_command('limits', limits_command))
+    application.add_handler(on_command('stats', stats_command))
+    application.add_handler(on_command('help', help_command))
+    application.add_handler(conv_handler)
+    application.add_handler(MessageHandler(filters.Document.ALL, concurrent(handle_file, slots),
+                                           block=False))
+    
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+        return
+    print("🤖 Бот запущен!")
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+startup.mark('import')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Задачи проверки: JobStore (курсор, результаты, очередь) и продолжение
+задачи JobManager после перезапуска бота. MailApi и Telegram подменяются -
+сеть не нужна.
+
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_bot as tb
+
+STATS = {'found': 0, 'cache_hits': 0, 'cache_misses': 0, 'skipped': 0}
+
+class JobStoreTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = tb.JobStore(os.path.join(tmp.name, 'jobs.db'))
+
+    def create(self, user_id=1, size=-1):
+        return self.store.create(user_id, user_id, 'list.txt', 'TXT', 'seller', size=size)
+
+    def test_checkpoint_and_resume(self):
+        job_id = self.create()
+        self.store.start(job_id, 0)
+        rows = [(idx, f'person{idx}@gmail.com', 'valid' if idx % 2 else 'invalid', 'api')
+                for idx in range(6)]
+        # Результаты приходят не по порядку файла
+        self.store.checkpoint(job_id, 4, 10, STATS, rows[3:] + rows[:3])
+        job = self.store.get(job_id)
+        self.assertEqual((job['status'], job['cursor'], job['credits']), ('running', 4, 10))
+        self.assertEqual(self.store.emails(job_id, 'valid'),
+                         ['person1@gmail.com', 'person3@gmail.com', 'person5@gmail.com'])
+        # При продолжении результаты после курсора проверяются заново
+        self.store.start(job_id, job['cursor'])
+        self.assertEqual(len(list(self.store.iter_results(job_id))), 4)
+        self.assertEqual([job['id'] for job in self.store.unfinished()], [job_id])
+
+    def test_iter_results_pages(self):
+        job_id = self.create()
+        rows = [(idx, f'person{idx}@gmail.com', 'valid', 'api') for idx in range(7)]
+        self.store.checkpoint(job_id, 7, -1, STATS, rows)
+        self.assertEqual([email for email, _, _ in self.store.iter_results(job_id, page=3)],
+                         [email for _, email, _, _ in rows])
+
+    def test_claim_alternates_users_within_limit(self):
+        first, second, other = self.create(1), self.create(1), self.create(2)
+        claimed = [self.store.claim(0, lambda user_id: 1)['id'] for _ in range(2)]
+        self.assertEqual(claimed, [first, other])
+        # У каждого пользователя уже выполняется задача
+        self.assertIsNone(self.store.claim(0, lambda user_id: 1))
+        self.assertEqual(self.store.claim(0, lambda user_id: 2)['id'], second)
+
+    def test_claim_fast_lane_takes_small_files(self):
+        self.create(size=10 ** 9)
+        small = self.create(size=100)
+        self.create(size=-1)
+        self.assertEqual(self.store.claim(0, lambda user_id: 5, max_size=1000)['id'], small)
+        self.assertIsNone(self.store.claim(0, lambda user_id: 5, max_size=1000))
+
+    def test_requeue_and_cancel(self):
+        running, pending = self.create(), self.create()
+        self.store.claim(3, lambda user_id: 1)
+        self.assertFalse(self.store.cancel_pending(running))
+        self.assertTrue(self.store.request_cancel(running))
+        self.assertTrue(self.store.cancel_requested(running))
+        self.assertTrue(self.store.cancel_pending(pending))
+        self.assertEqual(self.store.count_active(), (0, 1))
+        self.assertEqual(self.store.requeue(worker=4), 0)
+        self.assertEqual(self.store.requeue(worker=3), 1)
+        self.assertEqual(self.store.get(running)['status'], 'pending')
+        # Новый запуск сбрасывает старую просьбу об отмене
+        self.assertEqual(self.store.claim(0, lambda user_id: 1)['id'], running)
+        self.assertFalse(self.store.cancel_requested(running))
+
+class CountingMailApi:
+    """Подмена mailapi_request: валидны адреса, никнейм которых кончается на v"""
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, session, email, api_key):
+        self.calls.append(email)
+        await asyncio.sleep(0.002)
+        return 'valid' if email.split('@')[0].endswith('v') else 'invalid', -1, 0.0
+
+class FakeBot:
+    def __init__(self):
+        self.documents = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        data = document.read() if hasattr(document, 'read') else open(document, 'rb').read()
+        self.documents[filename] = data
+
+class ResumeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tb.load_telegram()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        config = tb.UserConfig(os.path.join(tmp.name, 'config.db'))
+        config.add_api_key(1, 'key', 0, 1)
+        self.api = CountingMailApi()
+        # Без кэша: после перезапуска проверяется ровно то, что не сохранено
+        patches = [
+            mock.patch.object(tb, 'user_config', config),
+            mock.patch.object(tb, 'result_cache', None),
+            mock.patch.object(tb, 'mx_resolver', None),
+            mock.patch.object(tb, 'scheduler', tb.FairScheduler()),
+            mock.patch.object(tb, 'mailapi_breaker', tb.CircuitBreaker()),
+            mock.patch.object(tb, 'mailapi_request', self.api),
+            mock.patch.object(tb, 'JOBS_DIR', tmp.name),
+            mock.patch.object(tb, 'JOB_CHECKPOINT_INTERVAL', 0.02),
+            mock.patch.object(tb.http_client, 'get_session', return_value=None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addAsyncCleanup(config.flush)
+
+    async def wait_for(self, condition):
+        for _ in range(1000):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('не дождались')
+
+    async def test_job_continues_after_restart(self):
+        nicknames = [f'person{i}' + ('v' if i % 3 == 0 else '') for i in range(300)]
+        path = os.path.join(self.dir, 'list.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(nicknames))
+        db_path = os.path.join(self.dir, 'jobs.db')
+        store = tb.JobStore(db_path)
+        job_id = store.create(1, 1, path, 'TXT', 'seller')
+
+        manager = tb.JobManager(store, workers=1, fast_workers=0)
+        await manager.start(FakeBot())
+        await self.wait_for(lambda: len(self.api.calls) >= 100)
+        await manager.stop()
+        job = store.get(job_id)
+        self.assertEqual(job['status'], 'running')
+        self.assertTrue(0 < job['cursor'] < len(nicknames))
+        self.assertEqual(len(list(store.iter_results(job_id))), job['cursor'])
+        first_run = len(self.api.calls)
+
+        # Перезапуск: новое хранилище на той же базе, задача продолжается с курсора
+        bot = FakeBot()
+        manager = tb.JobManager(tb.JobStore(db_path), workers=1, fast_workers=0)
+        await manager.start(bot)
+        await self.wait_for(lambda: store.get(job_id)['status'] == 'done')
+        await manager.stop()
+
+        # Запросы параллельные - порядок не важен, важно что ровно не сохраненные
+        self.assertEqual(sorted(self.api.calls[first_run:]),
+                         sorted(f'{nick}@gmail.com' for nick in nicknames[job['cursor']:]))
+        results = list(store.iter_results(job_id))
+        self.assertEqual([email for email, _, _ in results],
+                         [f'{nick}@gmail.com' for nick in nicknames])
+        self.assertEqual(store.emails(job_id, 'valid'),
+                         [f'{nick}@gmail.com' for nick in nicknames if nick.endswith('v')])
+        self.assertTrue(bot.documents)
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Пул ключей MailApi: выбор ключа, выбывание на 401/402 и проверка адреса
+следующим ключом. MailApi подменяется - сеть не нужна.
+
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+"""
+
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_bot as tb
+
+class FakeMailApi:
+    """Подмена mailapi_request: credits[ключ] - сколько проверок осталось
+    (0 - ответ 402), ключа нет в credits - ответ 401. Без report остаток
+    в ответе не сообщается."""
+    def __init__(self, credits, report=True):
+        self.credits = dict(credits)
+        self.report = report
+        self.calls = []
+
+    async def __call__(self, session, email, api_key):
+        self.calls.append((email, api_key))
+        if api_key not in self.credits:
+            return 'error_key', -1, 0.0
+        if self.credits[api_key] <= 0:
+            return 'error_credits', -1, 0.0
+        self.credits[api_key] -= 1
+        return 'valid', self.credits[api_key] if self.report else -1, 0.0
+
+def make_keys(*names, rate=0.0):
+    return [{'key': name, 'rate': rate, 'burst': 1} for name in names]
+
+class KeyPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def test_key_with_more_credits_first(self):
+        pool = tb.KeyPool(make_keys('key-a', 'key-b'))
+        pool.update_credits(pool.keys[0], 10)
+        pool.update_credits(pool.keys[1], 50)
+        self.assertEqual((await pool.acquire()).key, 'key-b')
+
+    async def test_credits_keep_minimum(self):
+        # Ответы приходят не по порядку - старший остаток не возвращается
+        pool = tb.KeyPool(make_keys('key-a'))
+        pool.update_credits(pool.keys[0], 10)
+        pool.update_credits(pool.keys[0], 12)
+        pool.update_credits(pool.keys[0], -1)
+        self.assertEqual(pool.credits(), 10)
+
+    async def test_retired_keys_are_skipped(self):
+        pool = tb.KeyPool(make_keys('key-a', 'key-b'))
+        pool.retire(pool.keys[0], 'error_key')
+        self.assertEqual((await pool.acquire()).key, 'key-b')
+        pool.retire(pool.keys[1], 'error_credits')
+        self.assertIsNone(await pool.acquire())
+        self.assertEqual(pool.exhausted_status(), 'error_credits')
+        self.assertEqual(len(pool.retired_keys()), 2)
+
+    async def test_busy_key_gives_way_to_free_one(self):
+        # Токен первого ключа потрачен - следующий запрос идет другим ключом, без ожидания
+        pool = tb.KeyPool(make_keys('key-a', 'key-b', rate=1.0))
+        first, second = await pool.acquire(), await pool.acquire()
+        self.assertNotEqual(first.key, second.key)
+        self.assertEqual(pool.total_rate, 2.0)
+
+    async def test_acquire_waits_for_token(self):
+        pool = tb.KeyPool(make_keys('key-a', rate=10.0))
+        await pool.acquire()
+        start = time.monotonic()
+        await pool.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+class FailoverTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.patches = [mock.patch.object(tb, 'mailapi_breaker', tb.CircuitBreaker())]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def use_api(self, credits, report=True):
+        api = FakeMailApi(credits, report)
+        patch = mock.patch.object(tb, 'mailapi_request', api)
+        patch.start()
+        self.patches.append(patch)
+        return api
+
+    async def test_bad_key_retired_address_rechecked(self):
+        api = self.use_api({'good-key': 100})
+        emails = [f'person{i}@gmail.com' for i in range(5)]
+        engine = tb.VerificationEngine(None, tb.KeyPool(make_keys('bad-key', 'good-key')),
+                                       concurrency=1)
+        valid, credits, status = await engine.run(emails)
+        self.assertEqual(status, '')
+        self.assertEqual(valid, emails)
+        self.assertEqual(credits, 95)
+        self.assertEqual([key for _, key in api.calls].count('bad-key'), 1)
+        self.assertEqual([reason for _, reason in engine.pool.retired_keys()], ['error_key'])
+
+    async def test_next_key_takes_over_when_credits_run_out(self):
+        # Остаток неизвестен - пул берет первый ключ, пока тот не ответит 402
+        api = self.use_api({'key-a': 3, 'key-b': 100}, report=False)
+        emails = [f'person{i}@gmail.com' for i in range(10)]
+        pool = tb.KeyPool(make_keys('key-a', 'key-b'))
+        valid, _, status = await tb.VerificationEngine(None, pool, concurrency=2).run(emails)
+        self.assertEqual(status, '')
+        self.assertEqual(valid, emails)
+        self.assertEqual(pool.retired_keys(), [(tb.mask_key('key-a'), 'error_credits')])
+        # Каждый адрес засчитан одним ключом, 402 лишь переводит его на другой
+        self.assertEqual(api.credits, {'key-a': 0, 'key-b': 93})
+
+    async def test_all_keys_exhausted_keeps_partial_result(self):
+        self.use_api({'key-a': 2, 'key-b': 1})
+        emails = [f'person{i}@gmail.com' for i in range(10)]
+        valid, _, status = await tb.VerificationEngine(
+            None, tb.KeyPool(make_keys('key-a', 'key-b')), concurrency=1).run(emails)
+        self.assertEqual(status, 'error_credits')
+        self.assertEqual(valid, emails[:3])
+
+    async def test_single_check_uses_key_pool(self):
+        tb.load_telegram()
+        api = self.use_api({'extra-key': 100})
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        config = tb.UserConfig(os.path.join(tmp.name, 'config.db'))
+        config.add_api_key(7, 'revoked-key', 0, 1)
+        config.add_api_key(7, 'extra-key', 0, 1)
+        for name, value in (('user_config', config),
+                            ('result_cache', tb.ResultCache(os.path.join(tmp.name, 'cache.db')))):
+            patch = mock.patch.object(tb, name, value)
+            patch.start()
+            self.patches.append(patch)
+        replies = []
+
+        class Message:
+            text = 'person.one@gmail.com'
+
+            async def reply_text(self, text, **kwargs):
+                return self
+
+            async def edit_text(self, text, **kwargs):
+                replies.append(text)
+
+        update = types.SimpleNamespace(effective_user=types.SimpleNamespace(id=7), message=Message())
+        with mock.patch.object(tb.http_client, 'get_session', return_value=None):
+            await tb.handle_single_email(update, None)
+        await config.flush()
+
+        self.assertIn('Валидный', replies[-1])
+        self.assertEqual(api.calls, [('personone@gmail.com', 'revoked-key'),
+                                     ('personone@gmail.com', 'extra-key')])
+
+if __name__ == '__main__':
+    unittest.main()
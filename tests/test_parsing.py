@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Разбор больших файлов не держит event loop и отдает никнеймы потоково.
+
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_bot as tb
+
+RECORDS = 300000
+DOMAINS = ('gmail.com', 'outlook.com')
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class LargeFileParsingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, 'products.json')
+        with open(cls.path, 'w', encoding='utf-8') as f:
+            json.dump({str(i): {'seller': f'seller.name{i % 150000}', 'price': i, 'title': 'x' * 40}
+                       for i in range(RECORDS)}, f)
+        # Файл заведомо больше порога - идет через процесс разбора
+        assert os.path.getsize(cls.path) > tb.PARSE_INLINE_SIZE
+
+    @classmethod
+    def tearDownClass(cls):
+        tb.parse_pool.shutdown()
+        cls.tmp.cleanup()
+
+    def consume(self, stats):
+        """Разбирает файл; возвращает, был ли жив процесс разбора на первом адресе"""
+        nicknames = tb.iter_job_nicknames(self.path, 'JSON', 'seller', DOMAINS)
+        parsing = None
+        for _ in tb.unique_candidates(nicknames, stats, DOMAINS):
+            if parsing is None:
+                parsing = any(p.name == 'parse-stream' for p in multiprocessing.active_children())
+        return parsing
+
+    def test_first_item_before_whole_file(self):
+        stats = {'found': 0, 'rejected': 0, 'unique': 0}
+        parsing = self.consume(stats)
+        self.assertEqual(stats['found'], RECORDS)
+        self.assertEqual(stats['unique'], 150000)
+        # Проверка начинается, пока файл еще разбирается
+        self.assertTrue(parsing, "первый адрес пришел после конца разбора")
+
+    def test_event_loop_lag_bounded(self):
+        lags = []
+        stats = {'found': 0, 'rejected': 0, 'unique': 0}
+
+        async def run():
+            loop = asyncio.get_running_loop()
+
+            async def ticker():
+                while True:
+                    start = loop.time()
+                    await asyncio.sleep(0.005)
+                    lags.append(loop.time() - start - 0.005)
+
+            probe = asyncio.create_task(ticker())
+            try:
+                await asyncio.to_thread(self.consume, stats)
+            finally:
+                probe.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(stats['found'], RECORDS)
+        self.assertGreater(len(lags), 10)
+        # Граница с большим запасом - тест не должен зависеть от загрузки машины
+        self.assertLess(percentile(lags, 50), 0.1, f"задержка loop p50 {percentile(lags, 50):.4f} с")
+        self.assertLess(percentile(lags, 99), 1.0, f"задержка loop p99 {percentile(lags, 99):.4f} с")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Повторы запросов к MailApi: бюджет повторов, пауза при деградации
+(CircuitBreaker) и лимит ключа на каждую попытку. MailApi подменяется -
+сеть не нужна.
+
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+"""
+
+import asyncio
+import os
+import sys
+import time
+import unittest
+from contextlib import asynccontextmanager
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_bot as tb
+
+class ScriptedMailApi:
+    """Подмена mailapi_request: отвечает статусами из script по очереди,
+    после конца script - последним"""
+    def __init__(self, *script, retry_after=0.0):
+        self.script = list(script)
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def __call__(self, session, email, api_key):
+        self.calls.append(time.monotonic())
+        status = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        return status, -1, self.retry_after if status == 'retry' else 0.0
+
+class RetryTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tb, 'mailapi_breaker', tb.CircuitBreaker(threshold=10 ** 6)),
+            mock.patch.object(tb, 'RETRY_BASE_DELAY', 0.001),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def use_api(self, api):
+        patch = mock.patch.object(tb, 'mailapi_request', api)
+        patch.start()
+        self.patches.append(patch)
+        return api
+
+class RetryBudgetTest(unittest.TestCase):
+    def test_min_retries_then_ratio(self):
+        budget = tb.RetryBudget(ratio=0.5, min_retries=2)
+        self.assertTrue(budget.spend())
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+        budget.requests = 4
+        self.assertTrue(budget.spend())
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+
+class CircuitBreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_opens_after_threshold(self):
+        breaker = tb.CircuitBreaker(threshold=3, cooldown=0.05, max_cooldown=1)
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        start = time.monotonic()
+        await breaker.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertFalse(breaker.is_open)
+
+    async def test_probe_failure_doubles_cooldown(self):
+        breaker = tb.CircuitBreaker(threshold=2, cooldown=0.01, max_cooldown=0.03)
+        for _ in range(2):
+            breaker.record_failure()
+        await breaker.wait()
+        # Пробный запрос после паузы не прошел - пауза снова, вдвое дольше
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertEqual(breaker.trips, 2)
+        self.assertEqual(breaker.current_cooldown, 0.03)  # не больше max_cooldown
+        await breaker.wait()
+        breaker.record_success()
+        self.assertEqual(breaker.current_cooldown, 0.01)
+        self.assertEqual(breaker.failures, 0)
+
+class VerifySingleTest(RetryTestCase):
+    async def test_transient_failures_are_retried(self):
+        api = self.use_api(ScriptedMailApi('retry', 'retry', 'valid'))
+        tokens = []
+
+        async def acquire():
+            tokens.append(1)
+
+        _, status, _ = await tb.mailapi_verify_single(None, 'a@gmail.com', 'key', acquire=acquire)
+        self.assertEqual(status, 'valid')
+        self.assertEqual(len(api.calls), 3)
+        # Первый токен берет вызывающий, каждый повтор - свой
+        self.assertEqual(len(tokens), 2)
+
+    async def test_unknown_after_retries(self):
+        api = self.use_api(ScriptedMailApi('retry'))
+        _, status, _ = await tb.mailapi_verify_single(None, 'a@gmail.com', 'key')
+        self.assertEqual(status, 'unknown')
+        self.assertEqual(len(api.calls), tb.MAILAPI_RETRIES + 1)
+
+    async def test_budget_stops_retries(self):
+        api = self.use_api(ScriptedMailApi('retry'))
+        budget = tb.RetryBudget(ratio=0, min_retries=1)
+        _, status, _ = await tb.mailapi_verify_single(None, 'a@gmail.com', 'key', budget=budget)
+        self.assertEqual(status, 'unknown')
+        self.assertEqual(len(api.calls), 2)
+        self.assertEqual(budget.requests, 1)
+
+    async def test_throttle_pauses_key(self):
+        self.use_api(ScriptedMailApi('retry', 'valid', retry_after=0.05))
+        pauses = []
+        _, status, _ = await tb.mailapi_verify_single(None, 'a@gmail.com', 'key',
+                                                      on_throttle=pauses.append)
+        self.assertEqual(status, 'valid')
+        self.assertEqual(pauses, [0.05])
+
+    async def test_errors_are_not_retried(self):
+        for status in ('invalid', 'error_key', 'error_credits', 'error'):
+            api = self.use_api(ScriptedMailApi(status))
+            _, result, _ = await tb.mailapi_verify_single(None, 'a@gmail.com', 'key')
+            self.assertEqual(result, status)
+            self.assertEqual(len(api.calls), 1)
+
+class ResponseMappingTest(unittest.IsolatedAsyncioTestCase):
+    """Разбор ответа MailApi в mailapi_request - на подмененной сессии"""
+    async def request(self, status, headers=None, payload=None):
+        tb.load_aiohttp()
+
+        class Response:
+            async def json(self):
+                return payload or {}
+
+        response = Response()
+        response.status, response.headers = status, headers or {}
+
+        class Session:
+            @asynccontextmanager
+            async def get(self, *args, **kwargs):
+                yield response
+
+        return await tb.mailapi_request(Session(), 'a@gmail.com', 'key')
+
+    async def test_statuses(self):
+        self.assertEqual(await self.request(200, payload={'valid': True, 'creditsRemaining': 7}),
+                         ('valid', 7, 0.0))
+        self.assertEqual((await self.request(401))[0], 'error_key')
+        self.assertEqual((await self.request(402))[0], 'error_credits')
+        self.assertEqual(await self.request(503), ('retry', -1, 0.0))
+        self.assertEqual(await self.request(503, {'Retry-After': '3'}), ('retry', -1, 3.0))
+        self.assertEqual((await self.request(400))[0], 'error')
+
+    async def test_429_without_retry_after_still_throttles(self):
+        self.assertEqual(await self.request(429), ('retry', -1, tb.RETRY_BASE_DELAY))
+        self.assertEqual(await self.request(429, {'Retry-After': '2'}), ('retry', -1, 2.0))
+
+class EngineRetryRateTest(RetryTestCase):
+    async def test_retries_respect_key_rate(self):
+        # MailApi лежит (все ответы 503): повторы не должны превышать лимит ключа
+        api = self.use_api(ScriptedMailApi('retry'))
+        rate = 20.0
+        pool = tb.KeyPool([{'key': 'key', 'rate': rate, 'burst': 1}])
+        engine = tb.VerificationEngine(None, pool, concurrency=8)
+        engine.budget = tb.RetryBudget(ratio=0, min_retries=10 ** 6)
+        start = time.monotonic()
+        run = asyncio.create_task(engine.run([f'person{i}@gmail.com' for i in range(100)]))
+        await asyncio.sleep(0.5)
+        sent, elapsed = len(api.calls), time.monotonic() - start
+        engine.stop()
+        await run
+        self.assertLessEqual(sent, 1 + rate * elapsed + 1)
+
+if __name__ == '__main__':
+    unittest.main()
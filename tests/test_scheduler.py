@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+FairScheduler: очередь по кругу с дефицитом между пользователями, вес,
+стоимость запроса, срочные запросы и отмена ожидающих.
+
+Запуск: python -m pytest -q tests  (или python -m unittest discover tests)
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telegram_bot as tb
+
+class FairSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def hold(self, scheduler):
+        """Занимает слот, чтобы следующие запросы встали в очередь"""
+        slot = scheduler.slot(0)
+        await slot.__aenter__()
+        return slot
+
+    async def run_queued(self, scheduler, requests):
+        """requests - (имя, user_id, вес, стоимость, срочный); возвращает
+        порядок, в котором запросы получили слот"""
+        order = []
+
+        async def request(name, user_id, weight, cost, urgent):
+            async with scheduler.slot(user_id, weight, cost, urgent):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        holder = await self.hold(scheduler)
+        tasks = [asyncio.create_task(request(*item)) for item in requests]
+        await asyncio.sleep(0)
+        await holder.__aexit__(None, None, None)
+        await asyncio.gather(*tasks)
+        self.assertEqual(scheduler.busy, 0)
+        return order
+
+    async def test_free_slots_pass_immediately(self):
+        scheduler = tb.FairScheduler(slots=2)
+        first, second = await self.hold(scheduler), await self.hold(scheduler)
+        self.assertEqual(scheduler.busy, 2)
+        third = asyncio.create_task(self.hold(scheduler))
+        await asyncio.sleep(0)
+        self.assertFalse(third.done())
+        await first.__aexit__(None, None, None)
+        await (await third).__aexit__(None, None, None)
+        await second.__aexit__(None, None, None)
+        self.assertEqual(scheduler.busy, 0)
+
+    async def test_users_take_turns(self):
+        # Пять запросов A в очереди раньше двух запросов B - B не ждет конца A
+        requests = [('A', 1, 1.0, 1, False)] * 5 + [('B', 2, 1.0, 1, False)] * 2
+        order = await self.run_queued(tb.FairScheduler(slots=1, quantum=1), requests)
+        self.assertEqual(order, ['A', 'B', 'A', 'B', 'A', 'A', 'A'])
+
+    async def test_weight(self):
+        requests = [('A', 1, 2.0, 1, False)] * 6 + [('B', 2, 1.0, 1, False)] * 6
+        order = await self.run_queued(tb.FairScheduler(slots=1, quantum=1), requests)
+        self.assertEqual(order[:6], ['A', 'A', 'B', 'A', 'A', 'B'])
+
+    async def test_cost(self):
+        # Пачка из трех адресов стоит как три одиночных запроса
+        requests = [('bulk', 1, 1.0, 3, False)] * 2 + [('single', 2, 1.0, 1, False)] * 8
+        order = await self.run_queued(tb.FairScheduler(slots=1, quantum=1), requests)
+        self.assertEqual(order, ['single', 'single', 'bulk', 'single', 'single', 'single',
+                                 'bulk', 'single', 'single', 'single'])
+
+    async def test_urgent_goes_first(self):
+        requests = [('A', 1, 1.0, 1, False)] * 3 + [('chat', 2, 1.0, 1, True)]
+        order = await self.run_queued(tb.FairScheduler(slots=1, quantum=1), requests)
+        self.assertEqual(order[0], 'chat')
+
+    async def test_cancel_while_waiting(self):
+        scheduler = tb.FairScheduler(slots=1)
+        holder = await self.hold(scheduler)
+        waiting = asyncio.create_task(self.hold(scheduler))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        await holder.__aexit__(None, None, None)
+        self.assertEqual(scheduler.busy, 0)
+        self.assertEqual((len(scheduler.users), scheduler.waiting), (0, {}))
+        # Очередь пуста - следующий запрос проходит сразу
+        await asyncio.wait_for(self.hold(scheduler), 1)
+
+    async def test_cancel_after_grant_releases_slot(self):
+        scheduler = tb.FairScheduler(slots=1)
+        holder = await self.hold(scheduler)
+        waiting = asyncio.create_task(self.hold(scheduler))
+        await asyncio.sleep(0)
+        # Слот отдан ожидающему, но задачу отменили раньше, чем она проснулась
+        await holder.__aexit__(None, None, None)
+        self.assertEqual(scheduler.busy, 1)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        self.assertTrue(waiting.cancelled())
+        self.assertEqual(scheduler.busy, 0)
+        await asyncio.wait_for(self.hold(scheduler), 1)
+
+if __name__ == '__main__':
+    unittest.main()